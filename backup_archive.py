@@ -0,0 +1,486 @@
+import os
+import sys
+import gzip
+import json
+import stat
+import time
+import queue
+import bisect
+import tarfile
+import argparse
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from backup_control import gate
+from backup_copy import CHUNK_SIZE, discard_partial, partial_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# --------------------------------------------------
+# Compressed, volume-split tar archives.
+#
+# Writing millions of small files to a network share costs one
+# round trip per file. An archive run streams the plan into a
+# single tar stream instead, cut into fixed-size blocks. Every
+# block is compressed on its own (one gzip member or one zstd
+# frame) by a pool of worker processes, so compression is not
+# held back by the GIL, and a writer thread writes the frames
+# in order. Concatenated frames are a valid .tar.gz / .tar.zst:
+#
+#   cat 20260101-*.tar.gz.* | tar -xz
+#
+# The workers are spawned, not forked: the web app forks from a
+# process full of threads, whose locks the child would inherit.
+#
+# Volumes are cut at frame boundaries. A sidecar index maps every
+# member to its offset in the uncompressed stream and every frame
+# to its volume and offset, so one file is extracted by
+# decompressing only the frames that hold it.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+# Archives live in <destination>/archives/
+ARCHIVE_DIR = 'archives'
+
+# Uncompressed bytes per independently compressed frame
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Just under the 4 GiB file size limit of FAT32 drives
+VOLUME_SIZE = 4000 * 1024 * 1024
+
+# A volume holds at least one frame, and the frame of a block that
+# does not compress is a little larger than the block
+MIN_VOLUME_BLOCKS = 2
+
+CODECS = ('gzip', 'zstd') if zstandard else ('gzip',)
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+EXTENSIONS = {'gzip': '.tar.gz', 'zstd': '.tar.zst'}
+
+INDEX_SUFFIX = '.index.jsonl.gz'
+
+
+def compress_block(codec, level, data):
+    """One self-contained gzip member or zstd frame (runs in a worker)."""
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def decompress_block(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def check_volume_size(volume_size, block_size=BLOCK_SIZE):
+    """Raise ValueError for a volume size no volume could keep to;
+    0 means a single volume."""
+    if 0 < volume_size < MIN_VOLUME_BLOCKS * block_size:
+        raise ValueError(
+            f"volume_size must be 0 or at least "
+            f"{MIN_VOLUME_BLOCKS * block_size} bytes"
+        )
+
+
+def index_path(out_dir, name):
+    return os.path.join(out_dir, name + INDEX_SUFFIX)
+
+
+class ArchiveWriter:
+    """Writes one archive, the same bytes into every out_dir.
+
+    Members are appended with add_file(), add_symlink(), add_link()
+    and add_dir(); close() ends the archive and writes its index,
+    abort() removes everything written so far. An out_dir failing
+    to write is dropped (see failed) while the others carry on.
+    """
+
+    def __init__(self, out_dirs, name, codec='gzip', level=None,
+                 volume_size=VOLUME_SIZE, workers=None, throttle=None,
+                 control=None, block_size=BLOCK_SIZE):
+        if codec not in CODECS:
+            raise ValueError(f"Unsupported codec: {codec}")
+        check_volume_size(volume_size, block_size)
+        self.name = name
+        self.codec = codec
+        self.level = level or DEFAULT_LEVELS[codec]
+        self.volume_size = volume_size
+        self.block_size = block_size
+        self.hook = gate(throttle, control)
+        self.throttle = throttle
+
+        # Owned by the writer thread once started
+        self.outputs = {}
+        self.failed = {}
+        self.volumes = []
+        self.volume_bytes = 0
+        self.compressed = 0
+        self.members = 0
+        self.error = None
+
+        for out_dir in out_dirs:
+            os.makedirs(out_dir, exist_ok=True)
+            index = gzip.open(
+                partial_path(index_path(out_dir, name)), 'wt',
+                encoding='utf-8'
+            )
+            self.outputs[out_dir] = [None, index]
+        self._index_line({
+            'type': 'archive', 'name': name, 'codec': codec,
+            'block_size': block_size, 'created': time.time()
+        })
+
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        # Frames being compressed or waiting to be written
+        self.frames = queue.Queue(maxsize=2 * workers)
+        self.block = bytearray()
+        self.offset = 0
+        self.block_start = 0
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    # ---- tar stream ----
+    def _append(self, data):
+        self.block += data
+        self.offset += len(data)
+        while len(self.block) >= self.block_size:
+            self._submit(bytes(self.block[:self.block_size]))
+            del self.block[:self.block_size]
+
+    def _submit(self, data):
+        if self.error:
+            raise self.error
+        future = self.pool.submit(
+            compress_block, self.codec, self.level, data
+        )
+        self.frames.put(('frame', self.block_start, len(data), future))
+        self.block_start += len(data)
+
+    def _header(self, arcname, st, kind, size=0, linkname=''):
+        info = tarfile.TarInfo(arcname)
+        info.type = kind
+        info.size = size
+        info.linkname = linkname
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = st.st_mtime_ns / 1e9
+        info.uid, info.gid = st.st_uid, st.st_gid
+        self._append(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def _member(self, arcname, kind, st, **fields):
+        self.members += 1
+        self.frames.put(('member', {
+            'path': arcname, 'kind': kind, 'mode': stat.S_IMODE(st.st_mode),
+            'mtime_ns': st.st_mtime_ns, **fields
+        }))
+
+    def add_file(self, src_file, arcname):
+        """Append a regular file; returns its size."""
+        with open(src_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            self._header(arcname, st, tarfile.REGTYPE, size)
+            data_offset = self.offset
+            remaining = size
+            error = None
+            try:
+                while remaining:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    if self.hook:
+                        self.hook.read(len(chunk))
+                    self._append(chunk)
+                    remaining -= len(chunk)
+            except OSError as e:
+                error = e
+
+        if remaining:
+            # The header already has the size: fill up with zeros so
+            # the stream stays a valid tar
+            if not error:
+                logger.warning(f"File shrank while archived: {src_file}")
+            while remaining:
+                n = min(CHUNK_SIZE, remaining)
+                self._append(bytes(n))
+                remaining -= n
+        self._append(bytes(-size % tarfile.BLOCKSIZE))
+
+        if error:
+            self._member(
+                arcname, 'file', st, offset=data_offset, size=size,
+                error=str(error)
+            )
+            raise error
+        self._member(arcname, 'file', st, offset=data_offset, size=size)
+        return size
+
+    def add_symlink(self, src_file, arcname):
+        st = os.lstat(src_file)
+        target = os.readlink(src_file)
+        self._header(arcname, st, tarfile.SYMTYPE, linkname=target)
+        self._member(arcname, 'symlink', st, target=target)
+
+    def add_link(self, src_file, arcname, first_arcname):
+        """Hard link to a member added before."""
+        st = os.stat(src_file)
+        self._header(arcname, st, tarfile.LNKTYPE, linkname=first_arcname)
+        self._member(arcname, 'link', st, target=first_arcname)
+
+    def add_dir(self, src_dir, arcname):
+        st = os.stat(src_dir)
+        self._header(arcname, st, tarfile.DIRTYPE)
+        self._member(arcname, 'dir', st)
+
+    # ---- output (writer thread) ----
+    def _index_line(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        for out_dir, output in list(self.outputs.items()):
+            try:
+                output[1].write(line)
+            except OSError as e:
+                self._drop(out_dir, e)
+
+    def _drop(self, out_dir, error):
+        logger.error(f"Archive output failed: {out_dir} | {error}")
+        self.failed[out_dir] = error
+        for f in self.outputs.pop(out_dir):
+            try:
+                if f:
+                    f.close()
+            except OSError:
+                pass
+        if not self.outputs:
+            raise error
+
+    def _next_volume(self):
+        self.volumes.append(
+            f"{self.name}{EXTENSIONS[self.codec]}.{len(self.volumes):03d}"
+        )
+        self.volume_bytes = 0
+        for out_dir, output in list(self.outputs.items()):
+            try:
+                if output[0]:
+                    output[0].close()
+                output[0] = open(os.path.join(out_dir, self.volumes[-1]), 'wb')
+            except OSError as e:
+                self._drop(out_dir, e)
+
+    def _write_frame(self, u_offset, u_length, data):
+        if not self.volumes or (
+                self.volume_size and self.volume_bytes and
+                self.volume_bytes + len(data) > self.volume_size):
+            self._next_volume()
+        if self.throttle:
+            self.throttle.write(len(data))
+        for out_dir, output in list(self.outputs.items()):
+            try:
+                output[0].write(data)
+            except OSError as e:
+                self._drop(out_dir, e)
+        self._index_line({'frame': [
+            u_offset, u_length, len(self.volumes) - 1,
+            self.volume_bytes, len(data)
+        ]})
+        self.volume_bytes += len(data)
+        self.compressed += len(data)
+
+    def _write(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+            if self.error:
+                # Keep taking items so the reading side never blocks
+                continue
+            try:
+                if item[0] == 'frame':
+                    _, u_offset, u_length, future = item
+                    self._write_frame(u_offset, u_length, future.result())
+                else:
+                    self._index_line(item[1])
+            except Exception as e:
+                self.error = e
+
+    # ---- finishing ----
+    def _stop(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.pool.shutdown(cancel_futures=True)
+
+    def close(self):
+        """End the archive; returns {'volumes', 'members', 'bytes', ...}."""
+        # End-of-archive marker, padded to a full record like tarfile
+        self._append(bytes(2 * tarfile.BLOCKSIZE))
+        self._append(bytes(-self.offset % tarfile.RECORDSIZE))
+        if self.block:
+            self._submit(bytes(self.block))
+            self.block = bytearray()
+        self._stop()
+        if self.error:
+            self.abort()
+            raise self.error
+
+        summary = {
+            'volumes': self.volumes, 'members': self.members,
+            'bytes': self.offset, 'compressed': self.compressed
+        }
+        self._index_line({'type': 'end', **summary})
+        for out_dir, (volume, index) in list(self.outputs.items()):
+            try:
+                volume.close()
+                index.close()
+                final = index_path(out_dir, self.name)
+                os.replace(partial_path(final), final)
+            except OSError as e:
+                self._drop(out_dir, e)
+        return summary
+
+    def abort(self):
+        """Remove the volumes and index written so far."""
+        if self.thread.is_alive():
+            # Frames still queued are not worth writing any more
+            self.error = self.error or RuntimeError('Archive aborted')
+            self._stop()
+        for out_dir in list(self.outputs) + list(self.failed):
+            for f in self.outputs.pop(out_dir, ()):
+                try:
+                    if f:
+                        f.close()
+                except OSError:
+                    pass
+            for name in self.volumes:
+                discard_partial(os.path.join(out_dir, name))
+            discard_partial(partial_path(index_path(out_dir, self.name)))
+
+
+# --------------------------------------------------
+# Reading
+# --------------------------------------------------
+class ArchiveReader:
+    """Random access to the members of an archive through its index."""
+
+    def __init__(self, path):
+        self.dir = os.path.dirname(path)
+        self.members = {}
+        frames = []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'frame' in entry:
+                    frames.append(entry['frame'])
+                elif 'path' in entry:
+                    self.members[entry['path']] = entry
+                elif entry.get('type') == 'archive':
+                    self.codec = entry['codec']
+                elif entry.get('type') == 'end':
+                    self.volumes = entry['volumes']
+        # Frames are indexed in stream order
+        self.frames = frames
+        self.starts = [frame[0] for frame in frames]
+
+    def read_range(self, offset, size):
+        """Yield the stream bytes [offset, offset + size), frame by frame."""
+        end = offset + size
+        i = bisect.bisect_right(self.starts, offset) - 1
+        volume = None
+        try:
+            while offset < end:
+                u_offset, u_length, n, c_offset, c_length = self.frames[i]
+                if volume is None or volume.name != self._volume(n):
+                    if volume:
+                        volume.close()
+                    volume = open(self._volume(n), 'rb')
+                volume.seek(c_offset)
+                data = decompress_block(self.codec, volume.read(c_length))
+                chunk = data[offset - u_offset:min(end, u_offset + u_length)
+                             - u_offset]
+                yield chunk
+                offset += len(chunk)
+                i += 1
+        finally:
+            if volume:
+                volume.close()
+
+    def _volume(self, n):
+        return os.path.join(self.dir, self.volumes[n])
+
+    def extract(self, path, target):
+        """Write member path to the file target; returns its size."""
+        member = self.members[path]
+        if member['kind'] == 'link':
+            # Alone, a hard link becomes a copy of its first name
+            member = self.members[member['target']]
+
+        if member['kind'] == 'dir':
+            os.makedirs(target, exist_ok=True)
+        elif member['kind'] == 'symlink':
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.symlink(member['target'], target)
+            return 0
+        else:
+            tmp = partial_path(target)
+            try:
+                with open(tmp, 'wb') as out:
+                    for chunk in self.read_range(
+                            member['offset'], member['size']):
+                        out.write(chunk)
+                os.replace(tmp, target)
+            except BaseException:
+                discard_partial(tmp)
+                raise
+
+        os.chmod(target, member['mode'])
+        os.utime(target, ns=(member['mtime_ns'], member['mtime_ns']))
+        return member.get('size', 0)
+
+
+# --------------------------------------------------
+# Command line
+#
+#   python backup_archive.py list /mnt/nas/archives/<run_id>.index.jsonl.gz
+#   python backup_archive.py extract <index> src/Documents/a.txt -C /tmp
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List or extract members of a backup archive'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list').add_argument('index')
+    extract = sub.add_parser('extract')
+    extract.add_argument('index')
+    extract.add_argument('paths', nargs='+')
+    extract.add_argument('-C', dest='target', default='.')
+    args = parser.parse_args(argv)
+
+    reader = ArchiveReader(args.index)
+    if args.command == 'list':
+        for path, member in reader.members.items():
+            print(f"{member['kind']:8} {member.get('size', 0):>14} {path}")
+        return 0
+
+    missing = [path for path in args.paths if path not in reader.members]
+    if missing:
+        print(f"Not in archive: {', '.join(missing)}", file=sys.stderr)
+        return 1
+
+    for path in args.paths:
+        target = os.path.join(args.target, path)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        reader.extract(path, target)
+        print(target)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
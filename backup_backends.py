@@ -0,0 +1,431 @@
+import os
+import time
+import base64
+import sqlite3
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from backup_control import gate
+from backup_pathindex import PathIndex
+
+try:
+    import boto3
+    from botocore.config import Config
+except ImportError:
+    boto3 = None
+
+# --------------------------------------------------
+# Destination backends.
+#
+# Local directories are written by the copy engine directly.
+# Any other destination is a URL whose scheme picks a Backend
+# (see BACKENDS), e.g. s3://bucket/prefix. A backend lists what
+# it holds as a PathIndex, so the incremental plan and the mirror
+# diff work as for a directory, and takes one file at a time
+# through upload(). Keys are the paths used in the manifests
+# ('source1/a/f1') under the URL's prefix.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+# Local state of remote destinations, in the user's home: a job
+# started from another working directory finds the same listings
+REMOTE_HOME = os.path.join(os.path.expanduser('~'), '.backup-remote')
+
+# Local copy of the remote listings, with the source mtime of
+# every object uploaded from here
+REMOTE_CACHE_DB = os.path.join(REMOTE_HOME, 'remotecache.db')
+
+# Local staging area for the manifests of remote destinations
+REMOTE_STATE_DIR = os.path.join(REMOTE_HOME, 'state')
+
+# S3: keep-alive connections shared by all threads of a job
+POOL_CONNECTIONS = 64
+# Files from this size up are sent as parallel multipart uploads
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+PART_WORKERS = 8
+# Keys per DeleteObjects request (the S3 maximum)
+DELETE_BATCH = 1000
+
+
+def is_remote(destination):
+    scheme, sep, _ = destination.partition('://')
+    return bool(sep) and scheme in BACKENDS
+
+
+def open_backend(destination, **options):
+    """Backend for a destination URL; options go to its constructor."""
+    scheme = destination.split('://', 1)[0]
+    return BACKENDS[scheme](destination, **options)
+
+
+class Backend:
+    """A destination that is not a local directory.
+
+    label names the destination for the concurrency tuner and
+    state_dir is a local directory for its manifests, which
+    put_file() then stores remotely.
+    """
+
+    label = None
+    state_dir = None
+
+    def index(self, base):
+        """PathIndex of what is stored under base (a source's name)."""
+        raise NotImplementedError
+
+    def upload(self, src_file, rel_path, throttle=None, control=None):
+        """Store src_file as rel_path; returns (size, bytes sent)."""
+        raise NotImplementedError
+
+    def copy(self, src_rel, dest_rel, mtime_ns):
+        """Store a copy of src_rel as dest_rel (hard links)."""
+        raise NotImplementedError
+
+    def remove(self, rel_paths):
+        """Delete rel_paths; returns those actually deleted."""
+        raise NotImplementedError
+
+    def put_file(self, path, rel_path):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# --------------------------------------------------
+# Remote listing cache
+# --------------------------------------------------
+class ListingCache:
+    """SQLite copy of object listings: key -> size, etag, mtime_ns.
+
+    mtime_ns is the source file's mtime when the object was
+    uploaded from here; it is kept only while size and etag still
+    match the remote listing, so a changed object is never taken
+    for up to date.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS objects ('
+            ' store TEXT, key TEXT, size INTEGER, etag TEXT,'
+            ' mtime_ns INTEGER, PRIMARY KEY (store, key))'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS listings ('
+            ' store TEXT, prefix TEXT, listed_at REAL,'
+            ' PRIMARY KEY (store, prefix))'
+        )
+        self.db.commit()
+
+    def listed_at(self, store, prefix):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT listed_at FROM listings WHERE store = ? AND prefix = ?',
+                (store, prefix)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def replace(self, store, prefix, listing):
+        """Take a fresh listing {key: (size, etag)} of prefix."""
+        with self.lock:
+            known = {
+                key: (size, etag, mtime_ns)
+                for key, size, etag, mtime_ns in self.db.execute(
+                    'SELECT key, size, etag, mtime_ns FROM objects'
+                    ' WHERE store = ? AND key >= ? AND key < ?',
+                    (store, prefix, prefix + '\U0010ffff')
+                )
+            }
+            self.db.execute(
+                'DELETE FROM objects WHERE store = ? AND key >= ? AND key < ?',
+                (store, prefix, prefix + '\U0010ffff')
+            )
+            rows = []
+            for key, (size, etag) in listing.items():
+                old = known.get(key)
+                same = old is not None and old[:2] == (size, etag)
+                rows.append((
+                    store, key, size, etag, old[2] if same else None
+                ))
+            self.db.executemany(
+                'INSERT INTO objects VALUES (?, ?, ?, ?, ?)', rows
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?)',
+                (store, prefix, time.time())
+            )
+            self.db.commit()
+
+    def rows(self, store, prefix):
+        """(key, size, etag, mtime_ns) of every object under prefix."""
+        with self.lock:
+            return self.db.execute(
+                'SELECT key, size, etag, mtime_ns FROM objects'
+                ' WHERE store = ? AND key >= ? AND key < ?',
+                (store, prefix, prefix + '\U0010ffff')
+            ).fetchall()
+
+    def put(self, store, key, size, etag, mtime_ns):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                (store, key, size, etag, mtime_ns)
+            )
+
+    def delete(self, store, keys):
+        with self.lock:
+            self.db.executemany(
+                'DELETE FROM objects WHERE store = ? AND key = ?',
+                ((store, key) for key in keys)
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+# --------------------------------------------------
+# S3-compatible object storage
+# --------------------------------------------------
+def _md5(data=b''):
+    return hashlib.md5(data, usedforsecurity=False)
+
+
+def multipart_etag(part_digests):
+    """ETag S3 gives an object uploaded in these parts."""
+    combined = _md5(b''.join(part_digests)).hexdigest()
+    return f"{combined}-{len(part_digests)}"
+
+
+class S3Backend(Backend):
+    """s3://bucket/prefix on AWS or any S3-compatible server.
+
+    endpoint_url selects another server (MinIO, moto_server, ...);
+    credentials come from the usual AWS environment, config files
+    or access_key/secret_key. One client is shared by all threads,
+    so its connection pool is too.
+
+    Objects are skipped when the cached listing says they were
+    uploaded from the same size and mtime. Otherwise, if only the
+    mtime differs, the local ETag (the MD5 scheme S3 uses for the
+    same part size) is compared first, so touched files are not
+    sent again.
+    """
+
+    def __init__(self, url, endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, part_size=PART_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD,
+                 part_workers=PART_WORKERS, pool_connections=POOL_CONNECTIONS,
+                 listing_max_age=0, cache_db=REMOTE_CACHE_DB):
+        if boto3 is None:
+            raise RuntimeError("S3 destinations need boto3 (pip install boto3)")
+
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        if not bucket:
+            raise ValueError(f"No bucket in {url}")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.store = f"{endpoint_url or 's3'}/{bucket}"
+        self.label = f"s3:{bucket}"
+        self.state_dir = os.path.join(REMOTE_STATE_DIR, bucket, self.prefix)
+        self.part_size = part_size
+        self.multipart_threshold = max(multipart_threshold, part_size)
+        self.listing_max_age = listing_max_age
+
+        self.client = boto3.session.Session().client(
+            's3', endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+            config=Config(
+                max_pool_connections=pool_connections,
+                retries={'max_attempts': 5, 'mode': 'adaptive'}
+            )
+        )
+        self.parts = ThreadPoolExecutor(max_workers=part_workers)
+        self.cache = ListingCache(cache_db)
+        self.lock = threading.Lock()
+        # key -> (size, etag) as listed at the start of the job, and
+        # the cached source mtimes of those objects
+        self.remote = None
+        self.mtimes = {}
+
+    def key(self, rel_path):
+        rel_path = rel_path.replace(os.sep, '/')
+        return f"{self.prefix}/{rel_path}" if self.prefix else rel_path
+
+    # ---- listing ----
+    def _list(self):
+        prefix = self.key('')
+        if time.time() - self.cache.listed_at(self.store, prefix) \
+                >= self.listing_max_age:
+            listing = {}
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for obj in page.get('Contents', ()):
+                    listing[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+            self.cache.replace(self.store, prefix, listing)
+            logger.info(f"Listed {len(listing)} objects in {self.label}/{prefix}")
+        return self.cache.rows(self.store, prefix)
+
+    def index(self, base):
+        with self.lock:
+            if self.remote is None:
+                rows = self._list()
+                self.remote = {key: (size, etag) for key, size, etag, _ in rows}
+                self.mtimes = {key: mtime for key, _, _, mtime in rows}
+        root = self.key(base) + '/'
+        # Unknown mtime (not uploaded from here): 0, so it gets checked
+        return PathIndex.from_files(
+            (key[len(root):], size, self.mtimes.get(key) or 0)
+            for key, (size, _) in self.remote.items()
+            if key.startswith(root)
+        )
+
+    # ---- uploading ----
+    def upload(self, src_file, rel_path, throttle=None, control=None):
+        key = self.key(rel_path)
+        hook = gate(throttle, control)
+        with open(src_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            remote = self.remote.get(key) if self.remote else None
+            if remote and remote[0] == size and \
+                    self._local_etag(f.fileno(), size, hook) == remote[1]:
+                self.cache.put(self.store, key, size, remote[1], st.st_mtime_ns)
+                return size, 0
+
+            metadata = {'mtime-ns': str(st.st_mtime_ns)}
+            if size < self.multipart_threshold:
+                data = f.read()
+                if hook:
+                    hook.read(len(data))
+                    hook.write(len(data))
+                digest = _md5(data).digest()
+                response = self.client.put_object(
+                    Bucket=self.bucket, Key=key, Body=data, Metadata=metadata,
+                    ContentMD5=base64.b64encode(digest).decode()
+                )
+                etag = response['ETag'].strip('"')
+            else:
+                etag = self._multipart(f.fileno(), key, size, metadata, hook)
+
+        self.cache.put(self.store, key, size, etag, st.st_mtime_ns)
+        with self.lock:
+            self.remote[key] = (size, etag)
+        return size, size
+
+    def _local_etag(self, fd, size, hook):
+        if size < self.multipart_threshold:
+            data = os.pread(fd, size, 0)
+            if hook:
+                hook.read(len(data))
+            return _md5(data).hexdigest()
+        digests = []
+        for offset in range(0, size, self.part_size):
+            data = os.pread(fd, self.part_size, offset)
+            if hook:
+                hook.read(len(data))
+            digests.append(_md5(data).digest())
+        return multipart_etag(digests)
+
+    def _part(self, fd, key, upload_id, number, hook):
+        data = os.pread(fd, self.part_size, (number - 1) * self.part_size)
+        if hook:
+            hook.read(len(data))
+            hook.write(len(data))
+        digest = _md5(data).digest()
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload_id,
+            PartNumber=number, Body=data,
+            ContentMD5=base64.b64encode(digest).decode()
+        )
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    def _multipart(self, fd, key, size, metadata, hook):
+        """Send the parts in parallel; every part is checked by MD5."""
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, Metadata=metadata
+        )['UploadId']
+        count = -(-size // self.part_size)
+        futures = [
+            self.parts.submit(self._part, fd, key, upload_id, n, hook)
+            for n in range(1, count + 1)
+        ]
+        try:
+            parts = [future.result() for future in futures]
+            response = self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            # Parts still running would outlive the abort
+            wait(futures)
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id
+                )
+            except Exception as e:
+                logger.warning(f"Abort failed for {key}: {e}")
+            raise
+        return response['ETag'].strip('"')
+
+    # ---- other operations ----
+    def copy(self, src_rel, dest_rel, mtime_ns):
+        src_key, key = self.key(src_rel), self.key(dest_rel)
+        response = self.client.copy_object(
+            Bucket=self.bucket, Key=key,
+            CopySource={'Bucket': self.bucket, 'Key': src_key}
+        )
+        etag = response['CopyObjectResult']['ETag'].strip('"')
+        size = self.remote.get(src_key, (None,))[0]
+        self.cache.put(self.store, key, size, etag, mtime_ns)
+        with self.lock:
+            self.remote[key] = (size, etag)
+
+    def remove(self, rel_paths):
+        keys = {self.key(rel_path): rel_path for rel_path in rel_paths}
+        batches = list(keys)
+        removed = []
+        for start in range(0, len(batches), DELETE_BATCH):
+            batch = batches[start:start + DELETE_BATCH]
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True}
+            )
+            errors = set()
+            for error in response.get('Errors', ()):
+                errors.add(error['Key'])
+                logger.error(
+                    f"Remove failed: {self.label}/{error['Key']} | "
+                    f"{error.get('Message')}"
+                )
+            deleted = [key for key in batch if key not in errors]
+            self.cache.delete(self.store, deleted)
+            with self.lock:
+                for key in deleted:
+                    self.remote.pop(key, None)
+            removed += [keys[key] for key in deleted]
+        return removed
+
+    def put_file(self, path, rel_path):
+        self.client.upload_file(path, self.bucket, self.key(rel_path))
+
+    def close(self):
+        self.parts.shutdown()
+        self.cache.close()
+
+
+# Destination URL scheme -> Backend class
+BACKENDS = {
+    's3': S3Backend,
+}
@@ -0,0 +1,769 @@
+import os
+import sys
+import json
+import time
+import hmac
+import heapq
+import shutil
+import argparse
+import threading
+import logging
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backup_control import Cancelled, JobControl
+from backup_copy import COPY_TIERS, copy_file
+from backup_history import Phases
+from backup_logging import RunManifest, new_run_id, read_manifest
+from backup_metadata import MetadataQueue
+from backup_pagecache import IO_MODES
+from backup_pathindex import ROOT, SYMLINK, DirLister, PathIndex
+from backup_scan import ParallelScanner
+
+# --------------------------------------------------
+# Coordinator / agent mode.
+#
+# The coordinator scans the sources once and splits them into
+# shards of about equal cost (files and bytes): directories too
+# big for one shard are split into their subdirectories plus their
+# own files. Agents are small HTTP servers (stdlib only) that each
+# back up one shard at a time:
+#
+#   POST /shards   {run_id, shard_id, attempt, destination, items, options}
+#   GET  /status   state and counters of the current shard
+#   POST /pause, /resume, /cancel
+#
+# Each shard item is (source, rel_dir, recursive): a whole subtree,
+# or only the files of one directory. Agents compare and copy their
+# items like an incremental backup and write a manifest of their
+# own under <destination>/.backup/shards/<run_id>/. The coordinator
+# polls the agents, sums up their progress, hands the shard of an
+# agent that stops answering (or fails) to another one, and finally
+# merges the shard manifests into the run's manifest.
+#
+# Sources and the destination must be at the same paths on every
+# agent (local disks for agents on one machine, shared mounts
+# otherwise).
+#
+# Agents write wherever a shard tells them to, so every request
+# must carry the shared token in the X-Backup-Token header; others
+# get 401. Agents and coordinators take it from --token or from
+# BACKUP_AGENT_TOKEN, and an agent does not start without one.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+AGENT_PORT = 8701
+AGENT_WORKERS = 8
+
+# Shards per agent: smaller shards even out differences in speed
+# and lose less work when an agent dies
+SHARDS_PER_AGENT = 4
+
+# A file costs as much as this many bytes on top of its size
+# (open, create, metadata), when shards are balanced
+FILE_COST_BYTES = 256 * 1024
+
+POLL_SECONDS = 0.5
+HTTP_TIMEOUT = 5
+# Failed requests in a row before an agent counts as gone
+AGENT_FAILURES = 3
+# Attempts per shard before it counts as failed
+SHARD_ATTEMPTS = 3
+
+SHARD_DIR = os.path.join('.backup', 'shards')
+
+TOKEN_HEADER = 'X-Backup-Token'
+TOKEN_ENV = 'BACKUP_AGENT_TOKEN'
+
+
+def shard_dir(destination, run_id):
+    return os.path.join(destination, SHARD_DIR, run_id)
+
+
+def agent_token(token=None):
+    """The shared token: token, else BACKUP_AGENT_TOKEN (or None)."""
+    return token or os.environ.get(TOKEN_ENV) or None
+
+
+# --------------------------------------------------
+# Sharding
+# --------------------------------------------------
+def cost(files, size):
+    return files * FILE_COST_BYTES + size
+
+
+def split_tree(index, source, target):
+    """Shard items of one source: subtrees costing at most target.
+
+    A directory above target becomes an item of its own files
+    (recursive False) and its subdirectories are split further.
+    Returns [(item, files, bytes)].
+    """
+    n = index.dir_total()
+    files = [index.dir_count[d] for d in range(n)]
+    sizes = [sum(index.sizes[i] for i in index.files_in(d)) for d in range(n)]
+    own = list(zip(files, sizes))
+    children = [[] for _ in range(n)]
+    # Children have larger ids than their parents
+    for d in range(n - 1, 0, -1):
+        parent = index.dir_parent[d]
+        children[parent].append(d)
+        files[parent] += files[d]
+        sizes[parent] += sizes[d]
+
+    items = []
+    stack = [ROOT]
+    while stack:
+        d = stack.pop()
+        item = {'source': source, 'path': index.dir_path(d)}
+        if cost(files[d], sizes[d]) <= target or not children[d]:
+            items.append(({**item, 'recursive': True}, files[d], sizes[d]))
+            continue
+        items.append(({**item, 'recursive': False}, *own[d]))
+        stack.extend(children[d])
+    return items
+
+
+def make_shards(indexes, count):
+    """Split {source: PathIndex} into at most count balanced shards.
+
+    Items go largest first to the cheapest shard so far.
+    """
+    total = sum(cost(len(index), index.total_bytes())
+                for index in indexes.values())
+    target = max(1, total // max(1, count))
+    items = []
+    for source, index in indexes.items():
+        items += split_tree(index, source, target)
+    items.sort(key=lambda item: cost(item[1], item[2]), reverse=True)
+
+    shards = [
+        {'shard_id': f"{n:04d}", 'items': [], 'files': 0, 'bytes': 0}
+        for n in range(max(1, min(count, len(items))))
+    ]
+    heap = [(0, n) for n in range(len(shards))]
+    for item, files, size in items:
+        load, n = heapq.heappop(heap)
+        shard = shards[n]
+        shard['items'].append(item)
+        shard['files'] += files
+        shard['bytes'] += size
+        heapq.heappush(heap, (load + cost(files, size), n))
+    return [shard for shard in shards if shard['items']]
+
+
+# --------------------------------------------------
+# Agent
+# --------------------------------------------------
+def _listing(path, symlinks):
+    """PathIndex of the files directly in path (no subdirectories)."""
+    index = PathIndex()
+    lister = DirLister(path, symlinks)
+    listing = lister.list(path, lister.root_ancestors()) \
+        if os.path.isdir(path) else None
+    index.add_listing(ROOT, listing[0] if listing else [], {})
+    return index
+
+
+class Agent:
+    """Runs one shard at a time; the HTTP handler drives it."""
+
+    def __init__(self, workers=AGENT_WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.thread = None
+        self.control = JobControl()
+        self.status = {'state': 'idle'}
+
+    def start(self, shard):
+        with self.lock:
+            if self.status['state'] == 'running':
+                return False
+            self.control = JobControl()
+            self.status = {
+                'state': 'running', 'run_id': shard['run_id'],
+                'shard_id': shard['shard_id'],
+                'attempt': shard.get('attempt', 1),
+                'total_files': 0, 'copied_files': 0, 'skipped_files': 0,
+                'failed_files': 0, 'linked_files': 0, 'bytes_copied': 0,
+                'manifest': None, 'error': None
+            }
+            self.thread = threading.Thread(
+                target=self._run, args=(shard,), daemon=True
+            )
+            self.thread.start()
+            return True
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.status)
+
+    def cancel(self):
+        self.control.cancel()
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.status[key] += n
+
+    def _run(self, shard):
+        destination = shard['destination']
+        options = shard.get('options') or {}
+        path = os.path.join(
+            shard_dir(destination, shard['run_id']),
+            f"{shard['shard_id']}-{shard.get('attempt', 1)}.jsonl.gz"
+        )
+        manifest = None
+        metadata = MetadataQueue()
+        state = 'done'
+        try:
+            manifest = RunManifest(
+                destination, shard['run_id'], path=path,
+                shard_id=shard['shard_id'], attempt=shard.get('attempt', 1)
+            )
+            self.status['manifest'] = path
+            with ThreadPoolExecutor(max_workers=self.workers) as pool, \
+                    ParallelScanner(control=self.control) as scanner:
+                for item in shard['items']:
+                    self._item(
+                        item, destination, options, manifest, metadata,
+                        scanner, pool
+                    )
+        except Cancelled:
+            state = 'cancelled'
+        except Exception as e:
+            logger.exception(f"Shard {shard['shard_id']} failed")
+            state = 'failed'
+            self.status['error'] = str(e)
+        finally:
+            # Copied files keep their times, whatever stopped the shard
+            try:
+                metadata.finish()
+            except Exception:
+                logger.exception("Metadata not applied")
+            if manifest is not None:
+                manifest.close(status=state)
+            with self.lock:
+                self.status['state'] = state
+
+    def _item(self, item, destination, options, manifest, metadata, scanner,
+              pool):
+        """Back up one shard item incrementally."""
+        source = item['source']
+        base = os.path.join(os.path.basename(source), item['path'])
+        src_root = os.path.join(source, item['path'])
+        dest_root = os.path.join(destination, base)
+        symlinks = options.get('symlinks', 'preserve')
+
+        if item['recursive']:
+            index = scanner.scan(src_root, symlinks)
+            dest_index = scanner.scan(dest_root) \
+                if os.path.isdir(dest_root) else PathIndex()
+        else:
+            index = _listing(src_root, symlinks)
+            dest_index = _listing(dest_root, 'preserve')
+        pending = set(index.changed(dest_index))
+        self._count('total_files', len(index))
+
+        links = []
+        futures = []
+        for d in range(index.dir_total()):
+            self.control.checkpoint()
+            rel = index.dir_path(d)
+            src_dir = os.path.join(src_root, rel)
+            dest_dir = os.path.join(dest_root, rel)
+            os.makedirs(dest_dir, exist_ok=True)
+            metadata.add_dir(src_dir, dest_dir)
+
+            for i in index.files_in(d):
+                f = index.file_names[i]
+                rel_path = os.path.join(base, rel, f)
+                if i not in pending:
+                    manifest.record(
+                        'skipped', rel_path,
+                        size=index.sizes[i], mtime_ns=index.mtimes[i]
+                    )
+                    self._count('skipped_files')
+                elif index.kinds[i] == SYMLINK:
+                    self._symlink(
+                        os.path.join(src_dir, f), os.path.join(dest_dir, f),
+                        rel_path, manifest
+                    )
+                elif i in index.hardlinks:
+                    links.append((i, rel_path))
+                else:
+                    futures.append(pool.submit(
+                        self._copy, os.path.join(src_dir, f),
+                        os.path.join(dest_dir, f), rel_path, options,
+                        manifest, metadata
+                    ))
+
+        for future in futures:
+            future.result()
+        # Hard links within the item, once their first file is there
+        for i, rel_path in links:
+            first = os.path.join(
+                dest_root, index.file_path(index.hardlinks[i])
+            )
+            dest_file = os.path.join(destination, rel_path)
+            try:
+                if not (os.path.exists(dest_file) and
+                        os.path.samefile(first, dest_file)):
+                    tmp = dest_file + '.backup-link'
+                    if os.path.lexists(tmp):
+                        os.unlink(tmp)
+                    os.link(first, tmp)
+                    os.replace(tmp, dest_file)
+            except OSError as e:
+                manifest.record('failed', rel_path, error=str(e))
+                self._count('failed_files')
+                continue
+            manifest.record(
+                'linked', rel_path, size=index.sizes[i],
+                mtime_ns=index.mtimes[i],
+                target=os.path.relpath(first, destination)
+            )
+            self._count('linked_files')
+            self._count('copied_files')
+        metadata.flush()
+
+    def _copy(self, src_file, dest_file, rel_path, options, manifest,
+              metadata):
+        try:
+            st = os.stat(src_file)
+            size, written = copy_file(
+                src_file, dest_file, None, options.get('copy_tier', 'auto'),
+                None, options.get('io_mode', 'normal'), metadata,
+                self.control
+            )
+        except Cancelled:
+            manifest.record('cancelled', rel_path)
+            return
+        except OSError as e:
+            manifest.record(
+                'failed', rel_path, error=str(e), errno=e.errno
+            )
+            self._count('failed_files')
+            return
+        manifest.record(
+            'copied', rel_path, size=size, transferred=written,
+            mtime_ns=st.st_mtime_ns
+        )
+        with self.lock:
+            self.status['copied_files'] += 1
+            self.status['bytes_copied'] += size
+
+    def _symlink(self, src_file, dest_file, rel_path, manifest):
+        try:
+            target = os.readlink(src_file)
+            if os.path.lexists(dest_file):
+                os.unlink(dest_file)
+            os.symlink(target, dest_file)
+        except OSError as e:
+            manifest.record('failed', rel_path, error=str(e))
+            self._count('failed_files')
+            return
+        manifest.record('symlink', rel_path, target=target)
+        self._count('copied_files')
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    agent = None
+    token = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        given = self.headers.get(TOKEN_HEADER) or ''
+        if self.token and hmac.compare_digest(given, self.token):
+            return True
+        self._reply(401, {'status': 'error', 'message': 'Bad token'})
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == '/status':
+            self._reply(200, self.agent.snapshot())
+        else:
+            self._reply(404, {'status': 'error', 'message': 'Not found'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._reply(400, {'status': 'error', 'message': 'Bad JSON'})
+            return
+        if self.path == '/shards':
+            if not self.agent.start(body):
+                self._reply(409, {'status': 'error', 'message': 'Busy'})
+                return
+            self._reply(202, {'status': 'started'})
+        elif self.path in ('/pause', '/resume'):
+            control = self.agent.control
+            state = control.pause() if self.path == '/pause' \
+                else control.resume()
+            self._reply(200, {'status': state})
+        elif self.path == '/cancel':
+            self.agent.cancel()
+            self._reply(200, {'status': 'cancelling'})
+        else:
+            self._reply(404, {'status': 'error', 'message': 'Not found'})
+
+    def log_message(self, format, *args):
+        # Status polls would drown everything else
+        if '/status' not in self.requestline:
+            logger.info(f"Agent: {format % args}")
+
+
+def agent_server(agent, host='127.0.0.1', port=AGENT_PORT, token=None):
+    """HTTP server of agent, not started yet; raises ValueError without
+    a token."""
+    token = agent_token(token)
+    if not token:
+        raise ValueError(
+            f"Agents need a shared token (--token or {TOKEN_ENV})"
+        )
+    handler = type(
+        'Handler', (AgentHandler,), {'agent': agent, 'token': token}
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve_agent(host='127.0.0.1', port=AGENT_PORT, workers=AGENT_WORKERS,
+                token=None):
+    """Run an agent until interrupted."""
+    server = agent_server(Agent(workers), host, port, token)
+    logger.info(f"Agent listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# --------------------------------------------------
+# Coordinator
+# --------------------------------------------------
+def _call(url, path, body=None, token=None):
+    """JSON request to an agent; raises OSError on any failure."""
+    data = json.dumps(body).encode() if body is not None else None
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers[TOKEN_HEADER] = token
+    req = urllib.request.Request(
+        url.rstrip('/') + path, data=data, headers=headers
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+            return resp.status, json.loads(resp.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        return e.code, {}
+    except (urllib.error.URLError, ValueError) as e:
+        raise OSError(f"{url}: {e}") from e
+
+
+class Coordinator:
+    """Backs up source_dirs to destination on a set of agents.
+
+    progress is kept up to date while run() polls the agents;
+    report(progress) is called after every poll. token is the
+    agents' shared token (default: BACKUP_AGENT_TOKEN).
+    """
+
+    def __init__(self, agents, source_dirs, destination, run_id=None,
+                 options=None, control=None, report=None, catalog=None,
+                 shards_per_agent=SHARDS_PER_AGENT, token=None):
+        self.agents = {
+            url: {'shard': None, 'failures': 0, 'alive': True, 'status': {}}
+            for url in agents
+        }
+        self.source_dirs = [s for s in source_dirs if os.path.isdir(s)]
+        self.destination = destination
+        self.run_id = run_id or new_run_id()
+        self.options = options or {}
+        self.control = control or JobControl()
+        self.report = report
+        # CatalogRun fed by the merged manifest
+        self.catalog = catalog
+        self.shards_per_agent = shards_per_agent
+        self.token = agent_token(token)
+        self.progress = {
+            'total_files': 0, 'bytes_total': 0, 'copied_files': 0,
+            'skipped_files': 0, 'failed_files': 0, 'linked_files': 0,
+            'bytes_copied': 0, 'shards_total': 0, 'shards_done': 0,
+            'shards_failed': 0, 'reassigned': 0, 'agents': {}
+        }
+        self.phases = Phases()
+        self.shards = {}
+        # shard_id -> final counters of its successful attempt
+        self.finished = {}
+
+    def scan(self):
+        with ParallelScanner(control=self.control) as scanner:
+            return {
+                src: scanner.scan(src, self.options.get('symlinks', 'preserve'))
+                for src in self.source_dirs
+            }
+
+    def run(self):
+        """Returns the progress summary; raises Cancelled or RuntimeError."""
+        with self.phases('scan'):
+            indexes = self.scan()
+        self.progress['total_files'] = sum(len(i) for i in indexes.values())
+        self.progress['bytes_total'] = sum(
+            i.total_bytes() for i in indexes.values()
+        )
+        shards = make_shards(
+            indexes, len(self.agents) * self.shards_per_agent
+        )
+        for shard in shards:
+            shard['attempt'] = 0
+            self.shards[shard['shard_id']] = shard
+        self.progress['shards_total'] = len(shards)
+        logger.info(
+            f"Cluster run {self.run_id}: {len(shards)} shards on "
+            f"{len(self.agents)} agents | "
+            + ', '.join(f"{s['shard_id']}={s['files']}/{s['bytes']}"
+                        for s in shards)
+        )
+
+        queue = [shard['shard_id'] for shard in shards]
+        try:
+            with self.phases('copy'):
+                self._drive(queue)
+        except Cancelled:
+            self._broadcast('/cancel')
+            raise
+
+        self._sum_up()
+        with self.phases('merge'):
+            self.merge()
+        return self.progress
+
+    def _drive(self, queue):
+        """Poll the agents until every shard is done or given up."""
+        while queue or any(a['shard'] for a in self.agents.values()):
+            if self.control.cancelled:
+                raise Cancelled()
+            if self.control.state == 'paused':
+                # Agents pause their own copies; polling waits too
+                self._broadcast('/pause')
+                self.control.checkpoint()
+                self._broadcast('/resume')
+            for url, agent in self.agents.items():
+                if agent['alive']:
+                    self._poll(url, agent, queue)
+            if not any(a['alive'] for a in self.agents.values()):
+                raise RuntimeError('No agents left')
+            self._sum_up()
+            if self.report:
+                self.report(self.progress)
+            time.sleep(POLL_SECONDS)
+
+    def _broadcast(self, path):
+        """Send path to every live agent busy with a shard."""
+        for url, agent in self.agents.items():
+            if agent['shard'] and agent['alive']:
+                try:
+                    _call(url, path, {}, self.token)
+                except OSError:
+                    pass
+
+    def _poll(self, url, agent, queue):
+        try:
+            if agent['shard'] is not None:
+                self._check(url, agent, queue)
+            # A finished agent gets its next shard right away
+            if agent['shard'] is None and queue:
+                self._assign(url, agent, queue)
+        except OSError as e:
+            agent['failures'] += 1
+            logger.warning(f"Agent not answering: {url} | {e}")
+            if agent['failures'] >= AGENT_FAILURES:
+                self._lost(url, agent, queue)
+            return
+        agent['failures'] = 0
+
+    def _check(self, url, agent, queue):
+        code, status = _call(url, '/status', token=self.token)
+        if code != 200:
+            raise OSError(f"{url}: HTTP {code}")
+        shard = self.shards[agent['shard']]
+        if (status.get('shard_id') != shard['shard_id'] or
+                status.get('attempt') != shard['attempt']):
+            # Restarted agent: the shard is gone with it
+            self._requeue(url, agent, queue, 'agent restarted')
+            return
+        agent['status'] = status
+        if status['state'] == 'done':
+            self.finished[shard['shard_id']] = status
+            agent['shard'] = None
+            agent['status'] = {}
+            self.progress['shards_done'] += 1
+        elif status['state'] in ('failed', 'cancelled'):
+            self._requeue(url, agent, queue, status.get('error'))
+
+    def _assign(self, url, agent, queue):
+        shard = self.shards[queue[0]]
+        body = {
+            'run_id': self.run_id, 'shard_id': shard['shard_id'],
+            'attempt': shard['attempt'] + 1,
+            'destination': self.destination, 'items': shard['items'],
+            'options': self.options
+        }
+        code, _ = _call(url, '/shards', body, self.token)
+        if code == 409:
+            return
+        if code != 202:
+            raise OSError(f"{url}: HTTP {code}")
+        queue.pop(0)
+        shard['attempt'] += 1
+        shard['agent'] = url
+        agent['shard'] = shard['shard_id']
+
+    def _requeue(self, url, agent, queue, reason):
+        shard = self.shards[agent['shard']]
+        agent['shard'] = None
+        agent['status'] = {}
+        if shard['attempt'] >= SHARD_ATTEMPTS:
+            logger.error(
+                f"Shard {shard['shard_id']} failed {shard['attempt']} times:"
+                f" {reason}"
+            )
+            self.progress['shards_failed'] += 1
+            return
+        logger.warning(
+            f"Shard {shard['shard_id']} reassigned (from {url}): {reason}"
+        )
+        self.progress['reassigned'] += 1
+        queue.insert(0, shard['shard_id'])
+
+    def _lost(self, url, agent, queue):
+        agent['alive'] = False
+        logger.error(f"Agent lost: {url}")
+        if agent['shard']:
+            # Its files so far are found unchanged by the next attempt
+            self._requeue(url, agent, queue, 'agent lost')
+
+    def _sum_up(self):
+        counters = (
+            'copied_files', 'skipped_files', 'failed_files', 'linked_files',
+            'bytes_copied'
+        )
+        live = list(self.finished.values()) + [
+            a['status'] for a in self.agents.values() if a['status']
+        ]
+        for key in counters:
+            self.progress[key] = sum(s.get(key, 0) for s in live)
+        self.progress['agents'] = {
+            url: {
+                'alive': a['alive'], 'shard': a['shard'],
+                'copied_files': a['status'].get('copied_files', 0),
+                'bytes_copied': a['status'].get('bytes_copied', 0)
+            }
+            for url, a in self.agents.items()
+        }
+
+    def merge(self):
+        """Merge the finished shard manifests into the run manifest.
+
+        Failed shards leave theirs in place, so the run reads as
+        incomplete.
+        """
+        status = 'failed' if self.progress['shards_failed'] else 'done'
+        manifest = RunManifest(
+            self.destination, self.run_id, catalog=self.catalog,
+            source_dirs=self.source_dirs, mode='incremental',
+            agents=list(self.agents), shards=len(self.shards)
+        )
+        for shard_id in sorted(self.finished):
+            path = self.finished[shard_id]['manifest']
+            for entry in read_manifest(path):
+                if entry.get('action'):
+                    manifest.record(**entry)
+        manifest.close(
+            status=status,
+            copied_files=self.progress['copied_files'],
+            failed_files=self.progress['failed_files']
+        )
+        if status == 'done':
+            shutil.rmtree(
+                shard_dir(self.destination, self.run_id), ignore_errors=True
+            )
+            try:
+                os.rmdir(os.path.join(self.destination, SHARD_DIR))
+            except OSError:
+                pass  # Another run's shards are still there
+        return manifest.path
+
+
+# --------------------------------------------------
+# Command line
+#
+#   BACKUP_AGENT_TOKEN=... python backup_cluster.py agent --port 8701
+#   BACKUP_AGENT_TOKEN=... python backup_cluster.py run /mnt/usb/backup \
+#       ~/Documents ~/Photos \
+#       --agent http://127.0.0.1:8701 --agent http://127.0.0.1:8702
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a backup agent, or a backup sharded over agents'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    agent_args = sub.add_parser('agent')
+    agent_args.add_argument('--host', default='127.0.0.1')
+    agent_args.add_argument('--port', type=int, default=AGENT_PORT)
+    agent_args.add_argument('--workers', type=int, default=AGENT_WORKERS)
+    run_args = sub.add_parser('run')
+    run_args.add_argument('destination')
+    run_args.add_argument('sources', nargs='+')
+    run_args.add_argument('--agent', action='append', required=True)
+    run_args.add_argument('--tier', choices=COPY_TIERS, default='auto')
+    run_args.add_argument('--io-mode', choices=IO_MODES, default='normal')
+    for sub_args in (agent_args, run_args):
+        # Visible in the process list: prefer BACKUP_AGENT_TOKEN
+        sub_args.add_argument('--token')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s'
+    )
+    if not agent_token(args.token):
+        print(f"A shared token is needed: --token or {TOKEN_ENV}",
+              file=sys.stderr)
+        return 1
+    if args.command == 'agent':
+        serve_agent(args.host, args.port, args.workers, args.token)
+        return 0
+
+    coordinator = Coordinator(
+        args.agent, args.sources, args.destination,
+        options={'copy_tier': args.tier, 'io_mode': args.io_mode},
+        token=args.token
+    )
+    started = time.monotonic()
+    summary = coordinator.run()
+    print(
+        f"Run {coordinator.run_id}: {summary['copied_files']} copied, "
+        f"{summary['skipped_files']} unchanged, {summary['failed_files']} "
+        f"failed, {summary['bytes_copied']} bytes | "
+        f"{summary['shards_done']}/{summary['shards_total']} shards, "
+        f"{summary['reassigned']} reassigned | "
+        f"{time.monotonic() - started:.1f} s"
+    )
+    return 1 if summary['failed_files'] or summary['shards_failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
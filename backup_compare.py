@@ -0,0 +1,179 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+# --------------------------------------------------
+# Content comparison for metadata-only updates.
+#
+# When a file changed only its timestamp (touch, chmod, photo
+# tools rewriting dates), the size still matches and the data
+# is usually identical. Proving that is far cheaper than
+# recopying: either compare a sample of blocks, or compare
+# full hashes that are cached across runs.
+# --------------------------------------------------
+
+COMPARE_MODES = ('off', 'sample', 'hash')
+
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_SIZE = 64 * 1024
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Cache writes between commits
+COMMIT_EVERY = 500
+
+
+def is_metadata_candidate(src_st, dest_st):
+    """Same size but different mtime: the data may be unchanged."""
+    return (
+        src_st.st_size == dest_st.st_size and
+        src_st.st_mtime_ns != dest_st.st_mtime_ns
+    )
+
+
+def sample_offsets(size):
+    """Evenly spaced block offsets, always including head and tail."""
+    if size <= SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE:
+        return list(range(0, size, SAMPLE_BLOCK_SIZE))
+
+    last = size - SAMPLE_BLOCK_SIZE
+    step = last / (SAMPLE_BLOCKS - 1)
+    return [int(i * step) for i in range(SAMPLE_BLOCKS)]
+
+
+def sample_equal(src_file, dest_file, size):
+    """Compare SAMPLE_BLOCKS blocks; small files are compared fully."""
+    with open(src_file, 'rb') as a, open(dest_file, 'rb') as b:
+        for offset in sample_offsets(size):
+            a.seek(offset)
+            b.seek(offset)
+            if a.read(SAMPLE_BLOCK_SIZE) != b.read(SAMPLE_BLOCK_SIZE):
+                return False
+    return True
+
+
+def data_digest(data):
+    """Digest of bytes in memory, as file_digest() gives for a file."""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=20)
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def copied_digest(src_file, st):
+    """Digest of a file just copied; st is its stat taken before the
+    copy. The data is read back while it is still in the page cache.
+    None if the file changed meanwhile: the digest would not describe
+    the data that was copied."""
+    now = os.stat(src_file)
+    if (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+        return None
+    return file_digest(src_file)
+
+
+class HashCache:
+    """SQLite cache of file digests keyed by path, size and mtime.
+
+    Shared by all worker threads; an entry is only reused while
+    the file's size and mtime_ns are unchanged.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            ' path TEXT PRIMARY KEY, size INTEGER,'
+            ' mtime_ns INTEGER, digest TEXT)'
+        )
+        self.db.commit()
+        self.pending = 0
+
+    def get(self, path, st):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, digest FROM hashes WHERE path = ?',
+                (path,)
+            ).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        return None
+
+    def put(self, path, st, digest):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, digest)
+            )
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.db.commit()
+                self.pending = 0
+
+    def digest(self, path, st=None):
+        st = st or os.stat(path)
+        digest = self.get(path, st)
+        if digest is None:
+            digest = file_digest(path)
+            self.put(path, st, digest)
+        return digest
+
+    def record_copy(self, src_file, st, dest_files):
+        """copied_digest(), stored for the source and for its copies,
+        so the next hash compare of these files reads nothing.
+
+        The copies are keyed by the source's size and mtime, which they
+        have once their metadata is applied.
+        """
+        digest = self.get(src_file, st) or copied_digest(src_file, st)
+        if digest is None:
+            return None
+        self.put(src_file, st, digest)
+        for dest_file in dest_files:
+            self.put(dest_file, st, digest)
+        return digest
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def content_equal(src_file, dest_file, mode, cache=None):
+    """Return True when the data of both files is the same."""
+    src_st = os.stat(src_file)
+    dest_st = os.stat(dest_file)
+    if src_st.st_size != dest_st.st_size:
+        return False
+
+    if mode == 'sample':
+        return sample_equal(src_file, dest_file, src_st.st_size)
+
+    if mode == 'hash':
+        if cache is None:
+            return file_digest(src_file) == file_digest(dest_file)
+        return cache.digest(src_file, src_st) == cache.digest(dest_file, dest_st)
+
+    return False
+
+
+def update_metadata(src_file, dest_file, cache=None):
+    """Bring timestamps, mode and xattrs of dest in line with src."""
+    shutil.copystat(src_file, dest_file)
+    if cache is not None:
+        # The data is unchanged, so the digest survives the new mtime
+        digest = cache.get(src_file, os.stat(src_file))
+        if digest:
+            cache.put(dest_file, os.stat(dest_file), digest)
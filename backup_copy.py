@@ -0,0 +1,612 @@
+import os
+import time
+import errno
+import queue
+import shutil
+import stat
+import threading
+
+from backup_control import gate
+from backup_pagecache import (
+    DIRECT_MIN_SIZE, Writeback, advise_sequential, copy_direct, drop_cache
+)
+
+# --------------------------------------------------
+# File copy engine shared by the backup apps.
+#
+# copy_file() returns (size, transferred): the logical size of
+# the file and the number of data bytes actually read/written.
+# They differ for sparse files, whose holes are skipped.
+#
+# Copy tiers, fastest first:
+#   kernel   - copy_file_range(): in-kernel, reflink/server-side
+#              copy where the filesystem supports it
+#   sendfile - sendfile(): in-kernel, but one thread alternates
+#              reads and writes
+#   pipeline - reader and writer threads over a pool of reusable
+#              buffers, overlapping the source and destination
+#              disks for cross-device copies
+#   chunked  - plain user-space loop
+#   sparse   - data extents only (SEEK_DATA/SEEK_HOLE)
+#   fanout   - one read, several destinations
+#   direct   - O_DIRECT, for very large files in 'direct' io_mode
+#
+# io_mode (see backup_pagecache) keeps a copy from flushing the
+# page cache: 'nocache' and 'direct' use the user-space tiers,
+# which advise, flush and drop pages as they go.
+#
+# Data is written to <dest>.backup-part and renamed over dest
+# once complete, so an interrupted or cancelled copy never
+# leaves a truncated file under the real name. With a job
+# control (backup_control) every tier passes a checkpoint at
+# least every KERNEL_CHUNK_SIZE bytes.
+# --------------------------------------------------
+
+# Chunk size for the user-space copy loop. Kept moderate so a
+# throttled job reacts quickly to live limit changes.
+CHUNK_SIZE = 1024 * 1024
+
+# Chunks a slow destination may lag behind the reader in a
+# fan-out copy before the reader waits for it
+FANOUT_BUFFER_CHUNKS = 16
+
+# Pipeline tier: buffers in flight between reader and writer
+PIPELINE_BUFFERS = 4
+PIPELINE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Below this size the thread hand-off costs more than it saves
+PIPELINE_MIN_SIZE = 8 * 1024 * 1024
+
+# Step of the in-kernel tiers between two checkpoints
+KERNEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Name of a copy in progress: dest + PART_SUFFIX
+PART_SUFFIX = '.backup-part'
+
+COPY_TIERS = ('auto', 'kernel', 'sendfile', 'pipeline', 'chunked', 'direct')
+
+# copy_file_range() errors that mean "not here, use another tier"
+_KERNEL_FALLBACK = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.EBADF, errno.ETXTBSY
+}
+
+SPARSE_SUPPORTED = hasattr(os, 'SEEK_DATA') and hasattr(os, 'SEEK_HOLE')
+
+
+def is_sparse(st):
+    """True when fewer blocks are allocated than the size needs."""
+    blocks = getattr(st, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < st.st_size
+
+
+def data_extents(fd, size):
+    """Yield (offset, length) of the allocated ranges of fd."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole remains up to EOF
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def _copy_range(fsrc, fdst, length, buf, throttle, writeback=None):
+    """Copy length bytes (None = up to EOF) from the current offsets."""
+    view = memoryview(buf)
+    copied = 0
+    while length is None or copied < length:
+        want = len(buf) if length is None else min(len(buf), length - copied)
+        n = fsrc.readinto(view[:want])
+        if not n:
+            break
+        if throttle:
+            throttle.read(n)
+            throttle.write(n)
+        fdst.write(view[:n])
+        if writeback:
+            writeback.wrote(n)
+        copied += n
+    return copied
+
+
+def _copy_sparse(src_file, dest_file, size, throttle, io_mode='normal'):
+    """Copy only the data extents; holes stay unallocated on dest."""
+    transferred = 0
+    buf = bytearray(CHUNK_SIZE)
+
+    with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+        for start, length in data_extents(fsrc.fileno(), size):
+            fsrc.seek(start)
+            fdst.seek(start)
+            transferred += _copy_range(fsrc, fdst, length, buf, throttle)
+        # Seeking past the last extent leaves the tail unwritten;
+        # truncate makes it a trailing hole of the right size
+        fdst.truncate(size)
+
+        if io_mode != 'normal':
+            Writeback(fdst).finish()
+            drop_cache(fsrc)
+
+    return transferred
+
+
+def _copy_chunked(src_file, dest_file, throttle, io_mode='normal'):
+    buf = bytearray(CHUNK_SIZE)
+    with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+        if io_mode == 'normal':
+            return _copy_range(fsrc, fdst, None, buf, throttle)
+
+        advise_sequential(fsrc)
+        writeback = Writeback(fdst)
+        copied = _copy_range(fsrc, fdst, None, buf, throttle, writeback)
+        writeback.finish()
+        drop_cache(fsrc)
+        return copied
+
+
+def _copy_kernel(src_file, dest_file, size, control=None):
+    """copy_file_range() loop; raises OSError to fall back."""
+    with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        copied = 0
+        while copied < size:
+            if control:
+                control.checkpoint()
+            n = os.copy_file_range(
+                infd, outfd, min(size - copied, KERNEL_CHUNK_SIZE)
+            )
+            if not n:
+                break
+            copied += n
+        return copied
+
+
+def _copy_sendfile(src_file, dest_file, size, control=None):
+    if control is None:
+        shutil.copyfile(src_file, dest_file)
+        return size
+
+    with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        copied = 0
+        while copied < size:
+            control.checkpoint()
+            n = os.sendfile(
+                outfd, infd, copied, min(size - copied, KERNEL_CHUNK_SIZE)
+            )
+            if not n:
+                break
+            copied += n
+        return copied
+
+
+# Buffers are allocated once per worker thread and reused for
+# every file that thread copies through the pipeline
+_pipeline_buffers = threading.local()
+
+
+def _buffer_pool():
+    pool = getattr(_pipeline_buffers, 'pool', None)
+    if pool is None:
+        pool = [bytearray(PIPELINE_CHUNK_SIZE) for _ in range(PIPELINE_BUFFERS)]
+        _pipeline_buffers.pool = pool
+    return pool
+
+
+def _copy_pipeline(src_file, dest_file, throttle, io_mode='normal'):
+    """Double-buffered copy: this thread reads, a helper thread writes.
+
+    Filled buffers travel over a bounded queue and come back on a
+    free queue, so the source disk is read while the destination
+    is written and no chunk is ever allocated.
+    """
+    free = queue.Queue()
+    for buf in _buffer_pool():
+        free.put(buf)
+    filled = queue.Queue(maxsize=PIPELINE_BUFFERS)
+    state = {'written': 0, 'error': None}
+
+    def writer(fdst, writeback):
+        while True:
+            item = filled.get()
+            if item is None:
+                return
+            buf, n = item
+            if state['error'] is None:
+                try:
+                    if throttle:
+                        throttle.write(n)
+                    fdst.write(memoryview(buf)[:n])
+                    if writeback:
+                        writeback.wrote(n)
+                    state['written'] += n
+                except Exception as e:
+                    # Keep recycling buffers so the reader notices and stops
+                    state['error'] = e
+            free.put(buf)
+
+    with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+        writeback = None
+        if io_mode != 'normal':
+            advise_sequential(fsrc)
+            writeback = Writeback(fdst)
+
+        thread = threading.Thread(
+            target=writer, args=(fdst, writeback), daemon=True
+        )
+        thread.start()
+        try:
+            while state['error'] is None:
+                buf = free.get()
+                n = fsrc.readinto(buf)
+                if not n:
+                    free.put(buf)
+                    break
+                if throttle:
+                    throttle.read(n)
+                filled.put((buf, n))
+        finally:
+            filled.put(None)
+            thread.join()
+
+        if writeback and state['error'] is None:
+            writeback.finish()
+            drop_cache(fsrc)
+
+    if state['error'] is not None:
+        raise state['error']
+    return state['written']
+
+
+class TierStats:
+    """Files, bytes and time spent per copy tier, for reporting."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tiers = {}
+
+    def add(self, tier, nbytes, seconds):
+        with self.lock:
+            t = self.tiers.setdefault(
+                tier, {'files': 0, 'bytes': 0, 'seconds': 0.0}
+            )
+            t['files'] += 1
+            t['bytes'] += nbytes
+            t['seconds'] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                tier: {
+                    'files': t['files'],
+                    'bytes': t['bytes'],
+                    'mb_per_sec': round(
+                        t['bytes'] / t['seconds'] / (1024 * 1024), 2
+                    ) if t['seconds'] else None
+                }
+                for tier, t in self.tiers.items()
+            }
+
+
+def choose_tier(src_st, dest_file, throttled, tier='auto', io_mode='normal'):
+    """Pick the copy tier for one (non-sparse) file."""
+    large = src_st.st_size >= PIPELINE_MIN_SIZE
+
+    if io_mode == 'direct' and src_st.st_size >= DIRECT_MIN_SIZE:
+        return 'direct'
+    if (io_mode != 'normal' or throttled) and \
+            tier in ('auto', 'kernel', 'sendfile'):
+        # In-kernel copies give no chance to flush and drop pages,
+        # nor to draw from the throttle's token buckets
+        return 'pipeline' if large else 'chunked'
+    if tier != 'auto':
+        return tier
+
+    same_device = (
+        src_st.st_dev == os.stat(os.path.dirname(dest_file) or '.').st_dev
+    )
+
+    if same_device and hasattr(os, 'copy_file_range'):
+        return 'kernel'
+    if not same_device and large:
+        return 'pipeline'
+    return 'sendfile'
+
+
+def _copy_data(src_file, dest_file, st, throttle, tier, io_mode='normal',
+               control=None):
+    """Run one tier, falling back when the kernel refuses. -> (tier, bytes)"""
+    hook = gate(throttle, control)
+    if tier == 'direct':
+        try:
+            return tier, copy_direct(src_file, dest_file, st.st_size, hook)
+        except OSError as e:
+            # e.g. tmpfs: no O_DIRECT; keep the cache-friendly path
+            if e.errno != errno.EINVAL:
+                raise
+            tier = 'pipeline'
+
+    if tier == 'kernel':
+        try:
+            return tier, _copy_kernel(
+                src_file, dest_file, st.st_size, control
+            )
+        except OSError as e:
+            if e.errno not in _KERNEL_FALLBACK:
+                raise
+            tier = 'pipeline' if st.st_size >= PIPELINE_MIN_SIZE else 'sendfile'
+
+    if tier == 'pipeline':
+        return tier, _copy_pipeline(src_file, dest_file, hook, io_mode)
+    if tier == 'chunked' or throttle is not None or io_mode != 'normal':
+        return 'chunked', _copy_chunked(src_file, dest_file, hook, io_mode)
+
+    try:
+        return 'sendfile', _copy_sendfile(
+            src_file, dest_file, st.st_size, control
+        )
+    except OSError as e:
+        if control is None or e.errno not in _KERNEL_FALLBACK:
+            raise
+        return 'chunked', _copy_chunked(src_file, dest_file, hook, io_mode)
+
+
+def partial_path(dest_file):
+    return dest_file + PART_SUFFIX
+
+
+def discard_partial(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def copy_file(src_file, dest_file, throttle=None, tier='auto', stats=None,
+              io_mode='normal', metadata=None, control=None):
+    """Copy data and metadata like shutil.copy2.
+
+    Picks a copy tier (see the top of this module), honours the
+    throttle and io_mode and skips the holes of sparse files. Per-tier
+    throughput is added to stats (a TierStats) when given. With a
+    metadata queue (backup_metadata.MetadataQueue) the metadata is
+    queued for later instead of applied here. With a control
+    (backup_control.JobControl) the copy pauses with the job and
+    raises Cancelled mid-file, leaving dest as it was.
+    Returns (size, transferred).
+    """
+    part = partial_path(dest_file)
+    try:
+        result = _copy_file(
+            src_file, part, throttle, tier, stats, io_mode, control
+        )
+        if metadata is None:
+            shutil.copystat(src_file, part)
+        os.replace(part, dest_file)
+    except BaseException:
+        discard_partial(part)
+        raise
+
+    st, transferred = result
+    if metadata is not None:
+        metadata.add_file(src_file, dest_file, st)
+    return st.st_size, transferred
+
+
+def check_regular(src_file, st):
+    """Refuse anything but a regular file: opening a FIFO would block
+    the copy for good (shutil.copyfile refuses them too)."""
+    if not stat.S_ISREG(st.st_mode):
+        raise shutil.SpecialFileError(f"Not a regular file: {src_file}")
+
+
+def _copy_file(src_file, dest_file, throttle, tier, stats, io_mode, control):
+    """Data of copy_file(). -> (source stat, transferred)"""
+    st = os.stat(src_file)
+    check_regular(src_file, st)
+    throttled = throttle is not None and throttle.active()
+
+    if throttled:
+        throttle.open_read()
+        throttle.open_write()
+    else:
+        throttle = None
+
+    started = time.monotonic()
+    transferred = None
+    used = 'sparse'
+    if SPARSE_SUPPORTED and is_sparse(st):
+        try:
+            transferred = _copy_sparse(
+                src_file, dest_file, st.st_size, gate(throttle, control),
+                io_mode
+            )
+        except OSError as e:
+            # Filesystem without SEEK_DATA support: copy it whole
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if transferred is None:
+        used, transferred = _copy_data(
+            src_file, dest_file, st, throttle,
+            choose_tier(st, dest_file, throttled, tier, io_mode), io_mode,
+            control
+        )
+
+    if stats is not None:
+        stats.add(used, transferred, time.monotonic() - started)
+    return st, transferred
+
+
+# --------------------------------------------------
+# Fan-out: read once, write to several destinations
+# --------------------------------------------------
+def _read_chunks(src_file, st, throttle, io_mode='normal'):
+    """Yield (offset, bytes) covering the data of src_file."""
+    with open(src_file, 'rb') as fsrc:
+        if io_mode != 'normal':
+            advise_sequential(fsrc)
+
+        extents = None
+        if SPARSE_SUPPORTED and is_sparse(st):
+            try:
+                extents = list(data_extents(fsrc.fileno(), st.st_size))
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        if extents is None:
+            extents = [(0, None)]
+
+        for start, length in extents:
+            fsrc.seek(start)
+            offset = start
+            while length is None or offset < start + length:
+                want = CHUNK_SIZE
+                if length is not None:
+                    want = min(want, start + length - offset)
+                chunk = fsrc.read(want)
+                if not chunk:
+                    break
+                if throttle:
+                    throttle.read(len(chunk))
+                yield offset, chunk
+                offset += len(chunk)
+
+        if io_mode != 'normal':
+            drop_cache(fsrc)
+
+
+class _FanoutWriter(threading.Thread):
+    """Writes the chunks of one destination from a bounded queue."""
+
+    def __init__(self, dest_file, size, throttle, io_mode='normal'):
+        super().__init__(daemon=True)
+        self.dest_file = dest_file
+        self.size = size
+        self.throttle = throttle
+        self.io_mode = io_mode
+        self.chunks = queue.Queue(maxsize=FANOUT_BUFFER_CHUNKS)
+        self.transferred = 0
+        self.error = None
+
+    def run(self):
+        fdst = None
+        sentinel_seen = False
+        try:
+            fdst = open(self.dest_file, 'wb')
+            writeback = Writeback(fdst) if self.io_mode != 'normal' else None
+            while True:
+                item = self.chunks.get()
+                if item is None:
+                    sentinel_seen = True
+                    break
+                offset, chunk = item
+                if fdst.tell() != offset:
+                    fdst.seek(offset)
+                if self.throttle:
+                    self.throttle.write(len(chunk))
+                fdst.write(chunk)
+                if writeback:
+                    writeback.wrote(len(chunk))
+                self.transferred += len(chunk)
+            fdst.truncate(self.size)
+            if writeback:
+                writeback.finish()
+        except Exception as e:
+            self.error = e
+            # Keep draining so the reader is never blocked by a
+            # destination that has already failed; once the end was
+            # read (truncate or writeback failed), nothing more comes
+            while not sentinel_seen:
+                sentinel_seen = self.chunks.get() is None
+        finally:
+            if fdst is not None:
+                fdst.close()
+
+    def put(self, item):
+        self.chunks.put(item)
+
+
+def copy_file_multi(src_file, dest_files, throttle=None, tier='auto',
+                    stats=None, io_mode='normal', metadata=None,
+                    control=None):
+    """Copy src_file to every path in dest_files, reading it only once.
+
+    Each destination has its own writer thread and bounded queue:
+    a slow target only holds the reader back once it is
+    FANOUT_BUFFER_CHUNKS behind, and a failing target never does.
+    Returns {dest_file: (size, transferred) or the exception raised}.
+    """
+    if len(dest_files) == 1:
+        try:
+            return {
+                dest_files[0]: copy_file(
+                    src_file, dest_files[0], throttle, tier, stats, io_mode,
+                    metadata, control
+                )
+            }
+        except Exception as e:
+            return {dest_files[0]: e}
+
+    try:
+        st = os.stat(src_file)
+        check_regular(src_file, st)
+    except OSError as e:
+        return {dest_file: e for dest_file in dest_files}
+    if throttle is not None and throttle.active():
+        throttle.open_read()
+        for _ in dest_files:
+            throttle.open_write()
+    else:
+        throttle = None
+
+    started = time.monotonic()
+    writers = [
+        _FanoutWriter(partial_path(d), st.st_size, throttle, io_mode)
+        for d in dest_files
+    ]
+    for writer in writers:
+        writer.start()
+
+    read_error = None
+    try:
+        for item in _read_chunks(
+                src_file, st, gate(throttle, control), io_mode):
+            for writer in writers:
+                if writer.error is None:
+                    writer.put(item)
+    except Exception as e:
+        read_error = e
+    finally:
+        for writer in writers:
+            writer.put(None)
+        for writer in writers:
+            writer.join()
+
+    if stats is not None:
+        stats.add(
+            'fanout', sum(w.transferred for w in writers),
+            time.monotonic() - started
+        )
+
+    results = {}
+    for dest_file, writer in zip(dest_files, writers):
+        error = read_error or writer.error
+        if error is None:
+            try:
+                if metadata is None:
+                    shutil.copystat(src_file, writer.dest_file)
+                os.replace(writer.dest_file, dest_file)
+                if metadata is not None:
+                    metadata.add_file(src_file, dest_file, st)
+            except Exception as e:
+                error = e
+        if error is not None:
+            discard_partial(writer.dest_file)
+        results[dest_file] = error or (st.st_size, writer.transferred)
+    return results
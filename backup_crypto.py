@@ -0,0 +1,500 @@
+import os
+import sys
+import hmac
+import json
+import base64
+import struct
+import getpass
+import hashlib
+import argparse
+import logging
+import threading
+
+from backup_backends import Backend
+from backup_control import gate
+from backup_copy import copy_file, discard_partial, partial_path
+from backup_pathindex import PathIndex
+from backup_tuner import device_label
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, AESSIV
+except ImportError:
+    AESGCM = None
+
+# --------------------------------------------------
+# Client-side encryption of a local destination.
+#
+# File contents are AES-256-GCM encrypted in fixed-size chunks
+# while they are copied, so nothing is read or written twice and
+# no plaintext ever reaches the destination. Each file is:
+#
+#   MAGIC | 16-byte random salt | chunk | chunk | ... | last
+#
+# and is sealed with a key of its own, derived from the data key
+# and its salt: a random nonce part would leave too few random bits
+# per file under one long-lived key. chunk n is sealed with nonce
+# = 8 zero bytes + n (32 bits, top bit set on the last chunk), so
+# chunks cannot be reordered, dropped or cut off unnoticed. The
+# last chunk is always short (possibly empty), so the ciphertext
+# size follows from the plaintext size and the incremental check
+# needs no decryption. Files of the first format (MAGIC_V1: an
+# 8-byte random nonce prefix under the data key itself) are still
+# decrypted.
+#
+# Every path component is encrypted deterministically with
+# AES-SIV and stored as lower-case base32 (safe on FAT/exFAT and
+# NTFS), so a directory keeps one name across runs. base32 of the
+# sealed name is 8/5 as long plus 26 characters, so names of more
+# than about 140 bytes would pass the file system's name limit:
+# those are stored under a hash of their encrypted name, and the
+# long-name manifest (.backup/long-names.json) maps the hash back.
+# It only holds encrypted names.
+#
+# Keys come from a passphrase (scrypt) or a key file, salted per
+# destination; the salt and parameters are kept in plain text in
+# <destination>/.backup/crypto.json.
+#
+# Run manifests are written to .backup/staging of the destination,
+# then stored encrypted like any file and the plain copy removed.
+# The restore of the web app and the GUIs reads plain manifests, so
+# encrypted destinations are restored with the command line below.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+CRYPTO_CONFIG = os.path.join('.backup', 'crypto.json')
+
+# Where run manifests are staged, under the destination
+CRYPT_STATE_DIR = os.path.join('.backup', 'staging')
+
+# Hashed names of long encrypted names -> the encrypted names
+LONG_NAMES = os.path.join('.backup', 'long-names.json')
+LONG_NAME_SUFFIX = '.long'
+
+# Used where the file system does not tell (no pathconf)
+NAME_MAX = 255
+
+MAGIC = b'BKE\x02'
+FILE_SALT_SIZE = 16
+HEADER_SIZE = len(MAGIC) + FILE_SALT_SIZE
+# Nonce of chunk 0 of a file with its own key
+FILE_NONCE_PREFIX = bytes(8)
+
+MAGIC_V1 = b'BKE\x01'
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+LAST_CHUNK = 0x80000000
+
+# Plaintext bytes per chunk
+CHUNK_SIZE = 1024 * 1024
+
+# scrypt cost (about 0.1 s and 32 MB per derivation)
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def is_encrypted(destination):
+    return os.path.exists(os.path.join(destination, CRYPTO_CONFIG))
+
+
+def check_plain(destination):
+    """Raise ValueError for an encrypted destination, which only the
+    command line below can restore."""
+    if is_encrypted(destination):
+        raise ValueError(
+            f"Encrypted destination: restore it with "
+            f"python backup_crypto.py restore {destination} <target>"
+        )
+
+
+def _name_max(path):
+    try:
+        return os.pathconf(path, 'PC_NAME_MAX')
+    except (AttributeError, OSError, ValueError):
+        return NAME_MAX
+
+
+def _subkey(master, label, size=32):
+    out = b''
+    counter = 0
+    while len(out) < size:
+        counter += 1
+        out += hmac.new(
+            master, label + bytes([counter]), hashlib.sha256
+        ).digest()
+    return out[:size]
+
+
+def _master_key(config, passphrase=None, keyfile=None):
+    salt = base64.b64decode(config['salt'])
+    if config['kdf'] == 'keyfile':
+        if not keyfile:
+            raise ValueError("This destination is encrypted with a key file")
+        with open(keyfile, 'rb') as f:
+            return hmac.new(salt, f.read(), hashlib.sha256).digest()
+    if not passphrase:
+        raise ValueError("This destination is encrypted with a passphrase")
+    return hashlib.scrypt(
+        passphrase.encode(), salt=salt, n=config['n'], r=config['r'],
+        p=config['p'], maxmem=128 * config['n'] * config['r'] * 2,
+        dklen=32
+    )
+
+
+class CryptoKeys:
+    """Keys of one encrypted destination, from its crypto.json.
+
+    The first use of a destination creates the file, with a new salt
+    and a check value that later detects a wrong passphrase or key
+    file. Safe to share between threads.
+    """
+
+    def __init__(self, destination, passphrase=None, keyfile=None):
+        if AESGCM is None:
+            raise RuntimeError(
+                "Encryption needs the cryptography package "
+                "(pip install cryptography)"
+            )
+        if not passphrase and not keyfile:
+            raise ValueError("Encryption needs a passphrase or a key file")
+
+        path = os.path.join(destination, CRYPTO_CONFIG)
+        try:
+            with open(path) as f:
+                config = json.load(f)
+            created = False
+        except FileNotFoundError:
+            config = {
+                'version': 1, 'cipher': 'aes-256-gcm', 'names': 'aes-siv',
+                'chunk_size': CHUNK_SIZE,
+                'kdf': 'keyfile' if keyfile else 'scrypt',
+                'salt': base64.b64encode(os.urandom(16)).decode(),
+                'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P
+            }
+            created = True
+
+        master = _master_key(config, passphrase, keyfile)
+        check = _subkey(master, b'check').hex()
+        if created:
+            config['check'] = check
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = partial_path(path)
+            with open(tmp, 'w') as f:
+                json.dump(config, f, indent=2)
+            os.replace(tmp, path)
+        elif not hmac.compare_digest(check, config['check']):
+            raise ValueError(f"Wrong passphrase or key file for {destination}")
+
+        self.chunk_size = config['chunk_size']
+        self.data_key = _subkey(master, b'data')
+        # Files of the first format are sealed with the data key
+        self.aead = AESGCM(self.data_key)
+        self.siv = AESSIV(_subkey(master, b'names', 64))
+        # Encrypted directory paths, which repeat for every file
+        self.dirs = {'': ''}
+
+        self.lock = threading.Lock()
+        self.name_max = _name_max(destination)
+        self.long_names_path = os.path.join(destination, LONG_NAMES)
+        try:
+            with open(self.long_names_path) as f:
+                self.long_names = json.load(f)
+        except FileNotFoundError:
+            self.long_names = {}
+
+    # ---- names ----
+    def encrypt_name(self, name):
+        sealed = self.siv.encrypt(os.fsencode(name), None)
+        name = base64.b32encode(sealed).decode().rstrip('=').lower()
+        if len(name) > self.name_max:
+            return self._long_name(name)
+        return name
+
+    def _long_name(self, name):
+        """Hashed stand-in for an encrypted name past the name limit,
+        recorded in the long-name manifest before it is used."""
+        short = hashlib.sha256(name.encode()).hexdigest() + LONG_NAME_SUFFIX
+        with self.lock:
+            if self.long_names.get(short) != name:
+                self.long_names[short] = name
+                tmp = partial_path(self.long_names_path)
+                with open(tmp, 'w') as f:
+                    json.dump(self.long_names, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.long_names_path)
+        return short
+
+    def decrypt_name(self, name):
+        """Plain name, or None for a name this key did not encrypt."""
+        name = self.long_names.get(name, name)
+        try:
+            data = base64.b32decode(
+                name.upper() + '=' * (-len(name) % 8)
+            )
+            return os.fsdecode(self.siv.decrypt(data, None))
+        except (ValueError, InvalidTag):
+            return None
+
+    def encrypt_path(self, rel_path):
+        rel_dir, name = os.path.split(rel_path)
+        enc_dir = self.dirs.get(rel_dir)
+        if enc_dir is None:
+            enc_dir = os.path.join(*(
+                self.encrypt_name(part) for part in rel_dir.split(os.sep)
+            ))
+            self.dirs[rel_dir] = enc_dir
+        return os.path.join(enc_dir, self.encrypt_name(name))
+
+    # ---- sizes ----
+    def plain_size(self, size):
+        """Plaintext size for a ciphertext size; -1 if none matches."""
+        full, rest = divmod(size - HEADER_SIZE, self.chunk_size + TAG_SIZE)
+        if size < HEADER_SIZE + TAG_SIZE or rest < TAG_SIZE:
+            return -1
+        return full * self.chunk_size + rest - TAG_SIZE
+
+    # ---- contents ----
+    def file_aead(self, salt):
+        """Cipher of the file with this salt."""
+        return AESGCM(_subkey(self.data_key, b'file' + salt))
+
+    def encrypt_file(self, src_file, dest_file, hook=None):
+        """Encrypt src_file to dest_file, with its mode and times.
+
+        Written as dest_file.backup-part and renamed once complete.
+        Returns (plaintext size, bytes written).
+        """
+        tmp = partial_path(dest_file)
+        salt = os.urandom(FILE_SALT_SIZE)
+        header = MAGIC + salt
+        aead = self.file_aead(salt)
+        size = 0
+        try:
+            with open(src_file, 'rb') as src, open(tmp, 'wb') as out:
+                st = os.fstat(src.fileno())
+                out.write(header)
+                written = len(header)
+                n = 0
+                while True:
+                    data = src.read(self.chunk_size)
+                    if hook:
+                        hook.read(len(data))
+                    last = len(data) < self.chunk_size
+                    nonce = FILE_NONCE_PREFIX + struct.pack(
+                        '>I', n | LAST_CHUNK if last else n
+                    )
+                    sealed = aead.encrypt(nonce, data, header)
+                    if hook:
+                        hook.write(len(sealed))
+                    out.write(sealed)
+                    size += len(data)
+                    written += len(sealed)
+                    n += 1
+                    if last:
+                        break
+            os.chmod(tmp, st.st_mode & 0o7777)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp, dest_file)
+        except BaseException:
+            discard_partial(tmp)
+            raise
+        return size, written
+
+    def _read_header(self, src, src_file):
+        """(header, cipher, nonce prefix) of the encrypted file open
+        in src, read from its start."""
+        magic = src.read(len(MAGIC))
+        if magic == MAGIC:
+            salt = src.read(FILE_SALT_SIZE)
+            if len(salt) == FILE_SALT_SIZE:
+                return magic + salt, self.file_aead(salt), FILE_NONCE_PREFIX
+        elif magic == MAGIC_V1:
+            prefix = src.read(NONCE_PREFIX_SIZE)
+            if len(prefix) == NONCE_PREFIX_SIZE:
+                return magic + prefix, self.aead, prefix
+        raise ValueError(f"Not an encrypted backup file: {src_file}")
+
+    def decrypt_file(self, src_file, dest_file):
+        """Decrypt src_file to dest_file; returns the plaintext size.
+
+        Raises ValueError for a damaged, truncated or foreign file.
+        """
+        tmp = partial_path(dest_file)
+        size = 0
+        try:
+            with open(src_file, 'rb') as src, open(tmp, 'wb') as out:
+                st = os.fstat(src.fileno())
+                header, aead, prefix = self._read_header(src, src_file)
+                n = 0
+                while True:
+                    sealed = src.read(self.chunk_size + TAG_SIZE)
+                    # Only the last chunk is short
+                    last = len(sealed) < self.chunk_size + TAG_SIZE
+                    nonce = prefix + struct.pack(
+                        '>I', n | LAST_CHUNK if last else n
+                    )
+                    try:
+                        data = aead.decrypt(nonce, sealed, header)
+                    except InvalidTag:
+                        raise ValueError(
+                            f"Damaged or truncated: {src_file} (chunk {n})"
+                        ) from None
+                    out.write(data)
+                    size += len(data)
+                    n += 1
+                    if last:
+                        break
+            os.chmod(tmp, st.st_mode & 0o7777)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp, dest_file)
+        except BaseException:
+            discard_partial(tmp)
+            raise
+        return size
+
+
+class EncryptedBackend(Backend):
+    """A local directory written through CryptoKeys.
+
+    Seen from the job it is a destination like any backend: indexes
+    and rel_paths are in plain text, sizes are plaintext sizes, and
+    mtimes are those of the source files (set on every ciphertext),
+    so a scan of the destination drives the incremental check.
+    """
+
+    def __init__(self, destination, passphrase=None, keyfile=None):
+        os.makedirs(destination, exist_ok=True)
+        self.destination = destination
+        self.keys = CryptoKeys(destination, passphrase, keyfile)
+        self.label = f"crypt:{device_label(destination)}"
+        self.state_dir = os.path.join(destination, CRYPT_STATE_DIR)
+
+    def path(self, rel_path):
+        return os.path.join(
+            self.destination, self.keys.encrypt_path(rel_path)
+        )
+
+    def index(self, base):
+        root = self.path(base)
+        if not os.path.isdir(root):
+            return PathIndex()
+        index = PathIndex.scan(root)
+        return PathIndex.from_files(
+            (rel_path, self.keys.plain_size(index.sizes[i]), index.mtimes[i])
+            for i, rel_path in decrypt_paths(self.keys, index)
+        )
+
+    def upload(self, src_file, rel_path, throttle=None, control=None):
+        dest_file = self.path(rel_path)
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        return self.keys.encrypt_file(
+            src_file, dest_file, gate(throttle, control)
+        )
+
+    def copy(self, src_rel, dest_rel, mtime_ns):
+        # Same key, same ciphertext: a hard link where possible
+        src_file, dest_file = self.path(src_rel), self.path(dest_rel)
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        tmp = partial_path(dest_file)
+        try:
+            os.link(src_file, tmp)
+        except OSError:
+            copy_file(src_file, dest_file)
+            return
+        os.replace(tmp, dest_file)
+
+    def remove(self, rel_paths):
+        removed = []
+        for rel_path in rel_paths:
+            try:
+                os.remove(self.path(rel_path))
+                removed.append(rel_path)
+            except OSError as e:
+                logger.error(f"Remove failed: {rel_path} | {e}")
+        return removed
+
+    def put_file(self, path, rel_path):
+        dest_file = self.path(rel_path)
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        self.keys.encrypt_file(path, dest_file)
+        # No plain copy stays on the destination
+        if path.startswith(self.state_dir + os.sep):
+            os.remove(path)
+
+
+def decrypt_paths(keys, index):
+    """(file id, plain rel_path) for the files of an index of encrypted
+    names; names this key did not encrypt (crypto.json) are skipped."""
+    for i in range(len(index)):
+        parts = index.file_path(i).split(os.sep)
+        plain = [keys.decrypt_name(part) for part in parts]
+        if None not in plain:
+            yield i, os.path.join(*plain)
+
+
+# --------------------------------------------------
+# Command line
+#
+#   python backup_crypto.py list /mnt/usb/backup --keyfile ~/backup.key
+#   python backup_crypto.py restore /mnt/usb/backup /tmp/restore
+#   python backup_crypto.py restore /mnt/usb/backup /tmp/restore --prefix src/Documents
+#
+# Without --keyfile the passphrase is asked for.
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List or restore an encrypted destination'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    list_args = sub.add_parser('list')
+    list_args.add_argument('destination')
+    restore_args = sub.add_parser('restore')
+    restore_args.add_argument('destination')
+    restore_args.add_argument('target')
+    for sub_args in (list_args, restore_args):
+        sub_args.add_argument('--prefix', default='')
+        sub_args.add_argument('--keyfile')
+    args = parser.parse_args(argv)
+
+    if not is_encrypted(args.destination):
+        print(f"Not an encrypted destination: {args.destination}",
+              file=sys.stderr)
+        return 1
+    passphrase = None if args.keyfile else getpass.getpass('Passphrase: ')
+    try:
+        keys = CryptoKeys(args.destination, passphrase, args.keyfile)
+    except (ValueError, RuntimeError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    index = PathIndex.scan(args.destination)
+    files = [
+        (i, rel_path) for i, rel_path in decrypt_paths(keys, index)
+        if rel_path.startswith(args.prefix)
+    ]
+
+    if args.command == 'list':
+        for i, rel_path in files:
+            print(f"{keys.plain_size(index.sizes[i]):>12} {rel_path}")
+        return 0
+
+    failed = 0
+    for i, rel_path in files:
+        out_file = os.path.join(args.target, rel_path)
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        try:
+            keys.decrypt_file(
+                os.path.join(args.destination, index.file_path(i)), out_file
+            )
+        except (OSError, ValueError) as e:
+            print(f"Failed: {rel_path} | {e}", file=sys.stderr)
+            failed += 1
+    print(f"Restored {len(files) - failed} files ({failed} failed)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,359 @@
+import os
+import sys
+import stat
+import time
+import hashlib
+import tarfile
+import zipfile
+import argparse
+import logging
+from collections import namedtuple
+
+from backup_crypto import check_plain
+from backup_logging import manifest_dir
+from backup_pack import PACK_INDEX, pack_dir
+from backup_pagecache import advise_sequential
+from backup_restore import backup_entries, packed_index, resolve_backup
+
+# --------------------------------------------------
+# Download.
+#
+# Streams a subtree of a backup as a tar or zip archive, built by
+# a generator while the response is sent: nothing is written to
+# disk first and memory stays at about one chunk. The file list
+# comes from the run manifests, as for a restore, so packed files
+# are included (read from their pack).
+#
+# The tar stream is laid out the same way on every request for
+# the same backup state, so a byte range of it can be produced
+# again on its own: an interrupted download resumes with a Range
+# request. The ETag names that state (the backup's manifests and
+# pack index).
+#
+# Zip entries are written with data descriptors, since the CRC is
+# only known after the data. Already-compressed media (jpg, mkv,
+# ...) are stored as they are; the rest is deflated.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+FORMATS = ('tar', 'zip')
+
+CHUNK_SIZE = 1024 * 1024
+
+BLOCK = tarfile.BLOCKSIZE
+
+# Compressing these again only costs CPU
+STORED_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mkv', '.mp4', '.m4v', '.mov', '.avi', '.webm',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub',
+))
+
+# Zip timestamps start in 1980
+ZIP_EPOCH = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
+
+# kind: 'file', 'packed', 'symlink' or 'hardlink' (of link, a
+# name earlier in the archive); source: the file, or the pack row
+Member = namedtuple(
+    'Member', 'name kind size mode mtime uid gid link source'
+)
+
+
+class Download:
+    """A subtree of one backup as a tar or zip stream.
+
+    prefix is a rel_path in the backup (a directory or a file); the
+    archive holds it under its own name. run_id picks a snapshot, as
+    for a restore. Raises ValueError for a backup it cannot read.
+    """
+
+    def __init__(self, destination, prefix='', run_id=None):
+        self.backup = resolve_backup(destination, run_id)
+        self.prefix = prefix.strip('/')
+        self.run_id = run_id
+        check_plain(destination)
+        try:
+            self.names = sorted(os.listdir(manifest_dir(self.backup)))
+        except FileNotFoundError:
+            self.names = []
+        if not any(name.endswith('.jsonl.gz') for name in self.names):
+            raise ValueError(f"No backup manifests in {self.backup}")
+        self.prefixes = [self.prefix] if self.prefix else []
+        self.packed = packed_index(self.backup, self.prefixes)
+        # Names in the archive start at the prefix's own name
+        self.base = os.path.dirname(self.prefix)
+        self.name = os.path.basename(self.prefix) or \
+            os.path.basename(os.path.normpath(destination))
+
+    def etag(self, fmt):
+        """Names the backup state the stream is built from."""
+        digest = hashlib.sha1(
+            f"{self.backup}\0{self.prefix}\0{self.run_id}\0{fmt}".encode()
+        )
+        paths = [os.path.join(manifest_dir(self.backup), n) for n in self.names]
+        paths.append(os.path.join(pack_dir(self.backup), PACK_INDEX))
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    # ---- members ----
+    def members(self):
+        """Members in archive order: manifest order, links after
+        the first name of their inode."""
+        inodes = {}
+        for rel_path in backup_entries(
+                self.backup, self.prefixes, (), self.run_id):
+            name = os.path.relpath(rel_path, self.base) if self.base \
+                else rel_path
+            src_file = os.path.join(self.backup, rel_path)
+            row = self.packed.get(rel_path)
+            try:
+                st = os.lstat(src_file)
+            except FileNotFoundError:
+                st = None
+            except OSError as e:
+                logger.error(f"Download: skipped {rel_path} | {e}")
+                continue
+
+            if row and (st is None or st.st_mtime_ns < row[6]):
+                # The pack holds the newer copy
+                _, _, _, size, mode, _, mtime_ns = row
+                yield Member(
+                    name, 'packed', size, stat.S_IFREG | stat.S_IMODE(mode),
+                    mtime_ns // 10 ** 9, 0, 0, None, row
+                )
+            elif st is None:
+                logger.error(f"Download: skipped {rel_path} | missing")
+            elif stat.S_ISLNK(st.st_mode):
+                yield Member(
+                    name, 'symlink', 0, st.st_mode, st.st_mtime_ns // 10 ** 9,
+                    st.st_uid, st.st_gid, os.readlink(src_file), None
+                )
+            elif stat.S_ISREG(st.st_mode):
+                key = (st.st_dev, st.st_ino)
+                if st.st_nlink > 1 and key in inodes:
+                    yield Member(
+                        name, 'hardlink', 0, st.st_mode,
+                        st.st_mtime_ns // 10 ** 9, st.st_uid, st.st_gid,
+                        inodes[key], src_file
+                    )
+                    continue
+                if st.st_nlink > 1:
+                    inodes[key] = name
+                yield Member(
+                    name, 'file', st.st_size, st.st_mode,
+                    st.st_mtime_ns // 10 ** 9, st.st_uid, st.st_gid, None,
+                    src_file
+                )
+
+    def read(self, member, skip=0):
+        """member's data from byte skip on, exactly member.size bytes
+        in all: a file that shrank since it was listed ends in zeros,
+        one that grew is cut."""
+        left = member.size - skip
+        if left <= 0:
+            return
+        if member.kind == 'packed':
+            _, pack, offset = member.source[:3]
+            fd = os.open(os.path.join(pack_dir(self.backup), pack), os.O_RDONLY)
+            try:
+                offset += skip
+                while left > 0:
+                    data = os.pread(fd, min(CHUNK_SIZE, left), offset)
+                    if not data:
+                        break
+                    offset += len(data)
+                    left -= len(data)
+                    yield data
+            finally:
+                os.close(fd)
+        else:
+            with open(member.source, 'rb') as f:
+                advise_sequential(f)
+                f.seek(skip)
+                while left > 0:
+                    data = f.read(min(CHUNK_SIZE, left))
+                    if not data:
+                        break
+                    left -= len(data)
+                    yield data
+        if left > 0:
+            logger.warning(f"Download: {member.name} shrank, zero-filled")
+            while left > 0:
+                yield bytes(min(CHUNK_SIZE, left))
+                left -= CHUNK_SIZE
+
+    # ---- tar ----
+    def tar_header(self, member):
+        info = tarfile.TarInfo(member.name)
+        info.size = member.size
+        info.mode = stat.S_IMODE(member.mode)
+        info.mtime = member.mtime
+        info.uid, info.gid = member.uid, member.gid
+        if member.kind == 'symlink':
+            info.type, info.linkname = tarfile.SYMTYPE, member.link
+        elif member.kind == 'hardlink':
+            info.type, info.linkname = tarfile.LNKTYPE, member.link
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+    def tar_pieces(self):
+        """(length, chunks) for each piece of the tar stream;
+        chunks(skip) yields the piece from byte skip on."""
+        for member in self.members():
+            header = self.tar_header(member)
+            yield len(header), lambda skip, h=header: (h[skip:],)
+            if member.size:
+                padding = -member.size % BLOCK
+                yield member.size + padding, \
+                    lambda skip, m=member, p=padding: self._tar_data(m, skip, p)
+        # End of archive: two zero blocks
+        yield 2 * BLOCK, lambda skip: (bytes(2 * BLOCK - skip),)
+
+    def _tar_data(self, member, skip, padding):
+        yield from self.read(member, skip)
+        yield bytes(min(padding, member.size + padding - skip))
+
+    def tar_size(self):
+        """Length of the whole tar stream; lists and stats every member,
+        but reads no data."""
+        return sum(length for length, _ in self.tar_pieces())
+
+    def tar(self, start=0, end=None):
+        """Bytes start to end (inclusive) of the tar stream; pieces
+        before start are skipped without reading them."""
+        offset = 0
+        for length, chunks in self.tar_pieces():
+            if offset + length <= start:
+                offset += length
+                continue
+            if end is not None and offset > end:
+                return
+            pos = max(offset, start)
+            for chunk in chunks(pos - offset):
+                if end is not None and pos + len(chunk) > end + 1:
+                    chunk = chunk[:end + 1 - pos]
+                if chunk:
+                    yield chunk
+                pos += len(chunk)
+            offset += length
+
+    # ---- zip ----
+    def zip(self):
+        sink = _Sink()
+        with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+            for member in self.members():
+                info = zipfile.ZipInfo(
+                    member.name,
+                    time.localtime(max(member.mtime, ZIP_EPOCH))[:6]
+                )
+                info.external_attr = (member.mode & 0xFFFF) << 16
+                if member.kind == 'symlink':
+                    # Info-ZIP convention: the target is the data
+                    data = os.fsencode(member.link)
+                    info.file_size = len(data)
+                    chunks = (data,)
+                else:
+                    # Zip has no hard links: each name gets the data
+                    if member.kind == 'hardlink':
+                        member = member._replace(
+                            size=os.path.getsize(member.source)
+                        )
+                    info.file_size = member.size
+                    chunks = self.read(member)
+                    ext = os.path.splitext(member.name)[1].lower()
+                    if ext not in STORED_EXTENSIONS:
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as out:
+                    for chunk in chunks:
+                        out.write(chunk)
+                        yield from sink.drain()
+                yield from sink.drain()
+        yield from sink.drain()
+
+    def stream(self, fmt):
+        return self.tar() if fmt == 'tar' else self.zip()
+
+
+class _Sink:
+    """Write end of ZipFile that hands the bytes on to the generator.
+
+    It has no tell(), so ZipFile writes as to a pipe."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def parse_range(header, size):
+    """(start, end) of a 'bytes=start-end' header for a stream of size
+    bytes; None for a header it cannot serve (several ranges, bad
+    syntax); raises ValueError for a range past the end."""
+    unit, _, spec = (header or '').partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # Suffix: the last N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(f"Range not satisfiable: {header}")
+    return start, end
+
+
+# --------------------------------------------------
+# Command line
+#
+#   python backup_download.py /mnt/usb/backup src/Photos > photos.tar
+#   python backup_download.py /mnt/usb/backup src/Photos --format zip -o photos.zip
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write a subtree of a backup as a tar or zip stream'
+    )
+    parser.add_argument('destination')
+    parser.add_argument('prefix', nargs='?', default='')
+    parser.add_argument('--run-id')
+    parser.add_argument('--format', choices=FORMATS, default='tar')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args(argv)
+
+    try:
+        download = Download(args.destination, args.prefix, args.run_id)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in download.stream(args.format):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,18 @@
 import os
-import shutil
 import threading
 import time
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from tkinter import filedialog, messagebox, simpledialog, ttk
 import logging
 
+from backup_control import Cancelled, JobControl
+from backup_copy import copy_file
+from backup_crypto import check_plain
+from backup_logging import RunManifest, new_run_id, setup_logging
+from backup_restore import Restorer, resolve_backup
+
 # Configure logging for backup_gui.py
-logging.basicConfig(filename='gui.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging('gui.log')
 logger = logging.getLogger('gui')
 
 # Main backup application class
@@ -24,6 +29,7 @@ class BackupApp:
         self.progress_percent = 0
         self.is_running = False # Backup running state
         self.thread = None     # Thread for backup operation
+        self.control = JobControl() # Pause / resume / cancel switch
         self.create_widgets()
 
     def create_widgets(self):
@@ -71,6 +77,12 @@ class BackupApp:
         self.start_btn.grid(row=7, column=0, pady=10, padx=(0, 5), sticky='w')
         self.reset_btn = ttk.Button(frm, text='Reset', command=self.reset)
         self.reset_btn.grid(row=7, column=1, pady=10, padx=(0, 5), sticky='w')
+        self.pause_btn = ttk.Button(frm, text='Pause', command=self.toggle_pause)
+        self.pause_btn.grid(row=7, column=2, pady=10, padx=(0, 5), sticky='w')
+        self.cancel_btn = ttk.Button(frm, text='Cancel', command=self.cancel_backup)
+        self.cancel_btn.grid(row=7, column=3, pady=10, sticky='w')
+        self.restore_btn = ttk.Button(frm, text='Restore...', command=self.start_restore)
+        self.restore_btn.grid(row=8, column=0, pady=(0, 10), padx=(0, 5), sticky='w')
 
         # Tooltips for usability
         self.create_tooltip(add_btn, 'Add a source folder to backup (one at a time)')
@@ -78,6 +90,9 @@ class BackupApp:
         self.create_tooltip(dest_btn, 'Choose the destination folder for backup')
         self.create_tooltip(self.start_btn, 'Start the backup process')
         self.create_tooltip(self.reset_btn, 'Reset all fields and progress')
+        self.create_tooltip(self.pause_btn, 'Pause the backup, or resume it where it stopped')
+        self.create_tooltip(self.cancel_btn, 'Stop the backup; no partial files are left behind')
+        self.create_tooltip(self.restore_btn, 'Copy files from the destination back to a folder of your choice')
 
     def create_tooltip(self, widget, text):
         # Create a tooltip for a widget
@@ -124,6 +139,7 @@ class BackupApp:
         count = 0
         for d in dirs:
             for root, _, files in os.walk(d):
+                self.control.checkpoint()
                 count += len(files)
         return count
 
@@ -131,11 +147,15 @@ class BackupApp:
         # Worker thread for performing the backup
         self.is_running = True
         self.copied_files = 0
-        self.total_files = self.count_files(self.source_dirs)
-        self.start_time = time.time()
-        self.progress['maximum'] = self.total_files if self.total_files else 1
         logger.info(f'Starting backup from {self.source_dirs} to {self.destination}')
+        manifest = None
+        status = 'failed'
         try:
+            # Restore reads the backup's file list from the run manifests
+            manifest = RunManifest(self.destination, new_run_id(), source_dirs=self.source_dirs, mode='incremental')
+            self.total_files = self.count_files(self.source_dirs)
+            self.start_time = time.time()
+            self.progress['maximum'] = self.total_files if self.total_files else 1
             for src in self.source_dirs:
                 dest_path = os.path.join(self.destination, os.path.basename(src))
                 for root, dirs, files in os.walk(src):
@@ -143,20 +163,103 @@ class BackupApp:
                     dest_dir = os.path.join(dest_path, rel_path)
                     os.makedirs(dest_dir, exist_ok=True)
                     for file in files:
+                        self.control.checkpoint()
                         src_file = os.path.join(root, file)
                         dest_file = os.path.join(dest_dir, file)
+                        rel_file = os.path.normpath(os.path.join(os.path.basename(src), rel_path, file))
                         # Incremental backup: only copy if dest does not exist or src is newer
                         if not os.path.exists(dest_file) or os.path.getmtime(src_file) > os.path.getmtime(dest_file):
-                            shutil.copy2(src_file, dest_file)
+                            # Stops mid-file on cancel, leaving no partial file
+                            size, _ = copy_file(src_file, dest_file, control=self.control)
+                            manifest.record('copied', rel_file, size=size)
+                        else:
+                            manifest.record('skipped', rel_file, size=os.path.getsize(dest_file))
                         self.copied_files += 1
                         self.update_progress()
             logger.info('Backup completed successfully')
+            manifest.close(status='done', copied_files=self.copied_files)
+            manifest = None
             self.is_running = False
             self.progress_label.config(text='Backup completed!')
+        except Cancelled:
+            logger.info('Backup cancelled')
+            status = 'cancelled'
+            self.is_running = False
+            self.progress_label.config(text='Backup cancelled.')
         except Exception as e:
             logger.error(f'Backup failed: {e}')
             self.is_running = False
             self.progress_label.config(text=f'Error: {e}')
+        finally:
+            if manifest is not None:
+                manifest.close(status=status, copied_files=self.copied_files)
+
+    def restore_worker(self, backup, target, patterns):
+        # Worker thread for restoring from the destination
+        self.is_running = True
+        self.copied_files = 0
+        self.total_files = 0
+        self.start_time = time.time()
+        # Patterns with wildcards are globs, the others path prefixes
+        globs = [p for p in patterns if any(c in p for c in '*?[')]
+        prefixes = [p for p in patterns if p not in globs]
+        logger.info(f'Starting restore from {backup} to {target} ({patterns or "everything"})')
+
+        def report(action, rel_path, **fields):
+            if action == 'cancelled':
+                return
+            if action == 'failed':
+                logger.error(f"Restore failed: {rel_path} | {fields.get('error')}")
+            self.copied_files += 1
+            self.total_files = restorer.summary['total_files']
+            self.progress['maximum'] = self.total_files or 1
+            self.update_progress()
+
+        restorer = Restorer(backup, target, prefixes, globs, control=self.control, report=report)
+        try:
+            summary = restorer.run()
+            logger.info(f'Restore completed: {summary}')
+            self.progress_label.config(
+                text=f"Restored {summary['restored_files']} files in {summary['seconds']}s "
+                     f"(first file after {summary['first_file_seconds']}s, "
+                     f"{summary['failed_files']} failed)")
+        except Cancelled:
+            logger.info('Restore cancelled')
+            self.progress_label.config(text='Restore cancelled.')
+        except Exception as e:
+            logger.error(f'Restore failed: {e}')
+            self.progress_label.config(text=f'Error: {e}')
+        self.is_running = False
+
+    def start_restore(self):
+        # Restore from the destination folder into a folder of the user's choice
+        if self.is_running:
+            messagebox.showinfo('Restore', 'A job is already running.')
+            return
+        destination = self.dest_entry.get()
+        if not destination:
+            messagebox.showwarning('Input Error', 'Please select the destination to restore from.')
+            return
+        try:
+            check_plain(destination)
+        except ValueError as e:
+            messagebox.showwarning('Restore', str(e))
+            return
+        target = filedialog.askdirectory(title='Restore To Folder')
+        if not target:
+            return
+        patterns = simpledialog.askstring(
+            'Restore', 'Only these paths or patterns, separated by spaces (empty = everything):', parent=self.root)
+        if patterns is None:
+            return
+        self.progress['value'] = 0
+        self.progress_label.config(text='Starting restore...')
+        self.control = JobControl()
+        self.pause_btn.config(text='Pause')
+        self.thread = threading.Thread(
+            target=self.restore_worker, args=(resolve_backup(destination), target, patterns.split()), daemon=True)
+        self.thread.start()
+        self.root.after(200, self.check_thread)
 
     def update_progress(self):
         # Update the progress bar and label
@@ -179,10 +282,32 @@ class BackupApp:
             return
         self.progress['value'] = 0
         self.progress_label.config(text='Starting backup...')
+        self.control = JobControl()
+        self.pause_btn.config(text='Pause')
         self.thread = threading.Thread(target=self.backup_worker, daemon=True)
         self.thread.start()
         self.root.after(200, self.check_thread)
 
+    def toggle_pause(self):
+        # Pause the running backup, or resume it where it stopped
+        if not self.is_running:
+            return
+        if self.control.state == 'paused':
+            self.control.resume()
+            self.pause_btn.config(text='Pause')
+            logger.info('Backup resumed')
+        else:
+            self.control.pause()
+            self.pause_btn.config(text='Resume')
+            self.progress_label.config(text=f'Paused at {self.copied_files} of {self.total_files} files')
+            logger.info('Backup paused')
+
+    def cancel_backup(self):
+        # Stop the running backup; the current file is abandoned cleanly
+        if self.is_running:
+            self.control.cancel()
+            self.progress_label.config(text='Cancelling...')
+
     def check_thread(self):
         # Periodically check if the backup thread is still running
         if self.is_running:
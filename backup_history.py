@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import statistics
+import threading
+import logging
+from contextlib import contextmanager
+
+# --------------------------------------------------
+# Run history.
+#
+# One structured row per backup or restore run: seconds per
+# phase, files and bytes scanned and copied, MB/s, failures,
+# host and destination devices. It lives in history.db in the
+# working directory.
+#
+# Runs of the same sources and destinations (a "pair") form a
+# rolling baseline: the median MB/s of their last BASELINE_RUNS
+# complete runs. A run well below it is flagged as a regression,
+# and a starting run's ETA leans on the baseline until its own
+# rate has settled.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+HISTORY_DB = 'history.db'
+
+# Complete runs the baseline is the median of
+BASELINE_RUNS = 10
+# Fewer runs than this give no baseline
+MIN_BASELINE_RUNS = 3
+# Below this fraction of the baseline a run is a regression
+REGRESSION_RATIO = 0.5
+# Runs copying less than this are mostly overhead: no MB/s verdict
+MIN_REGRESSION_BYTES = 64 * 1024 * 1024
+
+# Seconds until a run's own rate fully replaces the baseline in its ETA
+ETA_WARMUP_SECONDS = 30
+
+HISTORY_LIMIT = 100
+
+COLUMNS = (
+    'run_id', 'kind', 'pair', 'started', 'finished', 'status', 'host',
+    'devices', 'phases', 'files_scanned', 'bytes_scanned', 'files_copied',
+    'bytes_copied', 'failed_files', 'mb_per_sec', 'baseline_mb_per_sec',
+    'regression'
+)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS runs ('
+    ' run_id TEXT, kind TEXT, pair TEXT, started REAL, finished REAL,'
+    ' status TEXT, host TEXT, devices TEXT, phases TEXT,'
+    ' files_scanned INTEGER, bytes_scanned INTEGER, files_copied INTEGER,'
+    ' bytes_copied INTEGER, failed_files INTEGER, mb_per_sec REAL,'
+    ' baseline_mb_per_sec REAL, regression INTEGER,'
+    ' PRIMARY KEY (run_id, kind))',
+    'CREATE INDEX IF NOT EXISTS runs_pair ON runs (pair, started)',
+)
+
+
+def pair_key(sources, destinations):
+    """Stable name of a source/destination pair."""
+    return ','.join(sorted(sources)) + ' -> ' + ','.join(sorted(destinations))
+
+
+class Phases:
+    """Seconds spent per named phase of one run.
+
+        with phases('scan'):
+            ...
+    """
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def __call__(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.seconds[name] = round(
+                self.seconds.get(name, 0) + time.monotonic() - started, 3
+            )
+
+
+def _connect(db_path):
+    db = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+        db.execute(statement)
+    return db
+
+
+_lock = threading.Lock()
+
+
+def baseline(pair, db_path=HISTORY_DB):
+    """Median MB/s of the pair's last complete runs, or None."""
+    with _lock:
+        db = _connect(db_path)
+        try:
+            rates = [
+                row[0] for row in db.execute(
+                    "SELECT mb_per_sec FROM runs WHERE pair = ?"
+                    " AND status = 'done' AND mb_per_sec IS NOT NULL"
+                    " AND bytes_copied >= ? ORDER BY started DESC LIMIT ?",
+                    (pair, MIN_REGRESSION_BYTES, BASELINE_RUNS)
+                )
+            ]
+        finally:
+            db.close()
+    if len(rates) < MIN_BASELINE_RUNS:
+        return None
+    return round(statistics.median(rates), 2)
+
+
+def record_run(run, db_path=HISTORY_DB):
+    """Store one run and flag it against its pair's baseline.
+
+    run holds the COLUMNS (phases and devices as dicts); copy_seconds
+    (the data phase) gives mb_per_sec. Returns the stored row.
+    """
+    row = dict(run)
+    row.setdefault('host', socket.gethostname())
+    copy_seconds = row.pop('copy_seconds', None)
+    row['mb_per_sec'] = (
+        round(row['bytes_copied'] / copy_seconds / 1e6, 2)
+        if copy_seconds and row.get('bytes_copied') else None
+    )
+    # The baseline is taken before this run joins it
+    row['baseline_mb_per_sec'] = baseline(row['pair'], db_path)
+    row['regression'] = bool(
+        row['status'] == 'done' and row['mb_per_sec'] is not None and
+        row['baseline_mb_per_sec'] and
+        row['bytes_copied'] >= MIN_REGRESSION_BYTES and
+        row['mb_per_sec'] < REGRESSION_RATIO * row['baseline_mb_per_sec']
+    )
+
+    values = [
+        json.dumps(row.get(c) or {}) if c in ('phases', 'devices')
+        else row.get(c)
+        for c in COLUMNS
+    ]
+    with _lock:
+        db = _connect(db_path)
+        try:
+            db.execute(
+                f"INSERT OR REPLACE INTO runs ({', '.join(COLUMNS)})"
+                f" VALUES ({', '.join('?' * len(COLUMNS))})", values
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    if row['regression']:
+        logger.warning(
+            f"Throughput regression: {row['mb_per_sec']} MB/s against a "
+            f"baseline of {row['baseline_mb_per_sec']} MB/s | {row['pair']}",
+            extra={'run_id': row['run_id']}
+        )
+    return row
+
+
+def history(pair=None, limit=HISTORY_LIMIT, db_path=HISTORY_DB):
+    """Stored runs, newest first; only the pair's if given."""
+    if not os.path.exists(db_path):
+        return []
+    sql = f"SELECT {', '.join(COLUMNS)} FROM runs"
+    args = []
+    if pair:
+        sql += ' WHERE pair = ?'
+        args.append(pair)
+    sql += ' ORDER BY started DESC LIMIT ?'
+    args.append(limit)
+    with _lock:
+        db = _connect(db_path)
+        try:
+            rows = db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+    runs = []
+    for values in rows:
+        run = dict(zip(COLUMNS, values))
+        run['phases'] = json.loads(run['phases'] or '{}')
+        run['devices'] = json.loads(run['devices'] or '{}')
+        run['regression'] = bool(run['regression'])
+        runs.append(run)
+    return runs
+
+
+def eta_seconds(bytes_left, bytes_done, elapsed, baseline_mb_per_sec=None):
+    """Seconds left at the run's own rate, blended with the baseline.
+
+    Early in a run its own rate is noise (scan warm-up, small files
+    first); the baseline weighs in fully at the start and fades out
+    over ETA_WARMUP_SECONDS. None if there is nothing to go on yet.
+    """
+    rate = bytes_done / elapsed if elapsed > 0 and bytes_done else None
+    if baseline_mb_per_sec:
+        weight = min(1.0, elapsed / ETA_WARMUP_SECONDS) if rate else 0.0
+        rate = weight * (rate or 0) + (1 - weight) * baseline_mb_per_sec * 1e6
+    if not rate:
+        return None
+    return int(bytes_left / rate)
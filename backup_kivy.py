@@ -1,11 +1,16 @@
 import os
-import shutil
 import threading
 import time
 import logging
 
+from backup_control import Cancelled, JobControl
+from backup_copy import copy_file
+from backup_crypto import check_plain
+from backup_logging import RunManifest, new_run_id, setup_logging
+from backup_restore import Restorer, resolve_backup
+
 # Configure logging for backup_kivy.py
-logging.basicConfig(filename='kivy.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging('kivy.log')
 logger = logging.getLogger('kivy')
 
 from kivy.app import App
@@ -30,8 +35,10 @@ class BackupLayout(BoxLayout):
         self.start_time = None # Start time for ETA calculation
         self.is_running = False # Backup running state
         self.thread = None     # Thread for backup operation
+        self.control = JobControl() # Pause / resume / cancel switch
         self.progress_percent = 0
         self.eta = 0
+        self.action = 'Copied' # Verb of the progress line: Copied or Restored
 
         # Title label
         self.title = Label(text='[b]Directory Backup Tool[/b]', markup=True, font_size=28, color=(0.29,0.56,0.89,1), size_hint=(1, 0.15))
@@ -73,8 +80,14 @@ class BackupLayout(BoxLayout):
         btn_layout = BoxLayout(size_hint=(1, 0.12), spacing=10)
         self.start_btn = Button(text='Start Backup', on_press=self.start_backup)
         self.reset_btn = Button(text='Reset', on_press=self.reset)
+        self.pause_btn = Button(text='Pause', on_press=self.toggle_pause)
+        self.cancel_btn = Button(text='Cancel', on_press=self.cancel_backup)
+        self.restore_btn = Button(text='Restore', on_press=self.start_restore)
         btn_layout.add_widget(self.start_btn)
         btn_layout.add_widget(self.reset_btn)
+        btn_layout.add_widget(self.pause_btn)
+        btn_layout.add_widget(self.cancel_btn)
+        btn_layout.add_widget(self.restore_btn)
         self.add_widget(btn_layout)
 
     def add_folder(self, instance):
@@ -132,6 +145,7 @@ class BackupLayout(BoxLayout):
         count = 0
         for d in dirs:
             for root, _, files in os.walk(d):
+                self.control.checkpoint()
                 count += len(files)
         return count
 
@@ -139,10 +153,14 @@ class BackupLayout(BoxLayout):
         # Worker thread for performing the backup
         self.is_running = True
         self.copied_files = 0
-        self.total_files = self.count_files(self.source_dirs)
-        self.start_time = time.time()
         logger.info(f'Starting backup from {self.source_dirs} to {self.destination}')
+        manifest = None
+        status = 'failed'
         try:
+            # Restore reads the backup's file list from the run manifests
+            manifest = RunManifest(self.destination, new_run_id(), source_dirs=self.source_dirs, mode='incremental')
+            self.total_files = self.count_files(self.source_dirs)
+            self.start_time = time.time()
             for src in self.source_dirs:
                 dest_path = os.path.join(self.destination, os.path.basename(src))
                 for root, dirs, files in os.walk(src):
@@ -150,20 +168,36 @@ class BackupLayout(BoxLayout):
                     dest_dir = os.path.join(dest_path, rel_path)
                     os.makedirs(dest_dir, exist_ok=True)
                     for file in files:
+                        self.control.checkpoint()
                         src_file = os.path.join(root, file)
                         dest_file = os.path.join(dest_dir, file)
+                        rel_file = os.path.normpath(os.path.join(os.path.basename(src), rel_path, file))
                         # Incremental backup: only copy if dest does not exist or src is newer
                         if not os.path.exists(dest_file) or os.path.getmtime(src_file) > os.path.getmtime(dest_file):
-                            shutil.copy2(src_file, dest_file)
+                            # Stops mid-file on cancel, leaving no partial file
+                            size, _ = copy_file(src_file, dest_file, control=self.control)
+                            manifest.record('copied', rel_file, size=size)
+                        else:
+                            manifest.record('skipped', rel_file, size=os.path.getsize(dest_file))
                         self.copied_files += 1
                         Clock.schedule_once(lambda dt: self.update_progress(), 0)
             logger.info('Backup completed successfully')
+            manifest.close(status='done', copied_files=self.copied_files)
+            manifest = None
             self.is_running = False
             Clock.schedule_once(lambda dt: self.progress_label.setter('text')(self.progress_label, 'Backup completed!'), 0)
+        except Cancelled:
+            logger.info('Backup cancelled')
+            status = 'cancelled'
+            self.is_running = False
+            Clock.schedule_once(lambda dt: self.progress_label.setter('text')(self.progress_label, 'Backup cancelled.'), 0)
         except Exception as e:
             logger.error(f'Backup failed: {e}')
             self.is_running = False
             Clock.schedule_once(lambda dt: self.progress_label.setter('text')(self.progress_label, f'Error: {e}'), 0)
+        finally:
+            if manifest is not None:
+                manifest.close(status=status, copied_files=self.copied_files)
 
     def update_progress(self):
         # Update the progress bar and labels
@@ -172,7 +206,7 @@ class BackupLayout(BoxLayout):
         eta = int(elapsed * (self.total_files - self.copied_files) / self.copied_files) if self.copied_files else 0
         self.progress.value = percent
         self.progress_percent_label.text = f'{percent}%'
-        self.progress_label.text = f'Copied {self.copied_files} of {self.total_files} files ({percent}%) | ETA: {eta}s'
+        self.progress_label.text = f'{self.action} {self.copied_files} of {self.total_files} files ({percent}%) | ETA: {eta}s'
 
     def start_backup(self, instance):
         # Start the backup process in a new thread
@@ -184,9 +218,106 @@ class BackupLayout(BoxLayout):
             return
         self.progress.value = 0
         self.progress_label.text = 'Starting backup...'
+        self.action = 'Copied'
+        self.control = JobControl()
+        self.pause_btn.text = 'Pause'
         self.thread = threading.Thread(target=self.backup_worker, daemon=True)
         self.thread.start()
 
+    def restore_worker(self, backup, target, patterns):
+        # Worker thread for restoring from the destination
+        self.is_running = True
+        self.copied_files = 0
+        self.total_files = 0
+        self.start_time = time.time()
+        # Patterns with wildcards are globs, the others path prefixes
+        globs = [p for p in patterns if any(c in p for c in '*?[')]
+        prefixes = [p for p in patterns if p not in globs]
+        logger.info(f'Starting restore from {backup} to {target} ({patterns or "everything"})')
+
+        def report(action, rel_path, **fields):
+            if action == 'cancelled':
+                return
+            if action == 'failed':
+                logger.error(f"Restore failed: {rel_path} | {fields.get('error')}")
+            self.copied_files += 1
+            self.total_files = restorer.summary['total_files']
+            Clock.schedule_once(lambda dt: self.update_progress(), 0)
+
+        restorer = Restorer(backup, target, prefixes, globs, control=self.control, report=report)
+        try:
+            summary = restorer.run()
+            logger.info(f'Restore completed: {summary}')
+            text = (f"Restored {summary['restored_files']} files in {summary['seconds']}s "
+                    f"(first file after {summary['first_file_seconds']}s, "
+                    f"{summary['failed_files']} failed)")
+        except Cancelled:
+            logger.info('Restore cancelled')
+            text = 'Restore cancelled.'
+        except Exception as e:
+            logger.error(f'Restore failed: {e}')
+            text = f'Error: {e}'
+        self.is_running = False
+        Clock.schedule_once(lambda dt: self.progress_label.setter('text')(self.progress_label, text), 0)
+
+    def start_restore(self, instance):
+        # Pick a folder to restore into and, optionally, what to restore
+        if self.is_running:
+            self.progress_label.text = 'A job is already running.'
+            return
+        if not self.destination:
+            self.progress_label.text = 'Please select the destination folder to restore from.'
+            return
+        try:
+            check_plain(self.destination)
+        except ValueError as e:
+            self.progress_label.text = str(e)
+            return
+        chooser = FileChooserListView(path='/', dirselect=True, filters=['!*.pyc'])
+        patterns = TextInput(hint_text='Only these paths or patterns, separated by spaces (empty = everything)',
+                             multiline=False, size_hint=(1, 0.1))
+        box = BoxLayout(orientation='vertical')
+        box.add_widget(chooser)
+        box.add_widget(patterns)
+        btn = Button(text='Restore Here', size_hint=(1, 0.12))
+        box.add_widget(btn)
+        popup = Popup(title='Restore To Folder', content=box, size_hint=(0.9, 0.9))
+        def select_folder(instance):
+            if chooser.selection:
+                popup.dismiss()
+                self.progress.value = 0
+                self.progress_label.text = 'Starting restore...'
+                self.action = 'Restored'
+                self.control = JobControl()
+                self.pause_btn.text = 'Pause'
+                self.thread = threading.Thread(
+                    target=self.restore_worker,
+                    args=(resolve_backup(self.destination), chooser.selection[0], patterns.text.split()),
+                    daemon=True)
+                self.thread.start()
+        btn.bind(on_press=select_folder)
+        popup.open()
+
+    def toggle_pause(self, instance):
+        # Pause the running backup, or resume it where it stopped
+        if not self.is_running:
+            return
+        if self.control.state == 'paused':
+            self.control.resume()
+            self.pause_btn.text = 'Pause'
+            logger.info('Backup resumed')
+        else:
+            self.control.pause()
+            self.pause_btn.text = 'Resume'
+            self.progress_label.text = f'Paused at {self.copied_files} of {self.total_files} files'
+            logger.info('Backup paused')
+
+    def cancel_backup(self, instance):
+        # Stop the running backup; the current file is abandoned cleanly
+        if self.is_running:
+            self.control.cancel()
+            self.progress_label.text = 'Cancelling...'
+
     def reset(self, instance):
         # Reset all fields and progress
         self.source_dirs = []
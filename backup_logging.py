@@ -0,0 +1,197 @@
+import os
+import json
+import gzip
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+# --------------------------------------------------
+# Asynchronous logging for the backup apps.
+#
+# Log calls only put the record on a queue; a QueueListener
+# thread formats it as one JSON line and writes it to a
+# size-rotated file. Per-file records go to a separate gzip
+# manifest per run, written by its own thread, so auditing
+# every file never blocks the copy path.
+# --------------------------------------------------
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# Werkzeug access lines for these paths are dropped: the UI polls
+# them every second and they drown out everything else
+QUIET_PATHS = ('/progress',)
+
+# Attributes every LogRecord has; anything else came in via extra=
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QuietPathsFilter(logging.Filter):
+    """Drop werkzeug access lines for polled endpoints."""
+
+    def filter(self, record):
+        if record.name != 'werkzeug':
+            return True
+        message = record.getMessage()
+        return not any(f' {path} ' in message or f' {path}?' in message
+                       for path in QUIET_PATHS)
+
+
+def setup_logging(filename, level=logging.INFO):
+    """Route the root logger through a queue to a rotating JSON file.
+
+    Safe to call more than once; only the first call installs the
+    pipeline.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(QuietPathsFilter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    _listener = logging.handlers.QueueListener(
+        records, handler, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+# --------------------------------------------------
+# Per-run manifest
+# --------------------------------------------------
+MANIFEST_DIR = os.path.join('.backup', 'manifests')
+
+
+def manifest_dir(destination):
+    return os.path.join(destination, MANIFEST_DIR)
+
+
+def new_run_id():
+    now = time.time()
+    return time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + \
+        f"-{int(now * 1000) % 1000:03d}"
+
+
+class RunManifest:
+    """Gzip JSON-lines record of every file handled by one run.
+
+    Lives in <destination>/.backup/manifests/<run_id>.jsonl.gz.
+    The first line describes the run and the last one sums it up;
+    the lines in between are one per file with an 'action' of
+    copied, skipped, failed, removed, metadata, linked, symlink,
+    archived, packed or verified.
+
+    catalog (a CatalogRun, optional) gets every entry on the writer
+    thread too; a catalog error only stops the catalog. path writes
+    the manifest somewhere else, e.g. a shard's part of a run.
+    """
+
+    def __init__(self, destination, run_id, catalog=None, path=None, **info):
+        self.path = path or os.path.join(
+            manifest_dir(destination), f"{run_id}.jsonl.gz"
+        )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.records = queue.SimpleQueue()
+        self.totals = {}
+        self.catalog = catalog
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+        self.records.put({
+            'type': 'run', 'run_id': run_id,
+            'destination': destination, 'started': time.time(), **info
+        })
+
+    def record(self, action, path, **fields):
+        """Queue one per-file entry; never blocks on disk I/O."""
+        self.records.put({'action': action, 'path': path, **fields})
+
+    def _write(self):
+        with gzip.open(self.path, 'wt', encoding='utf-8') as out:
+            while True:
+                entry = self.records.get()
+                if entry is None:
+                    break
+                action = entry.get('action')
+                if action:
+                    total = self.totals.setdefault(
+                        action, {'files': 0, 'bytes': 0}
+                    )
+                    total['files'] += 1
+                    total['bytes'] += entry.get('size', 0)
+                elif entry.get('type') == 'summary':
+                    entry['totals'] = self.totals
+                out.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                if self.catalog is not None:
+                    self._catalog(entry)
+
+    def _catalog(self, entry):
+        try:
+            if entry.get('action'):
+                self.catalog.add(entry)
+            elif entry.get('type') == 'summary':
+                self.catalog.close(entry.get('status'))
+        except Exception:
+            logging.getLogger('app').exception('Catalog update failed')
+            self.catalog = None
+
+    def close(self, **summary):
+        self.records.put({
+            'type': 'summary', 'finished': time.time(), **summary
+        })
+        self.records.put(None)
+        self.thread.join()
+
+
+def read_manifest(path):
+    """Yield the entries of a manifest written by RunManifest."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def manifest_status(path):
+    """Status of the summary line of a manifest; None for a run that
+    never got to write one (or no readable manifest at all)."""
+    last = None
+    try:
+        # Only the last line is parsed
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for last in f:
+                pass
+        entry = json.loads(last) if last else {}
+    except (OSError, EOFError, ValueError):
+        return None
+    if entry.get('type') != 'summary':
+        return None
+    return entry.get('status')
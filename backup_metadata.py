@@ -0,0 +1,130 @@
+import os
+import stat
+import threading
+import logging
+
+# --------------------------------------------------
+# Deferred metadata application.
+#
+# shutil.copy2 runs copystat (utime, chmod, xattrs) right after
+# each data copy, interleaving metadata syscalls with data I/O.
+# Here copies only queue what has to be applied. File entries
+# are applied in batches, grouped per directory and addressed
+# relative to an open directory fd. Directory entries wait for
+# the final pass, leaf directories first, so that creating files
+# inside a directory can no longer bump its preserved mtime.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+# File entries applied together
+BATCH_SIZE = 5000
+
+HAS_XATTR = hasattr(os, 'listxattr')
+DIR_FD_OK = (
+    os.utime in os.supports_dir_fd and os.chmod in os.supports_dir_fd
+)
+
+
+def copy_xattrs(src_path, dest_path):
+    """Copy extended attributes, POSIX ACLs included (system.posix_acl_*)."""
+    if not HAS_XATTR:
+        return
+    try:
+        names = os.listxattr(src_path)
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.setxattr(dest_path, name, os.getxattr(src_path, name))
+        except OSError as e:
+            # Unsupported on the destination or not permitted
+            logger.debug(f"xattr {name} not copied to {dest_path}: {e}")
+
+
+class MetadataQueue:
+    """Collects metadata of copied files and created directories.
+
+    Thread-safe: copy workers call add_file(), the dispatcher calls
+    add_dir(), and the job calls finish() once all data is written.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.files = []
+        self.dirs = []
+        self.applied = 0
+        self.failed = 0
+
+    # ---- queueing ----
+    def add_file(self, src_file, dest_file, st):
+        """st is the source stat taken before its data was copied."""
+        entry = (
+            dest_file, st.st_mode, st.st_atime_ns, st.st_mtime_ns, src_file
+        )
+        with self.lock:
+            self.files.append(entry)
+            if len(self.files) < self.batch_size:
+                return
+            batch, self.files = self.files, []
+        self._apply(batch)
+
+    def add_dir(self, src_dir, dest_dir):
+        st = os.stat(src_dir)
+        with self.lock:
+            self.dirs.append((
+                os.path.normpath(dest_dir),
+                st.st_mode, st.st_atime_ns, st.st_mtime_ns, src_dir
+            ))
+
+    # ---- applying ----
+    def _apply(self, entries):
+        by_dir = {}
+        for entry in entries:
+            parent, name = os.path.split(entry[0])
+            by_dir.setdefault(parent, []).append((name, entry))
+
+        applied = failed = 0
+        for parent, items in by_dir.items():
+            dir_fd = None
+            if DIR_FD_OK:
+                try:
+                    dir_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+                except OSError as e:
+                    logger.error(f"Metadata skipped for {parent}: {e}")
+                    failed += len(items)
+                    continue
+            try:
+                for name, (path, mode, atime, mtime, src) in items:
+                    try:
+                        target = name if dir_fd is not None else path
+                        copy_xattrs(src, path)
+                        os.chmod(target, stat.S_IMODE(mode), dir_fd=dir_fd)
+                        os.utime(target, ns=(atime, mtime), dir_fd=dir_fd)
+                        applied += 1
+                    except OSError as e:
+                        failed += 1
+                        logger.error(f"Metadata failed: {path} | {e}")
+            finally:
+                if dir_fd is not None:
+                    os.close(dir_fd)
+
+        with self.lock:
+            self.applied += applied
+            self.failed += failed
+
+    def flush(self):
+        with self.lock:
+            batch, self.files = self.files, []
+        self._apply(batch)
+
+    def finish(self):
+        """Apply everything left: files, then directories leaf first."""
+        self.flush()
+        with self.lock:
+            dirs, self.dirs = self.dirs, []
+        # Deeper paths first; a parent is only touched after all of
+        # its children, so its mtime stays as set
+        dirs.sort(key=lambda entry: entry[0].count(os.sep), reverse=True)
+        self._apply(dirs)
@@ -0,0 +1,83 @@
+import fnmatch
+from array import array
+
+# --------------------------------------------------
+# Copy ordering policies.
+#
+# The dispatcher walks the plan directory by directory; copies
+# pass through an OrderBuffer on their way to the thread pool. The
+# plans are built from complete source indexes before anything is
+# dispatched, so the order can be exact: the buffer holds the
+# pending copies of the walk and hands them out sorted once it is
+# done. A copy is held as the ints the dispatcher rebuilds it from
+# (its file id and a flags word) and its sort key, in arrays: 24
+# to 28 bytes a file, not a tuple of paths and a dict of targets.
+# --------------------------------------------------
+
+# tree: walk order, newest: most recently modified first,
+# smallest/largest: by size, priority: by priority_paths
+ORDER_POLICIES = ('tree', 'newest', 'smallest', 'largest', 'priority')
+
+
+def path_rank(rel_path, patterns):
+    """Index of the first pattern matching rel_path, else len(patterns).
+
+    A pattern is a glob ('*.docx', 'photos/2024*') or a directory
+    prefix ('src/Documents').
+    """
+    for rank, pattern in enumerate(patterns):
+        prefix = pattern.rstrip('/')
+        if (rel_path == prefix or rel_path.startswith(prefix + '/') or
+                fnmatch.fnmatch(rel_path, pattern)):
+            return rank
+    return len(patterns)
+
+
+class OrderBuffer:
+    """Buffer handing out pending copies in policy order.
+
+    push() takes a copy as (file_id, flags), two ints of the
+    caller's, with its path, size and mtime; it returns the copies
+    to run now: the copy itself under the tree policy, else none.
+    drain() yields the rest as (file_id, flags) at the end of the
+    walk, sorted; ties keep walk order.
+    """
+
+    def __init__(self, policy='tree', priority_paths=()):
+        if policy not in ORDER_POLICIES:
+            raise ValueError(f"Unknown order policy: {policy}")
+        self.policy = policy
+        self.patterns = list(priority_paths)
+        self.ids = array('q')
+        self.flags = array('q')
+        self.keys = array('q')
+        # priority policy: rank of the path, then newest first
+        self.ranks = array('i')
+
+    def push(self, file_id, flags, rel_path, size, mtime_ns):
+        if self.policy == 'tree':
+            return [(file_id, flags)]
+        self.ids.append(file_id)
+        self.flags.append(flags)
+        if self.policy == 'smallest':
+            self.keys.append(size)
+        elif self.policy == 'largest':
+            self.keys.append(-size)
+        else:
+            self.keys.append(-mtime_ns)
+        if self.policy == 'priority':
+            self.ranks.append(path_rank(rel_path, self.patterns))
+        return []
+
+    def drain(self):
+        ids, flags, keys, ranks = self.ids, self.flags, self.keys, self.ranks
+        self.ids, self.flags = array('q'), array('q')
+        self.keys, self.ranks = array('q'), array('i')
+        if self.policy == 'priority':
+            def key(n):
+                return ranks[n], keys[n]
+        else:
+            key = keys.__getitem__
+        # sorted() is stable
+        for n in sorted(range(len(ids)), key=key):
+            yield ids[n], flags[n]
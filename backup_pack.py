@@ -0,0 +1,321 @@
+import os
+import sys
+import stat
+import sqlite3
+import argparse
+import threading
+import logging
+
+from backup_copy import copy_file, discard_partial, partial_path
+from backup_pathindex import FILE, PathIndex
+
+# --------------------------------------------------
+# Packed layout for small files.
+#
+# Copying a small file costs an open, write, close, chmod and
+# utime on the destination plus a directory entry; on USB disks
+# that caps a mail spool or source tree at a few hundred files
+# per second. In the packed layout, files below a threshold are
+# appended to large pack files instead, with one buffered,
+# sequential write stream per destination, and a SQLite index
+# maps each path to its pack, offset, size, mode and times.
+# Larger files, symlinks and hard links stay in the tree.
+#
+#   <destination>/.backup/packs/<run_id>-000.pack
+#   <destination>/.backup/packs/index.db
+#
+# A changed file is appended again and its row moved; the old
+# bytes stay in their pack.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+LAYOUTS = ('files', 'packed')
+
+PACK_DIR = os.path.join('.backup', 'packs')
+PACK_INDEX = 'index.db'
+
+# Files smaller than this are packed
+PACK_THRESHOLD = 256 * 1024
+
+# A new pack is started once the current one reaches this size
+PACK_SIZE = 1024 * 1024 * 1024
+
+# Write buffer of the open pack: turns many small appends into
+# large sequential writes
+PACK_BUFFER = 8 * 1024 * 1024
+
+
+def pack_dir(destination):
+    return os.path.join(destination, PACK_DIR)
+
+
+def linked_ids(index):
+    """Ids of all files of a PathIndex that share their inode."""
+    return set(index.hardlinks) | set(index.hardlinks.values())
+
+
+def packable(index, i, threshold=PACK_THRESHOLD, linked=()):
+    """Whether file i of a PathIndex belongs in a pack.
+
+    linked is linked_ids(index): hard links stay in the tree, where
+    they can be linked to each other.
+    """
+    return (
+        index.kinds[i] == FILE and i not in linked and
+        index.sizes[i] < threshold
+    )
+
+
+def read_small(src_file, hook=None):
+    """Read a whole (small) file: returns (stat, data)."""
+    with open(src_file, 'rb') as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    if hook:
+        hook.read(len(data))
+    return st, data
+
+
+class PackStore:
+    """Pack files and index of one destination.
+
+    Thread-safe: copy workers call add(), each append happening
+    under one lock. Nothing is visible in the index until close()
+    (or commit()) has flushed and synced the pack data.
+    """
+
+    def __init__(self, destination, run_id, pack_size=PACK_SIZE):
+        self.dir = pack_dir(destination)
+        os.makedirs(self.dir, exist_ok=True)
+        self.run_id = run_id
+        self.pack_size = pack_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(self.dir, PACK_INDEX), check_same_thread=False
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS packed ('
+            ' path TEXT PRIMARY KEY, pack TEXT, offset INTEGER,'
+            ' size INTEGER, mode INTEGER, atime_ns INTEGER,'
+            ' mtime_ns INTEGER)'
+        )
+        self.db.commit()
+        self.pack = None
+        self.pack_name = None
+        self.packs = 0
+        self.added = 0
+
+    # ---- reading the index ----
+    def path_index(self, base):
+        """PathIndex of the files packed under base (a source's name)."""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT path, size, mtime_ns FROM packed'
+                ' WHERE path > ? AND path < ? ORDER BY path',
+                (base + '/', base + '0')
+            ).fetchall()
+
+        return PathIndex.from_files(
+            (os.path.relpath(path, base), size, mtime_ns)
+            for path, size, mtime_ns in rows
+        )
+
+    def lookup(self, rel_path):
+        """(size, mtime_ns) of a packed path, or None."""
+        with self.lock:
+            return self.db.execute(
+                'SELECT size, mtime_ns FROM packed WHERE path = ?',
+                (rel_path,)
+            ).fetchone()
+
+    # ---- writing ----
+    def _roll(self):
+        if self.pack:
+            self.pack.close()
+        self.pack_name = f"{self.run_id}-{self.packs:03d}.pack"
+        self.packs += 1
+        self.pack = open(
+            os.path.join(self.dir, self.pack_name), 'ab',
+            buffering=PACK_BUFFER
+        )
+
+    def add(self, rel_path, st, data):
+        """Append data as rel_path; returns (pack name, offset)."""
+        with self.lock:
+            if self.pack is None or self.pack.tell() >= self.pack_size:
+                self._roll()
+            offset = self.pack.tell()
+            self.pack.write(data)
+            self.db.execute(
+                'INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (rel_path, self.pack_name, offset, len(data),
+                 stat.S_IMODE(st.st_mode), st.st_atime_ns, st.st_mtime_ns)
+            )
+            self.added += 1
+            return self.pack_name, offset
+
+    def remove(self, rel_paths):
+        with self.lock:
+            self.db.executemany(
+                'DELETE FROM packed WHERE path = ?',
+                ((path,) for path in rel_paths)
+            )
+
+    def commit(self):
+        """Make the data appended so far durable, then index it."""
+        with self.lock:
+            if self.pack:
+                self.pack.flush()
+                os.fsync(self.pack.fileno())
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            if self.pack:
+                self.pack.close()
+                self.pack = None
+            self.db.close()
+
+
+# --------------------------------------------------
+# Restore
+# --------------------------------------------------
+def packed_entries(destination, prefix=''):
+    """Index rows under prefix, in pack order so reading is sequential.
+
+    prefix is the path of a file or directory: 'src/mail' matches
+    src/mail and src/mail/..., not src/mailbox. Rows are (path, pack,
+    offset, size, mode, atime_ns, mtime_ns).
+    """
+    prefix = prefix.strip('/')
+    db = sqlite3.connect(os.path.join(pack_dir(destination), PACK_INDEX))
+    try:
+        if not prefix:
+            return db.execute(
+                'SELECT * FROM packed ORDER BY pack, offset'
+            ).fetchall()
+        # '0' sorts right after '/'
+        return db.execute(
+            'SELECT * FROM packed WHERE path = ? OR'
+            ' (path > ? AND path < ?) ORDER BY pack, offset',
+            (prefix, prefix + '/', prefix + '0')
+        ).fetchall()
+    finally:
+        db.close()
+
+
+def restore_packed(destination, target, prefix=''):
+    """Write the packed files under prefix back out below target.
+
+    Reads each pack front to back. A file the tree also holds (it
+    grew past the threshold since) is left to the tree copy when
+    that one is at least as new. Returns the number of files.
+    """
+    rows = packed_entries(destination, prefix)
+    restored = 0
+    pack_name, pack = None, None
+    try:
+        for path, name, offset, size, mode, atime_ns, mtime_ns in rows:
+            try:
+                tree_st = os.lstat(os.path.join(destination, path))
+                if tree_st.st_mtime_ns >= mtime_ns:
+                    continue
+            except FileNotFoundError:
+                pass
+
+            if name != pack_name:
+                if pack:
+                    pack.close()
+                pack_name = name
+                pack = open(
+                    os.path.join(pack_dir(destination), name), 'rb',
+                    buffering=PACK_BUFFER
+                )
+            pack.seek(offset)
+            data = pack.read(size)
+
+            dest_file = os.path.join(target, path)
+            os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+            tmp = partial_path(dest_file)
+            try:
+                with open(tmp, 'wb') as out:
+                    out.write(data)
+                os.chmod(tmp, mode)
+                os.utime(tmp, ns=(atime_ns, mtime_ns))
+                os.replace(tmp, dest_file)
+            except BaseException:
+                discard_partial(tmp)
+                raise
+            restored += 1
+    finally:
+        if pack:
+            pack.close()
+    return restored
+
+
+def restore(destination, target, prefix=''):
+    """Restore a packed-layout destination: tree files, then packs.
+
+    Returns (tree files, packed files) restored.
+    """
+    copied = 0
+    for root, dirs, files in os.walk(os.path.join(destination, prefix)):
+        rel_root = os.path.relpath(root, destination)
+        if rel_root == '.':
+            # Packs, manifests and archives are not backed-up data
+            dirs[:] = [
+                d for d in dirs
+                if d not in ('.backup', 'archives')
+            ]
+        out_dir = os.path.normpath(os.path.join(target, rel_root))
+        os.makedirs(out_dir, exist_ok=True)
+        # os.walk lists symlinks to directories with the directories
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        dirs[:] = [d for d in dirs if d not in links]
+        for f in links + files:
+            src_file = os.path.join(root, f)
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), os.path.join(out_dir, f))
+            else:
+                copy_file(src_file, os.path.join(out_dir, f))
+            copied += 1
+    return copied, restore_packed(destination, target, prefix)
+
+
+# --------------------------------------------------
+# Command line
+#
+#   python backup_pack.py list /mnt/usb/backup
+#   python backup_pack.py restore /mnt/usb/backup /tmp/restore
+#   python backup_pack.py restore /mnt/usb/backup /tmp/restore --prefix src/mail
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List or restore a destination in the packed layout'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list').add_argument('destination')
+    restore_args = sub.add_parser('restore')
+    restore_args.add_argument('destination')
+    restore_args.add_argument('target')
+    restore_args.add_argument('--prefix', default='')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(pack_dir(args.destination), PACK_INDEX)):
+        print(f"No packs in {args.destination}", file=sys.stderr)
+        return 1
+
+    if args.command == 'list':
+        for path, name, offset, size, *_ in packed_entries(args.destination):
+            print(f"{size:>10} {name}+{offset} {path}")
+        return 0
+
+    tree, packed = restore(args.destination, args.target, args.prefix)
+    print(f"Restored {tree} tree files and {packed} packed files")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+import os
+import mmap
+import errno
+import ctypes
+import ctypes.util
+
+# --------------------------------------------------
+# Page-cache hygiene for the copy engine.
+#
+# A nightly backup reads terabytes once and never again; left
+# alone, that data evicts everything else from the page cache.
+# In 'nocache' mode reads are advised SEQUENTIAL and dropped
+# (DONTNEED) once the file is done, and writes are pushed out
+# in batches with sync_file_range() so their pages can be
+# dropped too. 'direct' additionally bypasses the cache with
+# aligned O_DIRECT I/O for very large files.
+# --------------------------------------------------
+
+IO_MODES = ('normal', 'nocache', 'direct')
+
+# Writeback is started every WRITEBACK_BATCH bytes; the batch
+# before it is waited for and dropped from the cache
+WRITEBACK_BATCH = 8 * 1024 * 1024
+
+# O_DIRECT only pays off for big files
+DIRECT_MIN_SIZE = 256 * 1024 * 1024
+DIRECT_CHUNK_SIZE = 8 * 1024 * 1024
+DIRECT_ALIGN = 4096
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+HAS_DIRECT = hasattr(os, 'O_DIRECT')
+
+
+def _load_sync_file_range():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.sync_file_range
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = (
+        ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint
+    )
+    func.restype = ctypes.c_int
+    return func
+
+
+_sync_file_range = _load_sync_file_range()
+
+
+def sync_range(fd, offset, length, flags):
+    """sync_file_range(); falls back to fdatasync() when missing."""
+    if _sync_file_range is None:
+        if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+            os.fdatasync(fd)
+        return
+    if _sync_file_range(fd, offset, length, flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def advise(fd, advice, offset=0, length=0):
+    if HAS_FADVISE:
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            # Advice only: pipes, odd filesystems, etc.
+            pass
+
+
+def advise_sequential(f):
+    if HAS_FADVISE:
+        advise(f.fileno(), os.POSIX_FADV_SEQUENTIAL)
+
+
+def drop_cache(f):
+    """Drop the cached pages of f (they must be clean to go)."""
+    if HAS_FADVISE:
+        advise(f.fileno(), os.POSIX_FADV_DONTNEED)
+
+
+class Writeback:
+    """Flush a file being written in batches and drop its pages.
+
+    Call wrote(n) after every write and finish() at the end.
+    Keeps at most two batches of dirty data per file around.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.fd = f.fileno()
+        self.pos = 0
+        self.batch_start = 0
+        self.prev = None
+
+    def wrote(self, n):
+        self.pos += n
+        length = self.pos - self.batch_start
+        if length < WRITEBACK_BATCH:
+            return
+
+        self.f.flush()
+        # Start writeback of this batch without waiting...
+        sync_range(self.fd, self.batch_start, length, SYNC_FILE_RANGE_WRITE)
+        # ...and wait for the previous one, which is then clean
+        if self.prev:
+            self._settle(*self.prev)
+        self.prev = (self.batch_start, length)
+        self.batch_start = self.pos
+
+    def _settle(self, offset, length):
+        sync_range(
+            self.fd, offset, length,
+            SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+            SYNC_FILE_RANGE_WAIT_AFTER
+        )
+        if HAS_FADVISE:
+            advise(self.fd, os.POSIX_FADV_DONTNEED, offset, length)
+
+    def finish(self):
+        self.f.flush()
+        # offset 0, length 0 = the whole file
+        self._settle(0, 0)
+
+
+def copy_direct(src_file, dest_file, size, throttle=None):
+    """Copy with O_DIRECT on both sides through an aligned buffer.
+
+    The last block is written padded to DIRECT_ALIGN and the file
+    is then truncated to its real size. Raises OSError (EINVAL)
+    when the filesystem refuses O_DIRECT, so callers can fall back.
+    """
+    if not HAS_DIRECT:
+        raise OSError(errno.EINVAL, 'O_DIRECT not supported')
+
+    # Anonymous mmap memory is page aligned
+    buf = mmap.mmap(-1, DIRECT_CHUNK_SIZE)
+    infd = os.open(src_file, os.O_RDONLY | os.O_DIRECT)
+    try:
+        outfd = os.open(
+            dest_file,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644
+        )
+        try:
+            copied = 0
+            while True:
+                n = os.readv(infd, [buf])
+                if not n:
+                    break
+                if throttle:
+                    throttle.read(n)
+                    throttle.write(n)
+                padded = -(-n // DIRECT_ALIGN) * DIRECT_ALIGN
+                written = 0
+                with memoryview(buf) as view:
+                    while written < padded:
+                        written += os.writev(outfd, [view[written:padded]])
+                copied += n
+                if copied >= size:
+                    break
+                if n % DIRECT_ALIGN:
+                    # The next O_DIRECT read would be misaligned
+                    raise OSError(errno.EIO, f"Short O_DIRECT read: {src_file}")
+            os.ftruncate(outfd, size)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+        buf.close()
+
+    return copied
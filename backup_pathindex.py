@@ -0,0 +1,432 @@
+import os
+import stat
+import bisect
+import logging
+from array import array
+
+# --------------------------------------------------
+# Compact in-memory index of a directory tree.
+#
+# A set of relative path strings costs a few hundred bytes per
+# file, which does not fit 20M-file trees in RAM. PathIndex
+# instead keeps:
+#   - a directory table: parent id + name per directory
+#   - per directory one block of files, sorted by name
+#   - names packed into one UTF-8 buffer with an offset array
+#   - size and mtime as array('q') columns
+# which is a few dozen bytes per file. Paths are only turned
+# into strings when a caller asks for one.
+#
+# Symlinks are indexed as entries of kind SYMLINK (size is the
+# length of the target) and files sharing an inode are grouped,
+# so a copy can recreate both instead of duplicating data.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+ROOT = 0
+
+# File kinds
+FILE = 0
+SYMLINK = 1
+
+# How scan() treats symlinks: keep them as links, index their
+# targets, or leave them out
+SYMLINK_MODES = ('preserve', 'follow', 'skip')
+# Links leading outside the scanned tree (preserve mode): keep the
+# link as is, leave it out, or index the target instead
+OUT_OF_TREE_MODES = ('keep', 'skip', 'follow')
+# Directory links that lead back to an ancestor while following:
+# keep the link as is or leave it out
+LOOP_MODES = ('keep', 'skip')
+
+
+def _encode(name):
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def _decode(raw):
+    return raw.decode('utf-8', 'surrogateescape')
+
+
+class NameTable:
+    """Append-only list of strings packed into one buffer."""
+
+    __slots__ = ('data', 'offsets')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+
+    def append(self, name):
+        self.data += _encode(name)
+        self.offsets.append(len(self.data))
+        return len(self.offsets) - 2
+
+    def __getitem__(self, i):
+        return _decode(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def nbytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class PathIndex:
+    __slots__ = (
+        'dir_parent', 'dir_names', 'dir_first', 'dir_count',
+        'file_dir', 'file_names', 'sizes', 'mtimes', 'kinds', 'hardlinks',
+        '_children'
+    )
+
+    def __init__(self):
+        # Directory table
+        self.dir_parent = array('i')
+        self.dir_names = NameTable()
+        self.dir_first = array('q')
+        self.dir_count = array('i')
+        # File columns, one sorted block per directory
+        self.file_dir = array('i')
+        self.file_names = NameTable()
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.kinds = bytearray()
+        # file id -> id of the first file sharing its inode
+        self.hardlinks = {}
+        # (parent id, name) -> directory id
+        self._children = {}
+
+        self.add_directory(-1, '')
+
+    # ---- building ----
+    def add_directory(self, parent, name):
+        d = len(self.dir_parent)
+        self.dir_parent.append(parent)
+        self.dir_names.append(name)
+        self.dir_first.append(0)
+        self.dir_count.append(0)
+        if parent >= 0:
+            self._children[(parent, name)] = d
+        return d
+
+    def add_files(self, d, entries):
+        """Add the files of directory d: (name, size, mtime_ns[, kind]).
+
+        Called once per directory; entries are sorted here so that
+        directory blocks can be merge-joined and binary searched.
+        Returns the id of the first file of the block.
+        """
+        entries = sorted(entries)
+        first = len(self.sizes)
+        self.dir_first[d] = first
+        self.dir_count[d] = len(entries)
+        for entry in entries:
+            self.file_dir.append(d)
+            self.file_names.append(entry[0])
+            self.sizes.append(entry[1])
+            self.mtimes.append(entry[2])
+            self.kinds.append(entry[3] if len(entry) > 3 else FILE)
+        return first
+
+    def add_listing(self, d, files, inodes):
+        """Add a DirLister listing as the block of directory d.
+
+        inodes maps (st_dev, st_ino) to the first file id seen with
+        it and is shared by all directories of one tree.
+        """
+        files.sort()
+        first = self.add_files(d, [entry[:4] for entry in files])
+        for i, entry in enumerate(files, first):
+            if entry[4] is not None:
+                leader = inodes.setdefault(entry[4], i)
+                if leader != i:
+                    self.hardlinks[i] = leader
+
+    @classmethod
+    def scan(cls, base_dir, symlinks='preserve', out_of_tree='keep',
+             loops='skip'):
+        """Index every file below base_dir, one directory at a time.
+
+        symlinks, out_of_tree and loops take one of SYMLINK_MODES,
+        OUT_OF_TREE_MODES and LOOP_MODES. Directory links are only
+        descended into when they are followed. See backup_scan for
+        the parallel version.
+        """
+        index = cls()
+        lister = DirLister(base_dir, symlinks, out_of_tree, loops)
+        inodes = {}
+        stack = [(ROOT, base_dir, lister.root_ancestors())]
+
+        while stack:
+            d, path, ancestors = stack.pop()
+            listing = lister.list(path, ancestors)
+            if listing is None:
+                continue
+
+            files, subdirs = listing
+            index.add_listing(d, files, inodes)
+            for name, key in sorted(subdirs, reverse=True):
+                child = index.add_directory(d, name)
+                stack.append((
+                    child, os.path.join(path, name),
+                    lister.descend(ancestors, key)
+                ))
+
+        return index
+
+    @classmethod
+    def from_files(cls, entries):
+        """Index of (rel_path, size, mtime_ns) entries, e.g. a listing of
+        a pack index or an object store; '/' separates directories."""
+        by_dir = {}
+        for rel_path, size, mtime_ns in entries:
+            rel_dir, name = os.path.split(rel_path)
+            by_dir.setdefault(rel_dir, []).append((name, size, mtime_ns))
+
+        index = cls()
+        for rel_dir, files in by_dir.items():
+            index.add_files(index.make_dirs(rel_dir), files)
+        return index
+
+    # ---- access ----
+    def __len__(self):
+        return len(self.sizes)
+
+    def dir_total(self):
+        return len(self.dir_parent)
+
+    def total_bytes(self):
+        return sum(self.sizes)
+
+    def dir_path(self, d):
+        """Relative path of directory d ('' for the root)."""
+        parts = []
+        while d > ROOT:
+            parts.append(self.dir_names[d])
+            d = self.dir_parent[d]
+        return os.path.join(*reversed(parts)) if parts else ''
+
+    def files_in(self, d):
+        first = self.dir_first[d]
+        return range(first, first + self.dir_count[d])
+
+    def file_path(self, i, dir_path=None):
+        if dir_path is None:
+            dir_path = self.dir_path(self.file_dir[i])
+        return os.path.join(dir_path, self.file_names[i])
+
+    def find_dir(self, rel_dir):
+        d = ROOT
+        for part in rel_dir.split(os.sep):
+            if part in ('', '.'):
+                continue
+            d = self._children.get((d, part), -1)
+            if d < 0:
+                return -1
+        return d
+
+    def make_dirs(self, rel_dir):
+        """Id of directory rel_dir, adding it and its parents if missing."""
+        d = ROOT
+        for part in rel_dir.split(os.sep):
+            if part in ('', '.'):
+                continue
+            child = self._children.get((d, part), -1)
+            d = child if child >= 0 else self.add_directory(d, part)
+        return d
+
+    def lookup(self, rel_path):
+        """File id of rel_path, or -1."""
+        rel_dir, name = os.path.split(rel_path)
+        d = self.find_dir(rel_dir)
+        if d < 0:
+            return -1
+        names = self.block_names(d)
+        pos = bisect.bisect_left(names, name)
+        if pos < len(names) and names[pos] == name:
+            return self.dir_first[d] + pos
+        return -1
+
+    def block_names(self, d):
+        return [self.file_names[i] for i in self.files_in(d)]
+
+    # ---- comparing two trees ----
+    def map_dirs(self, other):
+        """array: directory id in self -> same directory in other, or -1."""
+        mapping = array('i', [-1]) * self.dir_total()
+        mapping[ROOT] = ROOT
+        # Parents always have smaller ids than their children
+        for d in range(1, self.dir_total()):
+            parent = mapping[self.dir_parent[d]]
+            if parent >= 0:
+                mapping[d] = other._children.get(
+                    (parent, self.dir_names[d]), -1
+                )
+        return mapping
+
+    def _join(self, other, d, od):
+        """Yield (i, j) for the files of d, j = match in od or -1."""
+        mine = self.files_in(d)
+        if od < 0:
+            for i in mine:
+                yield i, -1
+            return
+
+        theirs = other.files_in(od)
+        their_names = other.block_names(od)
+        k = 0
+        for i in mine:
+            name = self.file_names[i]
+            while k < len(their_names) and their_names[k] < name:
+                k += 1
+            if k < len(their_names) and their_names[k] == name:
+                yield i, theirs[k]
+            else:
+                yield i, -1
+
+    def pairs(self, other):
+        """Yield (i, j) for every file of self, j = same path in other or -1."""
+        mapping = self.map_dirs(other)
+        for d in range(self.dir_total()):
+            yield from self._join(other, d, mapping[d])
+
+    def diff(self, other):
+        """Yield ids of files in self that are not in other."""
+        for i, j in self.pairs(other):
+            if j < 0:
+                yield i
+
+    def changed(self, other):
+        """Yield ids of files in self that are new or changed vs other.
+
+        Same rule as should_copy(): missing, different size, or a
+        newer modification time; or a file replaced by a symlink and
+        the other way round.
+        """
+        for i, j in self.pairs(other):
+            if (j < 0 or
+                    self.kinds[i] != other.kinds[j] or
+                    self.sizes[i] != other.sizes[j] or
+                    self.mtimes[i] > other.mtimes[j]):
+                yield i
+
+    def nbytes(self):
+        """Approximate memory held by the index."""
+        arrays = (
+            self.dir_parent, self.dir_first, self.dir_count,
+            self.file_dir, self.sizes, self.mtimes
+        )
+        return (
+            sum(a.itemsize * len(a) for a in arrays) +
+            self.dir_names.nbytes() + self.file_names.nbytes() +
+            len(self.kinds) +
+            # dict entry + key tuple per directory
+            len(self._children) * 120 +
+            # dict entry + two ints per hard link
+            len(self.hardlinks) * 100
+        )
+
+
+class DirLister:
+    """Lists the directories of one tree for PathIndex.scan().
+
+    Holds the symlink options; list() only touches the directory it
+    is given, so several threads may list directories of one tree.
+    """
+
+    def __init__(self, base_dir, symlinks='preserve', out_of_tree='keep',
+                 loops='skip'):
+        self.base_dir = base_dir
+        self.real_base = os.path.realpath(base_dir)
+        self.symlinks = symlinks
+        self.out_of_tree = out_of_tree
+        self.loops = loops
+        # Directory links may be followed: track (st_dev, st_ino) of
+        # the directories above to catch loops
+        self.following = symlinks == 'follow' or out_of_tree == 'follow'
+
+    def root_ancestors(self):
+        if not self.following:
+            return frozenset()
+        st = os.stat(self.base_dir)
+        return frozenset([(st.st_dev, st.st_ino)])
+
+    def descend(self, ancestors, key):
+        return ancestors | {key} if key else ancestors
+
+    def list(self, path, ancestors):
+        """(files, subdirs) of path, or None if it cannot be read.
+
+        files are (name, size, mtime_ns, kind, inode key or None),
+        subdirs are (name, (st_dev, st_ino) or None).
+        """
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning(f"Scan skipped: {path} | {e}")
+            return None
+
+        files = []
+        subdirs = []
+        for entry in entries:
+            link = entry.is_symlink()
+            follow = not link
+            if link:
+                if self.symlinks == 'skip':
+                    continue
+                follow = self.symlinks == 'follow'
+                if (not follow and self.out_of_tree != 'keep' and
+                        not _inside(entry.path, self.real_base)):
+                    if self.out_of_tree == 'skip':
+                        logger.info(f"Out-of-tree link skipped: {entry.path}")
+                        continue
+                    follow = True
+
+            try:
+                if follow and entry.is_dir():
+                    key = None
+                    if self.following:
+                        st = entry.stat()
+                        key = (st.st_dev, st.st_ino)
+                        if key in ancestors:
+                            logger.warning(f"Symlink loop: {entry.path}")
+                            if self.loops == 'skip' or not link:
+                                continue
+                            follow = False
+                    if follow:
+                        subdirs.append((entry.name, key))
+                        continue
+                if follow:
+                    st = entry.stat()
+            except OSError:
+                # Broken symlink: kept as a link
+                follow = False
+
+            if not follow:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # Gone since it was listed
+                    continue
+                files.append((
+                    entry.name, st.st_size, st.st_mtime_ns, SYMLINK, None
+                ))
+                continue
+
+            if not stat.S_ISREG(st.st_mode):
+                # FIFOs, sockets, devices: reading them would block or
+                # never end
+                logger.warning(f"Special file skipped: {entry.path}")
+                continue
+            key = (st.st_dev, st.st_ino) if st.st_nlink > 1 else None
+            files.append((entry.name, st.st_size, st.st_mtime_ns, FILE, key))
+
+        return files, subdirs
+
+
+def _inside(path, real_base):
+    """Whether the symlink at path resolves to something below real_base."""
+    target = os.path.realpath(path)
+    return target == real_base or target.startswith(real_base + os.sep)
@@ -1,16 +1,22 @@
 import os
-import shutil
 import threading
 import time
 from PyQt5.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QProgressBar, QFileDialog, QListWidget, QListWidgetItem, QMessageBox
+    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QProgressBar, QFileDialog, QListWidget, QListWidgetItem, QMessageBox,
+    QInputDialog
 )
 from PyQt5.QtCore import Qt, QTimer
 import sys
 import logging
 
+from backup_control import Cancelled, JobControl
+from backup_copy import copy_file
+from backup_crypto import check_plain
+from backup_logging import RunManifest, new_run_id, setup_logging
+from backup_restore import Restorer, resolve_backup
+
 # Configure logging for backup_qt5.py
-logging.basicConfig(filename='qt5.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging('qt5.log')
 logger = logging.getLogger('qt5')
 
 # Main backup application class using PyQt5
@@ -26,6 +32,9 @@ class BackupAppQt(QWidget):
         self.start_time = None # Start time for ETA calculation
         self.is_running = False # Backup running state
         self.thread = None     # Thread for backup operation
+        self.control = JobControl() # Pause / resume / cancel switch
+        self.result_text = 'Backup completed!' # Shown when the thread ends
+        self.action = 'Copied' # Verb of the progress line: Copied or Restored
 
         self.init_ui()
 
@@ -94,6 +103,22 @@ class BackupAppQt(QWidget):
         self.reset_btn.setStyleSheet('border-radius: 40px; background: #d32f2f; color: white; font-size: 32pt;')
         self.reset_btn.clicked.connect(self.reset)
         btn_hbox.addWidget(self.reset_btn)
+        self.pause_btn = QPushButton('⏸')
+        self.pause_btn.setFixedSize(80, 80)
+        self.pause_btn.setStyleSheet('border-radius: 40px; background: #f5a623; color: white; font-size: 32pt;')
+        self.pause_btn.clicked.connect(self.toggle_pause)
+        btn_hbox.addWidget(self.pause_btn)
+        self.cancel_btn = QPushButton('■')
+        self.cancel_btn.setFixedSize(80, 80)
+        self.cancel_btn.setStyleSheet('border-radius: 40px; background: #555; color: white; font-size: 32pt;')
+        self.cancel_btn.clicked.connect(self.cancel_backup)
+        btn_hbox.addWidget(self.cancel_btn)
+        self.restore_btn = QPushButton('⤺')
+        self.restore_btn.setFixedSize(80, 80)
+        self.restore_btn.setStyleSheet('border-radius: 40px; background: #4a90e2; color: white; font-size: 32pt;')
+        self.restore_btn.setToolTip('Restore from the destination folder')
+        self.restore_btn.clicked.connect(self.start_restore)
+        btn_hbox.addWidget(self.restore_btn)
         layout.addLayout(btn_hbox)
 
         self.setLayout(layout)
@@ -126,17 +151,22 @@ class BackupAppQt(QWidget):
         count = 0
         for d in dirs:
             for root, _, files in os.walk(d):
+                self.control.checkpoint()
                 count += len(files)
         return count
 
     def backup_worker(self):
         # Worker thread for performing the backup
-        self.is_running = True
         self.copied_files = 0
-        self.total_files = self.count_files(self.source_dirs)
-        self.start_time = time.time()
+        self.result_text = 'Backup completed!'
         logger.info(f'Starting backup from {self.source_dirs} to {self.destination}')
+        manifest = None
+        status = 'failed'
         try:
+            # Restore reads the backup's file list from the run manifests
+            manifest = RunManifest(self.destination, new_run_id(), source_dirs=self.source_dirs, mode='incremental')
+            self.total_files = self.count_files(self.source_dirs)
+            self.start_time = time.time()
             for src in self.source_dirs:
                 dest_path = os.path.join(self.destination, os.path.basename(src))
                 for root, dirs, files in os.walk(src):
@@ -144,18 +174,34 @@ class BackupAppQt(QWidget):
                     dest_dir = os.path.join(dest_path, rel_path)
                     os.makedirs(dest_dir, exist_ok=True)
                     for file in files:
+                        self.control.checkpoint()
                         src_file = os.path.join(root, file)
                         dest_file = os.path.join(dest_dir, file)
+                        rel_file = os.path.normpath(os.path.join(os.path.basename(src), rel_path, file))
                         # Incremental backup: only copy if dest does not exist or src is newer
                         if not os.path.exists(dest_file) or os.path.getmtime(src_file) > os.path.getmtime(dest_file):
-                            shutil.copy2(src_file, dest_file)
+                            # Stops mid-file on cancel, leaving no partial file
+                            size, _ = copy_file(src_file, dest_file, control=self.control)
+                            manifest.record('copied', rel_file, size=size)
+                        else:
+                            manifest.record('skipped', rel_file, size=os.path.getsize(dest_file))
                         self.copied_files += 1
             logger.info('Backup completed successfully')
+            manifest.close(status='done', copied_files=self.copied_files)
+            manifest = None
+            self.is_running = False
+        except Cancelled:
+            logger.info('Backup cancelled')
+            status = 'cancelled'
+            self.result_text = 'Backup cancelled.'
             self.is_running = False
         except Exception as e:
             logger.error(f'Backup failed: {e}')
+            self.result_text = f'Error: {e}'
             self.is_running = False
-            self.progress_label.setText(f'Error: {e}')
+        finally:
+            if manifest is not None:
+                manifest.close(status=status, copied_files=self.copied_files)
 
     def update_progress(self):
         # Update the progress bar and labels
@@ -167,9 +213,12 @@ class BackupAppQt(QWidget):
         eta = int(elapsed * (self.total_files - self.copied_files) / self.copied_files) if self.copied_files else 0
         self.progress.setValue(percent)
         self.progress_percent_label.setText(f'{percent}%')
-        self.progress_label.setText(f'Copied {self.copied_files} of {self.total_files} files ({percent}%) | ETA: {eta}s')
+        self.progress_label.setText(f'{self.action} {self.copied_files} of {self.total_files} files ({percent}%) | ETA: {eta}s')
+        if self.control.state == 'paused':
+            self.progress_label.setText(f'Paused at {self.copied_files} of {self.total_files} files')
         if not self.is_running:
-            self.progress_label.setText('Backup completed!')
+            self.progress_label.setText(self.result_text)
+            self.pause_btn.setText('⏸')
             self.timer.stop()
 
     def start_backup(self):
@@ -182,10 +231,96 @@ class BackupAppQt(QWidget):
             return
         self.progress.setValue(0)
         self.progress_label.setText('Starting backup...')
+        self.action = 'Copied'
+        self.control = JobControl()
+        self.is_running = True
         self.thread = threading.Thread(target=self.run_backup, daemon=True)
         self.thread.start()
         self.timer.start(100)
 
+    def restore_worker(self, backup, target, patterns):
+        # Worker thread for restoring from the destination
+        self.copied_files = 0
+        self.total_files = 0
+        self.start_time = time.time()
+        # Patterns with wildcards are globs, the others path prefixes
+        globs = [p for p in patterns if any(c in p for c in '*?[')]
+        prefixes = [p for p in patterns if p not in globs]
+        logger.info(f'Starting restore from {backup} to {target} ({patterns or "everything"})')
+
+        def report(action, rel_path, **fields):
+            if action == 'cancelled':
+                return
+            if action == 'failed':
+                logger.error(f"Restore failed: {rel_path} | {fields.get('error')}")
+            self.copied_files += 1
+            self.total_files = restorer.summary['total_files']
+
+        restorer = Restorer(backup, target, prefixes, globs, control=self.control, report=report)
+        try:
+            summary = restorer.run()
+            logger.info(f'Restore completed: {summary}')
+            self.result_text = (
+                f"Restored {summary['restored_files']} files in {summary['seconds']}s "
+                f"(first file after {summary['first_file_seconds']}s, "
+                f"{summary['failed_files']} failed)")
+        except Cancelled:
+            logger.info('Restore cancelled')
+            self.result_text = 'Restore cancelled.'
+        except Exception as e:
+            logger.error(f'Restore failed: {e}')
+            self.result_text = f'Error: {e}'
+        self.is_running = False
+
+    def start_restore(self):
+        # Restore from the destination folder into a folder of the user's choice
+        if self.is_running:
+            self.progress_label.setText('A job is already running.')
+            return
+        if not self.destination:
+            self.progress_label.setText('Please select the destination folder to restore from.')
+            return
+        try:
+            check_plain(self.destination)
+        except ValueError as e:
+            self.progress_label.setText(str(e))
+            return
+        target = QFileDialog.getExistingDirectory(self, 'Restore To Folder', os.path.expanduser('~'))
+        if not target:
+            return
+        patterns, ok = QInputDialog.getText(
+            self, 'Restore', 'Only these paths or patterns, separated by spaces (empty = everything):')
+        if not ok:
+            return
+        self.progress.setValue(0)
+        self.progress_label.setText('Starting restore...')
+        self.action = 'Restored'
+        self.control = JobControl()
+        self.is_running = True
+        self.thread = threading.Thread(
+            target=self.restore_worker, args=(resolve_backup(self.destination), target, patterns.split()), daemon=True)
+        self.thread.start()
+        self.timer.start(100)
+
+    def toggle_pause(self):
+        # Pause the running backup, or resume it where it stopped
+        if not self.is_running:
+            return
+        if self.control.state == 'paused':
+            self.control.resume()
+            self.pause_btn.setText('⏸')
+            logger.info('Backup resumed')
+        else:
+            self.control.pause()
+            self.pause_btn.setText('▶')
+            logger.info('Backup paused')
+
+    def cancel_backup(self):
+        # Stop the running backup; the current file is abandoned cleanly
+        if self.is_running:
+            self.control.cancel()
+            self.progress_label.setText('Cancelling...')
+
     def run_backup(self):
         # Run the backup worker (for threading)
         self.backup_worker()
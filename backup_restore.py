@@ -0,0 +1,468 @@
+import os
+import sys
+import stat
+import time
+import fnmatch
+import argparse
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_control import Cancelled, gate
+from backup_copy import COPY_TIERS, copy_file, discard_partial, partial_path
+from backup_crypto import check_plain
+from backup_logging import manifest_dir, read_manifest
+from backup_metadata import MetadataQueue
+from backup_pack import PACK_INDEX, pack_dir, packed_entries
+from backup_snapshot import latest_snapshot, snapshot_path
+
+# --------------------------------------------------
+# Restore.
+#
+# The run manifests already list every file a backup holds, so a
+# restore reads them, newest first, instead of walking the
+# destination, and starts copying with the first matching entry.
+# Files are copied back on a pool of threads with the copy engine
+# (same tiers, throttle and job control as a backup); hard links
+# are linked again and symlinks recreated. Packed files are read
+# from their pack at the offset the pack index gives.
+#
+# Files already in place and newer than the backup's copy are left
+# alone unless the restore is told to overwrite them.
+#
+# Encrypted destinations have no plain manifests; they are restored
+# with python backup_crypto.py restore.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+RESTORE_WORKERS = 16
+
+# Copies queued ahead of the pool per worker
+QUEUE_DEPTH = 4
+
+# Manifest actions of files the backup holds afterwards
+PRESENT_ACTIONS = (
+    'copied', 'skipped', 'metadata', 'linked', 'symlink', 'packed'
+)
+
+# Run modes whose complete manifest lists everything the backup holds
+WHOLE_MODES = ('mirror', 'snapshot')
+
+
+def resolve_backup(destination, run_id=None):
+    """Directory to restore from: a snapshot, or the destination."""
+    if run_id and os.path.isdir(snapshot_path(destination, run_id)):
+        return snapshot_path(destination, run_id)
+    if not os.path.isdir(manifest_dir(destination)):
+        return latest_snapshot(destination) or destination
+    return destination
+
+
+def manifests(backup, run_id=None):
+    """Manifests of a backup, newest first; only run_id's if given."""
+    try:
+        names = sorted(os.listdir(manifest_dir(backup)), reverse=True)
+    except FileNotFoundError:
+        return []
+    if run_id and f"{run_id}.jsonl.gz" in names:
+        names = [f"{run_id}.jsonl.gz"]
+    return [
+        os.path.join(manifest_dir(backup), name)
+        for name in names if name.endswith('.jsonl.gz')
+    ]
+
+
+def selected(rel_path, prefixes=(), globs=()):
+    """True if rel_path is under one of prefixes or matches one of globs;
+    with neither, everything is selected."""
+    if not prefixes and not globs:
+        return True
+    for prefix in prefixes:
+        prefix = prefix.strip('/')
+        if rel_path == prefix or rel_path.startswith(prefix + '/'):
+            return True
+    return any(fnmatch.fnmatchcase(rel_path, pattern) for pattern in globs)
+
+
+def backup_entries(backup, prefixes=(), globs=(), run_id=None,
+                   sources=None):
+    """Selected rel_paths of a backup, newest manifest first.
+
+    An incremental run only lists what its sources still hold; files
+    deleted from them since stay in the backup, listed by older runs.
+    So the manifests are read back until a complete mirror or snapshot
+    run, which lists all of the backup. The newest run mentioning a
+    path decides: 'removed' drops it. sources (a dict), if given,
+    collects the source directory of each top-level name. Raises
+    ValueError for an archive run.
+    """
+    # rel_paths already decided, present or removed
+    seen = set()
+    for path in manifests(backup, run_id):
+        complete = False
+        whole = False
+        for entry in read_manifest(path):
+            action = entry.get('action')
+            if entry.get('type') == 'run':
+                if entry.get('mode') == 'archive':
+                    raise ValueError(
+                        f"{path} is an archive run: use backup_archive.py"
+                    )
+                whole = entry.get('mode') in WHOLE_MODES or \
+                    bool(entry.get('mirror_mode'))
+                if sources is not None:
+                    for src in entry.get('source_dirs') or ():
+                        sources.setdefault(
+                            os.path.basename(os.path.normpath(src)), src
+                        )
+            elif entry.get('type') == 'summary':
+                complete = entry.get('status') == 'done'
+            elif action in PRESENT_ACTIONS or action == 'removed':
+                # A run records its removals after its copies, so a
+                # path both kept and removed by one run is kept
+                rel_path = entry['path'].replace(os.sep, '/')
+                if rel_path in seen:
+                    continue
+                seen.add(rel_path)
+                if action != 'removed' and selected(
+                        rel_path, prefixes, globs):
+                    yield rel_path
+        if run_id or (complete and whole):
+            return
+        if not complete:
+            logger.warning(f"Incomplete run, reading older manifests: {path}")
+
+
+def packed_index(backup, prefixes=(), globs=()):
+    """path -> pack index row, for a backup in the packed layout."""
+    if not os.path.exists(os.path.join(pack_dir(backup), PACK_INDEX)):
+        return {}
+    return {
+        row[0]: row for row in packed_entries(backup)
+        if selected(row[0], prefixes, globs)
+    }
+
+
+class Restorer:
+    """Copies a selection of one backup back out.
+
+    target is the directory to restore into (rel_paths below it);
+    without one, files go back to the source directories recorded in
+    the manifest. Files already there with the same size and mtime are
+    skipped, so a restore can simply be run again. Files already there
+    and newer than the backup's copy are skipped too (reason 'newer'),
+    unless overwrite is set.
+
+    report(action, rel_path, **fields) is called from the pool for
+    every file: restored, skipped, failed or cancelled. Raises
+    ValueError for an encrypted backup.
+    """
+
+    def __init__(self, backup, target=None, prefixes=(), globs=(),
+                 run_id=None, workers=RESTORE_WORKERS, throttle=None,
+                 tier='auto', io_mode='normal', stats=None, control=None,
+                 report=None, overwrite=False):
+        check_plain(backup)
+        self.backup = backup
+        self.target = target
+        self.prefixes = list(prefixes)
+        self.globs = list(globs)
+        self.run_id = run_id
+        self.workers = workers
+        self.throttle = throttle
+        self.tier = tier
+        self.io_mode = io_mode
+        self.stats = stats
+        self.control = control
+        self.report = report
+        self.overwrite = overwrite
+        self.metadata = MetadataQueue()
+        self.sources = {}
+        self.packed = self._packed()
+
+        self.lock = threading.Lock()
+        self.created = set()
+        # rel_paths left alone because the file in place is newer
+        self.newer = set()
+        self.started = None
+        self.summary = {
+            'total_files': 0, 'restored_files': 0, 'skipped_files': 0,
+            'newer_files': 0, 'failed_files': 0, 'bytes_restored': 0,
+            'first_file_seconds': None, 'seconds': None
+        }
+
+    def _packed(self):
+        return packed_index(self.backup, self.prefixes, self.globs)
+
+    # ---- selection ----
+    def entries(self):
+        """Selected rel_paths of the backup, newest manifest first."""
+        return backup_entries(
+            self.backup, self.prefixes, self.globs, self.run_id, self.sources
+        )
+
+    def out_path(self, rel_path):
+        if self.target:
+            return os.path.join(self.target, rel_path)
+        base, _, rest = rel_path.partition('/')
+        if base not in self.sources:
+            raise FileNotFoundError(f"No source directory recorded for {base}")
+        return os.path.join(self.sources[base], rest)
+
+    # ---- running ----
+    def run(self):
+        """Restore the selection; returns the summary.
+
+        Raises Cancelled once the copies in flight have stopped.
+        """
+        self.started = time.monotonic()
+        slots = threading.Semaphore(self.workers * QUEUE_DEPTH)
+        # inode -> rel_path of the first file restored for it
+        inodes = {}
+        links = []
+        cancelled = False
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            def submit(func, *args):
+                slots.acquire()
+                future = pool.submit(func, *args)
+                future.add_done_callback(lambda _: slots.release())
+
+            try:
+                for rel_path in self.entries():
+                    if self.control:
+                        self.control.checkpoint()
+                    self.summary['total_files'] += 1
+                    src_file = os.path.join(self.backup, rel_path)
+                    try:
+                        st = os.lstat(src_file)
+                    except FileNotFoundError:
+                        if rel_path in self.packed:
+                            submit(self._unpack, rel_path)
+                        else:
+                            self._done('failed', rel_path, error='missing')
+                        continue
+                    except OSError as e:
+                        self._done('failed', rel_path, error=str(e))
+                        continue
+
+                    row = self.packed.get(rel_path)
+                    if row and st.st_mtime_ns < row[6]:
+                        # The pack holds the newer copy
+                        submit(self._unpack, rel_path)
+                    elif st.st_nlink > 1 and not stat.S_ISLNK(st.st_mode):
+                        key = (st.st_dev, st.st_ino)
+                        if key in inodes:
+                            links.append((inodes[key], rel_path))
+                        else:
+                            inodes[key] = rel_path
+                            submit(self._copy, rel_path, src_file, st)
+                    else:
+                        submit(self._copy, rel_path, src_file, st)
+            except Cancelled:
+                cancelled = True
+
+        if not cancelled:
+            for first, rel_path in links:
+                self._link(first, rel_path)
+        self.metadata.finish()
+        self.summary['newer_files'] = len(self.newer)
+        self.summary['seconds'] = round(time.monotonic() - self.started, 3)
+        if cancelled or (self.control and self.control.cancelled):
+            raise Cancelled()
+        return self.summary
+
+    def _done(self, action, rel_path, size=0, **fields):
+        with self.lock:
+            if action == 'restored':
+                self.summary['restored_files'] += 1
+                self.summary['bytes_restored'] += size
+                if self.summary['first_file_seconds'] is None:
+                    self.summary['first_file_seconds'] = round(
+                        time.monotonic() - self.started, 3
+                    )
+            elif action in ('skipped', 'failed'):
+                self.summary[f"{action}_files"] += 1
+        if action == 'failed':
+            logger.error(f"Restore failed: {rel_path} | {fields.get('error')}")
+        if self.report:
+            self.report(action, rel_path, size=size, **fields)
+
+    def _make_dirs(self, rel_path, out_file):
+        """Create the parents of out_file; they get the times of the
+        backup's directory once all files are in."""
+        out_dir = os.path.dirname(out_file)
+        if out_dir in self.created:
+            return
+        os.makedirs(out_dir, exist_ok=True)
+        with self.lock:
+            if out_dir in self.created:
+                return
+            self.created.add(out_dir)
+        src_dir = os.path.join(self.backup, os.path.dirname(rel_path))
+        if os.path.isdir(src_dir):
+            self.metadata.add_dir(src_dir, out_dir)
+
+    def _kept(self, rel_path, out_file, size, mtime_ns):
+        """Why the file in place is left as it is, or None."""
+        try:
+            st = os.lstat(out_file)
+        except OSError:
+            return None
+        if st.st_size == size and st.st_mtime_ns == mtime_ns:
+            return 'unchanged'
+        if st.st_mtime_ns > mtime_ns and not self.overwrite:
+            logger.info(f"Restore kept newer file: {out_file}")
+            with self.lock:
+                self.newer.add(rel_path)
+            return 'newer'
+        return None
+
+    def _copy(self, rel_path, src_file, st):
+        try:
+            out_file = self.out_path(rel_path)
+            reason = self._kept(rel_path, out_file, st.st_size, st.st_mtime_ns)
+            if reason:
+                self._done('skipped', rel_path, st.st_size, reason=reason)
+                return
+            self._make_dirs(rel_path, out_file)
+            if stat.S_ISLNK(st.st_mode):
+                if os.path.lexists(out_file):
+                    os.unlink(out_file)
+                os.symlink(os.readlink(src_file), out_file)
+                os.utime(
+                    out_file, ns=(st.st_atime_ns, st.st_mtime_ns),
+                    follow_symlinks=False
+                )
+                size = 0
+            else:
+                size, _ = copy_file(
+                    src_file, out_file, self.throttle, self.tier, self.stats,
+                    self.io_mode, self.metadata, self.control
+                )
+        except Cancelled:
+            self._done('cancelled', rel_path)
+            return
+        except Exception as e:
+            self._done('failed', rel_path, error=str(e))
+            return
+        self._done('restored', rel_path, size)
+
+    def _unpack(self, rel_path):
+        _, pack, offset, size, mode, atime_ns, mtime_ns = self.packed[rel_path]
+        hook = gate(self.throttle, self.control)
+        try:
+            if self.control:
+                self.control.checkpoint()
+            out_file = self.out_path(rel_path)
+            reason = self._kept(rel_path, out_file, size, mtime_ns)
+            if reason:
+                self._done('skipped', rel_path, size, reason=reason)
+                return
+            self._make_dirs(rel_path, out_file)
+            fd = os.open(os.path.join(pack_dir(self.backup), pack), os.O_RDONLY)
+            try:
+                data = os.pread(fd, size, offset)
+            finally:
+                os.close(fd)
+            if hook:
+                hook.read(len(data))
+                hook.write(len(data))
+            tmp = partial_path(out_file)
+            try:
+                with open(tmp, 'wb') as out:
+                    out.write(data)
+                os.chmod(tmp, mode)
+                os.utime(tmp, ns=(atime_ns, mtime_ns))
+                os.replace(tmp, out_file)
+            except BaseException:
+                discard_partial(tmp)
+                raise
+        except Cancelled:
+            self._done('cancelled', rel_path)
+            return
+        except Exception as e:
+            self._done('failed', rel_path, error=str(e))
+            return
+        self._done('restored', rel_path, size)
+
+    def _link(self, first, rel_path):
+        try:
+            first_out, out_file = self.out_path(first), self.out_path(rel_path)
+            src_file = os.path.join(self.backup, rel_path)
+            if first in self.newer:
+                # first_out is not the backup's data: copy this name
+                self._copy(rel_path, src_file, os.lstat(src_file))
+                return
+            if os.path.exists(out_file) and os.path.samefile(first_out, out_file):
+                self._done('skipped', rel_path, reason='unchanged')
+                return
+            st = os.lstat(src_file)
+            reason = self._kept(rel_path, out_file, st.st_size, st.st_mtime_ns)
+            if reason:
+                self._done('skipped', rel_path, st.st_size, reason=reason)
+                return
+            self._make_dirs(rel_path, out_file)
+            tmp = partial_path(out_file)
+            try:
+                os.link(first_out, tmp)
+                os.replace(tmp, out_file)
+            except OSError:
+                discard_partial(tmp)
+                # First copy failed or no hard links here: copy it
+                self._copy(rel_path, src_file, st)
+                return
+        except Exception as e:
+            self._done('failed', rel_path, error=str(e))
+            return
+        self._done('restored', rel_path, linked=first)
+
+
+# --------------------------------------------------
+# Command line
+#
+#   python backup_restore.py /mnt/usb/backup --target /tmp/restore
+#   python backup_restore.py /mnt/usb/backup --prefix src/Documents --glob '*.xlsx'
+#   python backup_restore.py /mnt/usb/backup --run-id 20240131-235959-123
+#
+# Without --target, files go back to where they were backed up from.
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Restore files from a backup destination'
+    )
+    parser.add_argument('destination')
+    parser.add_argument('--target')
+    parser.add_argument('--prefix', action='append', default=[])
+    parser.add_argument('--glob', action='append', default=[])
+    parser.add_argument('--run-id')
+    parser.add_argument('--workers', type=int, default=RESTORE_WORKERS)
+    parser.add_argument('--tier', choices=COPY_TIERS, default='auto')
+    # Without it, files newer than the backup's copy are kept
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args(argv)
+
+    backup = resolve_backup(args.destination, args.run_id)
+    try:
+        restorer = Restorer(
+            backup, args.target, args.prefix, args.glob, args.run_id,
+            args.workers, tier=args.tier, overwrite=args.overwrite
+        )
+        summary = restorer.run()
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(
+        f"Restored {summary['restored_files']}/{summary['total_files']} "
+        f"files ({summary['bytes_restored']} bytes) from {backup}, "
+        f"{summary['skipped_files']} skipped "
+        f"({summary['newer_files']} newer in place), "
+        f"{summary['failed_files']} failed | first file after "
+        f"{summary['first_file_seconds']} s, {summary['seconds']} s total"
+    )
+    return 1 if summary['failed_files'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import time
+import errno
+import heapq
+import itertools
+import threading
+import logging
+
+# --------------------------------------------------
+# Deferred retries for transient I/O errors.
+#
+# A copy that fails with a transient errno (busy file, stalled
+# disk, NFS timeout) is put back on a queue with an exponential
+# backoff instead of being counted as failed right away; the
+# job keeps copying other files meanwhile. Out-of-space errors
+# wait until the mirror cleanup has freed space. Anything else
+# (EACCES, ENOENT, ...) fails at once.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+RETRYABLE_ERRNOS = frozenset(
+    getattr(errno, name) for name in (
+        'EBUSY', 'EAGAIN', 'EIO', 'ETIMEDOUT', 'EINTR', 'ESTALE'
+    )
+    if hasattr(errno, name)
+)
+
+# Only worth retrying once something has freed space
+AFTER_CLEANUP_ERRNOS = frozenset(
+    getattr(errno, name) for name in ('ENOSPC', 'EDQUOT')
+    if hasattr(errno, name)
+)
+
+# Attempts per file, the first one included
+MAX_ATTEMPTS = 4
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+
+
+def classify(exc):
+    """'retry', 'cleanup' (retry after freeing space) or 'permanent'."""
+    code = getattr(exc, 'errno', None)
+    if code in RETRYABLE_ERRNOS:
+        return 'retry'
+    if code in AFTER_CLEANUP_ERRNOS:
+        return 'cleanup'
+    return 'permanent'
+
+
+def backoff(attempt):
+    """Delay before attempt number attempt + 1 (attempt >= 1)."""
+    return min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1))
+
+
+def retry_call(func, *args, attempts=MAX_ATTEMPTS, **kwargs):
+    """Call func, retrying transient OSErrors in place with backoff.
+
+    For quick metadata calls (mkdir) that later work depends on.
+    The last error is raised when attempts run out.
+    """
+    for attempt in itertools.count(1):
+        try:
+            return func(*args, **kwargs)
+        except OSError as e:
+            if classify(e) != 'retry' or attempt >= attempts:
+                raise
+            delay = backoff(attempt)
+            logger.warning(f"Retrying in {delay:.0f}s: {e}")
+            time.sleep(delay)
+
+
+class RetryQueue:
+    """Failed work items waiting for another attempt.
+
+    schedule() queues an item after a failure, or returns False when
+    it has to be given up. Items come back from pop_due() once their
+    backoff has passed. With defer_cleanup, out-of-space failures
+    are held until release_deferred(), called after the cleanup.
+    """
+
+    def __init__(self, defer_cleanup=False, max_attempts=MAX_ATTEMPTS):
+        self.cond = threading.Condition()
+        self.defer_cleanup = defer_cleanup
+        self.max_attempts = max_attempts
+        self.heap = []
+        self.deferred = []
+        self.seq = itertools.count()
+        self.scheduled = 0
+
+    def schedule(self, item, attempt, exc):
+        """Queue item, which failed at attempt (1-based) with exc."""
+        kind = classify(exc)
+        if kind == 'permanent' or attempt >= self.max_attempts:
+            return False
+        if kind == 'cleanup' and not self.defer_cleanup:
+            return False
+
+        with self.cond:
+            if kind == 'cleanup':
+                self.deferred.append((item, attempt + 1))
+            else:
+                due = time.monotonic() + backoff(attempt)
+                heapq.heappush(
+                    self.heap, (due, next(self.seq), item, attempt + 1)
+                )
+            self.scheduled += 1
+            self.cond.notify_all()
+        return True
+
+    def pop_due(self):
+        """List of (item, attempt) whose backoff has passed."""
+        now = time.monotonic()
+        due = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, item, attempt = heapq.heappop(self.heap)
+                due.append((item, attempt))
+        return due
+
+    def wait(self, timeout):
+        """Sleep until the next item is due, a new one arrives, or timeout."""
+        with self.cond:
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - time.monotonic())
+            if timeout > 0:
+                self.cond.wait(timeout)
+
+    def release_deferred(self):
+        """Make held out-of-space items due now; later ones fail at once."""
+        with self.cond:
+            self.defer_cleanup = False
+            now = time.monotonic()
+            for item, attempt in self.deferred:
+                heapq.heappush(self.heap, (now, next(self.seq), item, attempt))
+            released = len(self.deferred)
+            self.deferred = []
+        return released
+
+    def pending(self):
+        """Items waiting for their backoff (held ones not included)."""
+        with self.cond:
+            return len(self.heap)
@@ -0,0 +1,171 @@
+import os
+import queue
+import itertools
+import threading
+import collections
+import logging
+
+from backup_control import Cancelled
+from backup_pathindex import ROOT, DirLister, PathIndex
+
+# --------------------------------------------------
+# Parallel directory scanning.
+#
+# On NFS/SMB mounts and busy spinning disks every directory
+# listing costs a round trip, and a walk that lists one
+# directory at a time spends most of its time waiting. Here a
+# pool of threads lists directories with os.scandir; each
+# thread keeps its own deque of directories (depth first) and
+# steals from the others when it runs dry, so hundreds of
+# listings are in flight across all trees being scanned. The
+# thread building a PathIndex receives whole directory listings
+# and adds them one block per directory, parents first.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+SCAN_WORKERS = 16
+
+
+class WorkStealingPool:
+    """Threads running handler(task), one deque of tasks per thread.
+
+    Tasks submitted from a worker go to the end of its own deque and
+    are taken back from there (LIFO); idle workers steal from the
+    front of the others (FIFO), where the bigger subtrees are.
+    """
+
+    def __init__(self, handler, workers=SCAN_WORKERS):
+        self.handler = handler
+        self.deques = [collections.deque() for _ in range(workers)]
+        # One release per queued task: an acquired worker is sure
+        # to find one in some deque
+        self.available = threading.Semaphore(0)
+        self.local = threading.local()
+        self.next_deque = itertools.count()
+        self.closed = False
+        self.threads = [
+            threading.Thread(target=self._run, args=(n,), daemon=True)
+            for n in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, task):
+        n = getattr(self.local, 'n', None)
+        if n is None:
+            n = next(self.next_deque) % len(self.deques)
+        self.deques[n].append(task)
+        self.available.release()
+
+    def _take(self, n):
+        own = self.deques[n]
+        while True:
+            try:
+                return own.pop()
+            except IndexError:
+                pass
+            for k in range(1, len(self.deques)):
+                try:
+                    return self.deques[(n + k) % len(self.deques)].popleft()
+                except IndexError:
+                    continue
+
+    def _run(self, n):
+        self.local.n = n
+        while True:
+            self.available.acquire()
+            if self.closed:
+                return
+            task = self._take(n)
+            try:
+                self.handler(task)
+            except Exception:
+                logger.exception("Scan task failed")
+
+    def close(self):
+        self.closed = True
+        for _ in self.threads:
+            self.available.release()
+
+
+class ParallelScanner:
+    """Builds PathIndexes with a shared WorkStealingPool.
+
+    scan() may be called from several threads at once; all trees
+    share the same listing threads. With a control (JobControl) the
+    listing threads pause with the job; once it is cancelled they
+    stop descending and scan() returns what was listed so far.
+    """
+
+    def __init__(self, workers=SCAN_WORKERS, control=None):
+        self.control = control
+        self.pool = WorkStealingPool(self._list, workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    def scan(self, base_dir, symlinks='preserve', out_of_tree='keep',
+             loops='skip'):
+        """Same result as PathIndex.scan(), listed in parallel."""
+        lister = DirLister(base_dir, symlinks, out_of_tree, loops)
+        results = queue.SimpleQueue()
+        tokens = itertools.count(1)
+        job = (lister, results, tokens)
+        self.pool.submit((job, 0, base_dir, lister.root_ancestors()))
+
+        index = PathIndex()
+        inodes = {}
+        # Listing token -> directory id, set once the parent is added
+        dirs = {0: ROOT}
+        outstanding = 1
+
+        while outstanding:
+            token, files, subdirs = results.get()
+            outstanding -= 1
+            d = dirs.pop(token)
+            if files is not None:
+                index.add_listing(d, files, inodes)
+            # Child ids in name order, like the sequential scan
+            for name, child in sorted(subdirs):
+                dirs[child] = index.add_directory(d, name)
+            outstanding += len(subdirs)
+
+        return index
+
+    def _list(self, task):
+        (lister, results, tokens), token, path, ancestors = task
+        try:
+            if self.control:
+                self.control.checkpoint()
+            listing = lister.list(path, ancestors)
+        except Cancelled:
+            results.put((token, None, []))
+            return
+        except Exception:
+            # The builder still waits for this directory
+            results.put((token, None, []))
+            raise
+
+        if listing is None:
+            results.put((token, None, []))
+            return
+
+        files, subdirs = listing
+        children = [(name, next(tokens), key) for name, key in subdirs]
+        # The parent's listing goes out before any child is queued,
+        # so the builder always knows the parent's id first
+        results.put((
+            token, files, [(name, child) for name, child, _ in children]
+        ))
+        for name, child, key in children:
+            self.pool.submit((
+                (lister, results, tokens), child, os.path.join(path, name),
+                lister.descend(ancestors, key)
+            ))
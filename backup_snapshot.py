@@ -0,0 +1,322 @@
+import os
+import sys
+import time
+import errno
+import shutil
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_logging import MANIFEST_DIR, manifest_status, read_manifest
+
+# --------------------------------------------------
+# Snapshots and retention.
+#
+# In snapshot mode every run writes a complete tree of its own:
+#
+#   <destination>/snapshots/<run_id>/<source>/...
+#   <destination>/snapshots/<run_id>/.backup/manifests/<run_id>.jsonl.gz
+#
+# Files unchanged since the previous snapshot are hard-linked to
+# it instead of copied, so a snapshot costs only the changed data.
+# The link count of an inode is its reference count: a file's
+# space is freed when the last snapshot holding it goes.
+#
+# Retention keeps the last N snapshots plus the newest one of each
+# of the last D days, W weeks and M months. Only complete snapshots
+# (manifest status 'done') count; a cancelled or failed one is
+# pruned once a complete snapshot is newer. Pruning reads the list
+# of files from the snapshot's own manifest instead of walking it,
+# and unlinks them with unlinkat() relative to an open directory
+# fd, many directories at a time.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+SNAPSHOT_DIR = 'snapshots'
+
+RETENTION_RULES = ('keep_last', 'keep_daily', 'keep_weekly', 'keep_monthly')
+
+# Directories unlinked in parallel while pruning
+PRUNE_WORKERS = 16
+
+
+def snapshot_root(destination):
+    return os.path.join(destination, SNAPSHOT_DIR)
+
+
+def snapshot_path(destination, run_id):
+    return os.path.join(snapshot_root(destination), run_id)
+
+
+def snapshot_manifest(snapshot):
+    run_id = os.path.basename(snapshot)
+    return os.path.join(snapshot, MANIFEST_DIR, f"{run_id}.jsonl.gz")
+
+
+def snapshot_status(destination, run_id):
+    """Final status of a snapshot's run ('done', 'cancelled', ...);
+    None for a run that died before finishing its manifest."""
+    return manifest_status(
+        snapshot_manifest(snapshot_path(destination, run_id))
+    )
+
+
+def run_time(run_id):
+    """Local time of a run id ('20240131-235959-123') as struct_time."""
+    return time.strptime(run_id[:15], '%Y%m%d-%H%M%S')
+
+
+def list_snapshots(destination):
+    """Run ids of the snapshots in a destination, oldest first."""
+    try:
+        names = os.listdir(snapshot_root(destination))
+    except FileNotFoundError:
+        return []
+    snapshots = []
+    for name in names:
+        try:
+            run_time(name)
+        except ValueError:
+            continue
+        snapshots.append(name)
+    return sorted(snapshots)
+
+
+def latest_snapshot(destination, before=None):
+    """Path of the newest snapshot (older than run id before), or None."""
+    snapshots = [
+        run_id for run_id in list_snapshots(destination)
+        if before is None or run_id < before
+    ]
+    return snapshot_path(destination, snapshots[-1]) if snapshots else None
+
+
+def select_prune(snapshots, keep_last=0, keep_daily=0, keep_weekly=0,
+                 keep_monthly=0, complete=None):
+    """Run ids to delete under a retention policy, oldest first.
+
+    complete holds the run ids of the complete snapshots (default:
+    all of them); only these count for the rules. A complete snapshot
+    is kept if any rule keeps it; with no rule at all, everything is
+    kept. The newest complete snapshot is always kept. Incomplete
+    ones go once a complete snapshot is newer; a newer one may be a
+    run still in progress.
+    """
+    if not (keep_last or keep_daily or keep_weekly or keep_monthly):
+        return []
+    if complete is None:
+        complete = snapshots
+    complete = set(complete)
+    newest_first = sorted(
+        (run_id for run_id in snapshots if run_id in complete), reverse=True
+    )
+    if not newest_first:
+        return []
+    keep = set(newest_first[:max(1, keep_last)])
+    keep.update(
+        run_id for run_id in snapshots
+        if run_id not in complete and run_id > newest_first[0]
+    )
+
+    buckets = (
+        (keep_daily, lambda t: time.strftime('%Y-%m-%d', t)),
+        (keep_weekly, lambda t: time.strftime('%G-%V', t)),
+        (keep_monthly, lambda t: time.strftime('%Y-%m', t)),
+    )
+    for count, bucket in buckets:
+        seen = set()
+        for run_id in newest_first:
+            if len(seen) >= count:
+                break
+            key = bucket(run_time(run_id))
+            if key not in seen:
+                # The newest snapshot of each bucket
+                seen.add(key)
+                keep.add(run_id)
+
+    return [run_id for run_id in sorted(snapshots) if run_id not in keep]
+
+
+# --------------------------------------------------
+# Garbage collection
+# --------------------------------------------------
+def snapshot_files(snapshot):
+    """{rel_dir: {names}} of every path the snapshot's manifest holds."""
+    by_dir = {}
+    for entry in read_manifest(snapshot_manifest(snapshot)):
+        rel_path = entry.get('path')
+        if rel_path and entry.get('action') != 'removed':
+            rel_dir, name = os.path.split(rel_path)
+            by_dir.setdefault(rel_dir, set()).add(name)
+    return by_dir
+
+
+def _unlink_dir(dir_path, names, links, lock):
+    """Unlink names in one directory; returns (files, bytes freed).
+
+    Bytes count only for inodes losing their last link. Inodes with
+    more links are tallied in links, {(dev, ino): [unlinked, most
+    links seen, bytes]}, shared by the whole snapshot: two of their
+    names can be unlinked at once from different directories.
+    """
+    try:
+        fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        return 0, 0
+    files = freed = 0
+    try:
+        for name in names:
+            try:
+                st = os.stat(name, dir_fd=fd, follow_symlinks=False)
+                os.unlink(name, dir_fd=fd)
+            except FileNotFoundError:
+                continue
+            files += 1
+            if st.st_nlink == 1:
+                freed += st.st_blocks * 512
+                continue
+            with lock:
+                tally = links.setdefault(
+                    (st.st_dev, st.st_ino), [0, 0, st.st_blocks * 512]
+                )
+                tally[0] += 1
+                tally[1] = max(tally[1], st.st_nlink)
+    finally:
+        os.close(fd)
+    return files, freed
+
+
+def delete_snapshot(snapshot, workers=PRUNE_WORKERS):
+    """Delete one snapshot from its manifest; returns (files, bytes freed).
+
+    Directories are emptied in parallel, then removed deepest first.
+    Whatever the manifest does not list (empty directories, a run
+    that died before its manifest was complete) is removed with
+    rmtree, which then only has little left to walk.
+    """
+    try:
+        by_dir = snapshot_files(snapshot)
+    except (OSError, EOFError, ValueError) as e:
+        logger.warning(f"No usable manifest in {snapshot}, walking it | {e}")
+        by_dir = {}
+
+    files = freed = 0
+    links = {}
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for n, b in pool.map(
+            lambda item: _unlink_dir(
+                os.path.join(snapshot, item[0]), item[1], links, lock
+            ),
+            by_dir.items()
+        ):
+            files += n
+            freed += b
+    # Every name was stat()ed before its own unlink, so the most links
+    # seen is at least what the inode had before the prune: it is gone
+    # once that many of its names were unlinked
+    freed += sum(
+        size for unlinked, most, size in links.values() if unlinked >= most
+    )
+
+    dirs = set()
+    for rel_dir in by_dir:
+        while rel_dir:
+            dirs.add(rel_dir)
+            rel_dir = os.path.dirname(rel_dir)
+    for rel_dir in sorted(dirs, key=lambda d: d.count(os.sep), reverse=True):
+        try:
+            os.rmdir(os.path.join(snapshot, rel_dir))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+    shutil.rmtree(snapshot)
+    return files, freed
+
+
+def prune(destination, retention, dry_run=False, workers=PRUNE_WORKERS,
+          done=()):
+    """Apply retention rules to a destination's snapshots.
+
+    done names runs that count as complete although their manifest is
+    not closed yet (the run that prunes). Returns a summary: snapshots
+    deleted, files unlinked, bytes reclaimed and seconds taken.
+    """
+    started = time.monotonic()
+    snapshots = list_snapshots(destination)
+    doomed = select_prune(
+        snapshots, **retention, complete=[
+            run_id for run_id in snapshots
+            if run_id in done or
+            snapshot_status(destination, run_id) == 'done'
+        ]
+    )
+    summary = {
+        'snapshots': doomed, 'files': 0, 'bytes_reclaimed': 0,
+        'seconds': 0.0
+    }
+    if dry_run:
+        return summary
+
+    for run_id in doomed:
+        files, freed = delete_snapshot(
+            snapshot_path(destination, run_id), workers
+        )
+        summary['files'] += files
+        summary['bytes_reclaimed'] += freed
+        logger.info(
+            f"Pruned snapshot {run_id} of {destination}: {files} files, "
+            f"{freed} bytes reclaimed"
+        )
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    return summary
+
+
+# --------------------------------------------------
+# Command line
+#
+#   python backup_snapshot.py list /mnt/usb/backup
+#   python backup_snapshot.py prune /mnt/usb/backup --keep-last 7 --keep-monthly 12
+#   python backup_snapshot.py prune /mnt/usb/backup --keep-daily 14 --dry-run
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List or prune the snapshots of a destination'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list').add_argument('destination')
+    prune_args = sub.add_parser('prune')
+    prune_args.add_argument('destination')
+    for rule in RETENTION_RULES:
+        prune_args.add_argument(
+            '--' + rule.replace('_', '-'), type=int, default=0
+        )
+    prune_args.add_argument('--dry-run', action='store_true')
+    prune_args.add_argument('--workers', type=int, default=PRUNE_WORKERS)
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for run_id in list_snapshots(args.destination):
+            status = snapshot_status(args.destination, run_id)
+            print(f"{run_id} {status or 'incomplete'}")
+        return 0
+
+    retention = {rule: getattr(args, rule) for rule in RETENTION_RULES}
+    summary = prune(args.destination, retention, args.dry_run, args.workers)
+    if args.dry_run:
+        for run_id in summary['snapshots']:
+            print(f"Would delete {run_id}")
+        return 0
+    print(
+        f"Deleted {len(summary['snapshots'])} snapshots, "
+        f"{summary['files']} files, {summary['bytes_reclaimed']} bytes "
+        f"reclaimed in {summary['seconds']} s"
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import platform
+import threading
+import logging
+
+# --------------------------------------------------
+# I/O throttling for backup jobs.
+#
+# A job owns one IOThrottle; every worker thread of that job
+# draws from the same token buckets, so the configured limits
+# are global to the job and not per thread. Limits can be
+# changed at any time while the job is running.
+# --------------------------------------------------
+
+logger = logging.getLogger('app')
+
+LIMIT_KEYS = (
+    'read_bytes_per_sec',
+    'write_bytes_per_sec',
+    'read_files_per_sec',
+    'write_files_per_sec'
+)
+
+# Allow bursts of up to this many seconds worth of tokens
+BURST_SECONDS = 1.0
+
+
+# --------------------------------------------------
+# Token bucket
+# --------------------------------------------------
+class TokenBucket:
+    """Thread-safe token bucket. A rate of 0 means unlimited."""
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = max(0, float(rate or 0))
+            self.tokens = min(self.tokens, self.capacity())
+
+    def capacity(self):
+        return self.rate * BURST_SECONDS
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(
+                self.capacity(),
+                self.tokens + (now - self.last) * self.rate
+            )
+        self.last = now
+
+    def consume(self, amount=1):
+        """Take `amount` tokens, sleeping until they are available.
+
+        Requests larger than the bucket are allowed to drive the
+        balance negative; the caller then waits off the debt, which
+        keeps the long-run rate correct for big chunks.
+        """
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                self._refill()
+                if self.tokens > 0:
+                    self.tokens -= amount
+                    debt = max(0.0, -self.tokens / self.rate)
+                    break
+                # Empty: poll in short steps so a live rate change
+                # (including removing the limit) is picked up quickly.
+                wait = min(max(-self.tokens / self.rate, 0.001), 0.25)
+            time.sleep(wait)
+
+        if debt:
+            time.sleep(debt)
+
+
+class IOThrottle:
+    """Read/write byte and file rate limits shared by a whole job."""
+
+    def __init__(self, limits=None):
+        self.buckets = {key: TokenBucket() for key in LIMIT_KEYS}
+        self.set_limits(limits or {})
+
+    def set_limits(self, limits):
+        """Update any subset of the limits; unknown keys and values
+        that are not numbers >= 0 are rejected (ValueError) before
+        any limit changes."""
+        if not isinstance(limits, dict):
+            raise ValueError("Limits must be an object")
+        unknown = set(limits) - set(LIMIT_KEYS)
+        if unknown:
+            raise ValueError(
+                f"Unknown limit(s): {', '.join(sorted(map(str, unknown)))}"
+            )
+
+        rates = {}
+        for key, value in limits.items():
+            try:
+                # None or '' removes the limit, as 0 does
+                rates[key] = float(value if value not in (None, '') else 0)
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} must be a number") from None
+            # Also rejects NaN
+            if not rates[key] >= 0:
+                raise ValueError(f"{key} must be >= 0")
+        for key, rate in rates.items():
+            self.buckets[key].set_rate(rate)
+
+    def reset(self):
+        self.set_limits({key: 0 for key in LIMIT_KEYS})
+
+    def limits(self):
+        return {key: self.buckets[key].rate for key in LIMIT_KEYS}
+
+    def active(self):
+        return any(bucket.rate for bucket in self.buckets.values())
+
+    def open_read(self):
+        self.buckets['read_files_per_sec'].consume(1)
+
+    def open_write(self):
+        self.buckets['write_files_per_sec'].consume(1)
+
+    def read(self, nbytes):
+        self.buckets['read_bytes_per_sec'].consume(nbytes)
+
+    def write(self, nbytes):
+        self.buckets['write_bytes_per_sec'].consume(nbytes)
+
+
+# --------------------------------------------------
+# ionice / nice
+# --------------------------------------------------
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set syscall numbers per architecture
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+IDLE_NICE = 19
+
+
+def _set_idle_ioprio():
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        return False
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    # who=0 targets the calling thread
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        err = ctypes.get_errno()
+        logger.warning(f"ioprio_set failed: {os.strerror(err)}")
+        return False
+    return True
+
+
+def set_low_priority():
+    """Put the calling thread at idle I/O priority and lowest CPU nice.
+
+    On Linux both settings are per thread, so this must be called
+    from inside every worker thread of the job. Best effort: returns
+    False when the platform does not support it.
+    """
+    if not sys.platform.startswith('linux'):
+        try:
+            os.nice(IDLE_NICE)
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    ok = True
+    try:
+        tid = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, tid, IDLE_NICE)
+    except OSError as e:
+        logger.warning(f"setpriority failed: {e}")
+        ok = False
+
+    return _set_idle_ioprio() and ok
@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+
+# --------------------------------------------------
+# Adaptive concurrency for the copy engine.
+#
+# One ConcurrencyTuner exists per (source device, destination
+# device) pair. It gates how many copies may be in flight and,
+# once per measurement window, hill-climbs that level: additive
+# increase while throughput keeps improving, multiplicative
+# decrease when it drops (AIMD). Spinning disks settle at one
+# or two streams, SSD arrays climb much higher.
+# --------------------------------------------------
+
+MIN_LEVEL = 1
+MAX_LEVEL = 32
+START_LEVEL = 2
+
+# Length of one measurement window in seconds
+WINDOW_SECONDS = 2.0
+
+# Relative change treated as noise
+TOLERANCE = 0.05
+
+# Multiplicative decrease factor on a throughput drop
+BACKOFF = 0.75
+
+# Per-file overhead expressed in bytes, so that small-file and
+# large-file workloads are scored on a single scale
+FILE_COST_BYTES = 64 * 1024
+
+# Stable windows before probing one level higher again
+PROBE_AFTER = 3
+
+# Number of windows kept in the history
+HISTORY_SIZE = 60
+
+
+def device_label(path):
+    """Return a short 'major:minor' label for the device holding path."""
+    dev = os.stat(path).st_dev
+    return f"{os.major(dev)}:{os.minor(dev)}"
+
+
+class ConcurrencyTuner:
+    def __init__(self, name, min_level=MIN_LEVEL, max_level=MAX_LEVEL,
+                 start_level=START_LEVEL, window=WINDOW_SECONDS):
+        self.name = name
+        self.min_level = min_level
+        self.max_level = max_level
+        self.level = max(min_level, min(start_level, max_level))
+        self.window = window
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+
+        self.window_start = time.monotonic()
+        self.window_files = 0
+        self.window_bytes = 0
+        self.prev_score = None
+        self.last_action = 'start'
+        self.stable_windows = 0
+        self.history = []
+
+    # ---- gate ----
+    def acquire(self):
+        """Block until another copy may start on this device pair."""
+        with self.cond:
+            while self.in_flight >= self.level:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, nbytes=0):
+        """Record a finished copy and free its slot."""
+        with self.cond:
+            self.in_flight -= 1
+            self.window_files += 1
+            self.window_bytes += nbytes
+            self._maybe_adjust()
+            self.cond.notify_all()
+
+    # ---- hill climbing ----
+    def _maybe_adjust(self):
+        elapsed = time.monotonic() - self.window_start
+        # Need both a full window and enough completions to be meaningful
+        if elapsed < self.window or self.window_files < self.level:
+            return
+
+        files_per_sec = self.window_files / elapsed
+        bytes_per_sec = self.window_bytes / elapsed
+        score = bytes_per_sec + files_per_sec * FILE_COST_BYTES
+        level_measured = self.level
+
+        if self.prev_score is None:
+            action = 'increase'
+        elif score > self.prev_score * (1 + TOLERANCE):
+            action = 'increase'
+        elif score < self.prev_score * (1 - TOLERANCE):
+            action = 'decrease'
+        elif self.last_action == 'increase':
+            # The extra stream bought nothing: give it back
+            action = 'revert'
+        elif self.stable_windows >= PROBE_AFTER:
+            # Conditions may have changed (e.g. bigger files now)
+            action = 'increase'
+        else:
+            action = 'hold'
+
+        if action in ('hold', 'revert'):
+            self.stable_windows += 1
+        else:
+            self.stable_windows = 0
+
+        if action == 'increase':
+            self.level = min(self.max_level, self.level + 1)
+        elif action == 'decrease':
+            self.level = max(self.min_level, int(self.level * BACKOFF))
+        elif action == 'revert':
+            self.level = max(self.min_level, self.level - 1)
+
+        self.history.append({
+            'time': round(time.time(), 1),
+            'level': level_measured,
+            'files_per_sec': round(files_per_sec, 1),
+            'mb_per_sec': round(bytes_per_sec / (1024 * 1024), 2),
+            'action': action
+        })
+        del self.history[:-HISTORY_SIZE]
+
+        self.prev_score = score
+        self.last_action = action
+        self.window_start = time.monotonic()
+        self.window_files = 0
+        self.window_bytes = 0
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                'level': self.level,
+                'in_flight': self.in_flight,
+                'history': list(self.history)
+            }
@@ -5,8 +5,12 @@ import threading
 import time
 import logging
 
+from backup_control import Cancelled, JobControl
+from backup_copy import copy_file
+from backup_logging import setup_logging
+
 # Configure logging for app.py
-logging.basicConfig(filename='webapp.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging('webapp.log')
 logger = logging.getLogger('app')
 
 # Initialize Flask app
@@ -24,16 +28,21 @@ progress = {
     'error': None
 }
 
+# Pause / resume / cancel switch of the running backup
+control = JobControl()
+
 def count_files(dirs):
     # Count total files in all source directories
     count = 0
     for d in dirs:
         for root, _, files in os.walk(d):
+            control.checkpoint()
             count += len(files)
     return count
 
 def backup_worker(source_dirs, destination):
-    # Worker thread for performing the backup
+    # Worker thread for performing the backup; start_backup() has
+    # given it a new control
     global progress
     progress['status'] = 'running'
     progress['copied_files'] = 0
@@ -56,9 +65,11 @@ def backup_worker(source_dirs, destination):
                 dest_dir = os.path.join(dest_path, rel_path)
                 os.makedirs(dest_dir, exist_ok=True)
                 for file in files:
+                    control.checkpoint()
                     src_file = os.path.join(root, file)
                     dest_file = os.path.join(dest_dir, file)
-                    shutil.copy2(src_file, dest_file)
+                    # Stops mid-file on cancel, leaving no partial file
+                    copy_file(src_file, dest_file, control=control)
                     copied += 1
                     progress['copied_files'] = copied
                     if total_files > 0:
@@ -69,6 +80,9 @@ def backup_worker(source_dirs, destination):
                             progress['eta'] = int(eta)
         logger.info('Backup completed successfully')
         progress['status'] = 'done'
+    except Cancelled:
+        logger.info('Backup cancelled')
+        progress['status'] = 'cancelled'
     except Exception as e:
         logger.error(f'Backup failed: {e}')
         progress['status'] = 'error'
@@ -82,19 +96,56 @@ def index():
 @app.route('/start-backup', methods=['POST'])
 def start_backup():
     # Start the backup process in a new thread
-    global progress
+    global progress, control
     data = request.json
     source_dirs = data.get('source_dirs', [])
     destination = data.get('destination', '')
     if not source_dirs or not destination:
         return jsonify({'status': 'error', 'message': 'Missing source or destination'}), 400
+    if progress['status'] in ('starting', 'running', 'paused', 'cancelling'):
+        return jsonify({'status': 'error', 'message': 'Already running'}), 409
     # Reset progress
     progress['status'] = 'starting'
-    thread = threading.Thread(target=backup_worker, args=(source_dirs, destination))
+    # New before the thread starts, so no pause or cancel of this job
+    # can reach the previous job's control
+    control = JobControl()
+    # Daemon: a running backup must not keep the server from exiting
+    thread = threading.Thread(
+        target=backup_worker, args=(source_dirs, destination), daemon=True
+    )
     thread.start()
     logger.info(f'Backup initiated for sources: {source_dirs} to {destination}')
     return jsonify({'status': 'started'})
 
+@app.route('/pause', methods=['POST'])
+def pause_backup():
+    # Hold the running backup where it is
+    if progress['status'] != 'running':
+        return jsonify({'status': 'error', 'message': 'Not running'}), 409
+    control.pause()
+    progress['status'] = 'paused'
+    logger.info('Backup paused')
+    return jsonify({'status': 'paused'})
+
+@app.route('/resume', methods=['POST'])
+def resume_backup():
+    # Continue a paused backup
+    if progress['status'] != 'paused':
+        return jsonify({'status': 'error', 'message': 'Not paused'}), 409
+    progress['status'] = 'running'
+    control.resume()
+    logger.info('Backup resumed')
+    return jsonify({'status': 'running'})
+
+@app.route('/cancel', methods=['POST'])
+def cancel_backup():
+    # Stop the running backup at the next checkpoint
+    if progress['status'] not in ('running', 'paused'):
+        return jsonify({'status': 'error', 'message': 'Not running'}), 409
+    progress['status'] = 'cancelling'
+    control.cancel()
+    return jsonify({'status': 'cancelling'})
+
 @app.route('/progress', methods=['GET'])
 def get_progress():
     # Return the current backup progress as JSON
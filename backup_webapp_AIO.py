@@ -1,23 +1,75 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 import os
-import shutil
+import bisect
 import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from backup_archive import (
+    ARCHIVE_DIR, CODECS, VOLUME_SIZE, ArchiveWriter, check_volume_size
+)
+from backup_backends import is_remote, open_backend
+from backup_catalog import (
+    CATALOG_DB, SEARCH_LIMIT, Catalog, search as catalog_search
+)
+from backup_cluster import TOKEN_ENV, Coordinator, agent_token
+from backup_compare import (
+    COMPARE_MODES, HashCache, content_equal, copied_digest, data_digest,
+    is_metadata_candidate, update_metadata
+)
+from backup_control import Cancelled, JobControl, gate
+from backup_copy import COPY_TIERS, TierStats, copy_file_multi
+from backup_history import (
+    HISTORY_LIMIT, Phases, baseline as history_baseline, eta_seconds,
+    history as run_history, pair_key, record_run
+)
+from backup_crypto import EncryptedBackend, check_plain
+from backup_download import (
+    FORMATS as DOWNLOAD_FORMATS, Download, parse_range
+)
+from backup_logging import RunManifest, new_run_id, setup_logging
+from backup_pack import (
+    LAYOUTS, PACK_THRESHOLD, PackStore, linked_ids, packable, read_small
+)
+from backup_pagecache import IO_MODES
+from backup_metadata import MetadataQueue
+from backup_order import ORDER_POLICIES, OrderBuffer
+from backup_pathindex import (
+    FILE, LOOP_MODES, OUT_OF_TREE_MODES, ROOT, SYMLINK, SYMLINK_MODES,
+    PathIndex
+)
+from backup_restore import RESTORE_WORKERS, Restorer, manifests as \
+    backup_manifests, resolve_backup
+from backup_retry import RetryQueue, retry_call
+from backup_scan import ParallelScanner
+from backup_snapshot import (
+    RETENTION_RULES, latest_snapshot, prune, snapshot_path
+)
+from backup_throttle import IOThrottle, set_low_priority
+from backup_tuner import ConcurrencyTuner, device_label
 
 # --------------------------------------------------
 # Configuration
 # --------------------------------------------------
 LOG_FILE_NAMES = False
 
+# Digest cache used by the 'hash' compare mode
+HASH_CACHE_DB = 'hashcache.db'
+
+# Trees indexed at once; their directories are listed by one shared
+# pool of backup_scan.SCAN_WORKERS threads
+SCAN_TREES = 8
+
+# incremental and mirror copy file by file; archive writes one
+# compressed, volume-split tar per run (backup_archive.py)
+BACKUP_MODES = ('incremental', 'mirror', 'archive', 'snapshot')
+
 # --------------------------------------------------
 # Logging
 # --------------------------------------------------
-logging.basicConfig(
-    filename='webapp.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+setup_logging('webapp.log')
 logger = logging.getLogger('app')
 
 # --------------------------------------------------
@@ -38,167 +90,1694 @@ progress = {
     'eta': None,
     'percent': 0,
     'status': 'idle',
-    'error': None
+    'error': None,
+    'run_id': None,
+    'bytes_total': 0,
+    'bytes_copied': 0,
+    'bytes_transferred': 0,
+    'metadata_updated': 0,
+    'linked_files': 0,
+    'symlinks': 0,
+    'packed_files': 0,
+    'retried_files': 0,
+    'failures': [],
+    'destinations': {},
+    'concurrency': {}
+}
+
+# Final failures listed in progress['failures']; the manifest has all
+MAX_FAILURES_LISTED = 1000
+
+# I/O limits shared by all worker threads of the running job
+throttle = IOThrottle()
+
+# Options of the running job
+options = {
+    'compare_mode': 'off',
+    'copy_tier': 'auto',
+    'io_mode': 'normal',
+    'symlinks': 'preserve',
+    'out_of_tree': 'keep',
+    'symlink_loops': 'skip',
+    'order': 'tree',
+    'priority_paths': [],
+    'layout': 'files',
+    'pack_threshold': PACK_THRESHOLD
 }
 
+# Throughput per copy tier of the running job
+tier_stats = TierStats()
+
+# Digest cache of the running job ('hash' compare mode only)
+hash_cache = None
+
+# File catalog fed by the manifests of the running job
+catalog = None
+
+# Metadata waiting to be applied after the data of the running job
+metadata = MetadataQueue()
+
+# Per-file manifest of the running job, one per destination
+manifests = {}
+
+# Concurrency tuner per 'src_dev->dest_dev' pair of the running job
+tuners = {}
+
+# PackStore per destination of the running job ('packed' layout)
+packs = {}
+
+# Backend per remote destination (s3://...) of the running job
+backends = {}
+
+# Snapshot mode: new snapshot -> previous snapshot of the same
+# destination, which unchanged files are hard-linked to
+link_dest = {}
+
+# Copies of the running job waiting for another attempt
+retries = RetryQueue()
+
+# Pause / resume / cancel switch of the running job
+control = JobControl()
+
+# Job states in which no new job may start
+ACTIVE_STATES = ('running', 'paused', 'cancelling')
+
 # --------------------------------------------------
 # Helpers
 # --------------------------------------------------
-def should_copy(src_file, dest_file):
-    if not os.path.exists(dest_file):
-        return True
+def scan_sources(source_dirs, destinations):
+    """Index each source and its copy in every destination.
 
-    s = os.stat(src_file)
-    d = os.stat(dest_file)
+    Returns one plan per source. plan['pending'][destination] is a
+    bytearray with a 1 for every source file id that needs copying
+    there: new, different size, or newer mtime. plan['links'] collects
+    the hard links to recreate once their data has been copied. In
+    the packed layout, small files are compared with the pack index
+    (plan['packed'][destination]) instead of the tree. A new snapshot
+    is compared with the previous one.
 
-    return s.st_size != d.st_size or s.st_mtime > d.st_mtime
+    All trees, sources and destination copies alike, are scanned at
+    the same time on one ParallelScanner. Remote destinations are
+    listed by their backend meanwhile.
+    """
+    source_dirs = [src for src in source_dirs if os.path.isdir(src)]
 
+    with ParallelScanner(control=control) as scanner, \
+            ThreadPoolExecutor(max_workers=SCAN_TREES) as builders:
+        sources = {
+            src: builders.submit(
+                scanner.scan, src, options['symlinks'],
+                options['out_of_tree'], options['symlink_loops']
+            )
+            for src in source_dirs
+        }
+        copies = {}
+        for src in source_dirs:
+            for destination in destinations:
+                if destination in backends:
+                    copies[(src, destination)] = builders.submit(
+                        backends[destination].index, os.path.basename(src)
+                    )
+                    continue
+                dest_root = os.path.join(
+                    link_dest.get(destination, destination),
+                    os.path.basename(src)
+                )
+                if os.path.isdir(dest_root):
+                    copies[(src, destination)] = builders.submit(
+                        scanner.scan, dest_root
+                    )
 
-def count_all_files(source_dirs):
-    count = 0
-    for src in source_dirs:
-        if os.path.isdir(src):
-            for _, _, files in os.walk(src):
-                count += len(files)
-    return count
-
+        plans = []
+        for src in source_dirs:
+            dest_indexes = {}
+            for destination in destinations:
+                job = copies.get((src, destination))
+                dest_indexes[destination] = (
+                    job.result() if job else PathIndex()
+                )
+            pack_indexes = {
+                destination: store.path_index(os.path.basename(src))
+                for destination, store in packs.items()
+            }
+            plans.append(make_plan(
+                src, sources[src].result(), dest_indexes, pack_indexes
+            ))
 
-def count_incremental_files(source_dirs, destination):
-    count = 0
-    for src in source_dirs:
-        if not os.path.isdir(src):
-            continue
+    # A cancelled scan returns partial indexes: never act on those
+    control.checkpoint()
+    return plans
 
-        dest_root = os.path.join(destination, os.path.basename(src))
 
-        for root, _, files in os.walk(src):
-            rel = os.path.relpath(root, src)
-            dest_dir = os.path.join(dest_root, rel)
+def make_plan(src, index, dest_indexes, pack_indexes=None):
+    """Plan of one source from its index and {destination: index}.
 
-            for f in files:
-                if should_copy(
-                    os.path.join(root, f),
-                    os.path.join(dest_dir, f)
-                ):
-                    count += 1
-    return count
+    pack_indexes ({destination: index of packed files}) is given in
+    the packed layout.
+    """
+    plan = {
+        'src': src, 'index': index,
+        'dests': {}, 'pending': {}, 'dir_map': {}, 'links': [],
+        'packed': {}, 'linked': linked_ids(index), 'remote_links': []
+    }
+    threshold = options['pack_threshold']
+    linked = plan['linked']
 
+    for destination, dest_index in dest_indexes.items():
+        pending = bytearray(len(index))
+        packed = (pack_indexes or {}).get(destination)
+        for i in index.changed(dest_index):
+            if packed is None or not packable(index, i, threshold, linked):
+                pending[i] = 1
+        if packed is not None:
+            for i in index.changed(packed):
+                if packable(index, i, threshold, linked):
+                    pending[i] = 1
+            plan['packed'][destination] = packed
 
-def build_file_index(base_dir):
-    files = set()
-    for root, _, fs in os.walk(base_dir):
-        for f in fs:
-            files.add(os.path.relpath(os.path.join(root, f), base_dir))
-    return files
+        plan['dests'][destination] = dest_index
+        plan['pending'][destination] = pending
+        # A new snapshot starts out empty
+        plan['dir_map'][destination] = index.map_dirs(
+            PathIndex() if destination in link_dest else dest_index
+        )
 
+    return plan
 
-def mirror_cleanup(source_dirs, destination):
-    removed = 0
 
-    for src in source_dirs:
-        if not os.path.isdir(src):
-            continue
+def mirror_cleanup(plans, destination, manifest=None):
+    """Remove files of the destination that are gone from the source.
 
-        dest_root = os.path.join(destination, os.path.basename(src))
-        if not os.path.isdir(dest_root):
-            continue
+    Uses the indexes taken by scan_sources(); files copied since
+    then exist in the source, so the extras are unchanged. In the
+    packed layout this also drops files that moved between the tree
+    and the packs, once their new copy is in place.
+    """
+    removed = 0
 
-        src_files = build_file_index(src)
-        dest_files = build_file_index(dest_root)
+    for plan in plans:
+        dest_root = os.path.join(destination, os.path.basename(plan['src']))
+        dest_index = plan['dests'][destination]
+        extras = list(dest_index.diff(plan['index']))
+        if destination in plan['packed']:
+            removed += mirror_packs(plan, destination, manifest)
+            extras += tree_copies_packed(plan, destination)
 
-        for rel in dest_files - src_files:
-            path = os.path.join(dest_root, rel)
+        for i in extras:
+            control.checkpoint()
+            path = os.path.join(dest_root, dest_index.file_path(i))
             try:
                 os.remove(path)
                 removed += 1
                 logger.info(f"Removed (mirror): {path}")
+                if manifest:
+                    manifest.record(
+                        'removed', os.path.relpath(path, destination),
+                        size=dest_index.sizes[i]
+                    )
             except Exception as e:
                 logger.error(f"Remove failed: {path} | {e}")
 
     return removed
 
+def tree_copies_packed(plan, destination):
+    """Ids of tree files in the destination that now live in a pack."""
+    index = plan['index']
+    base = os.path.basename(plan['src'])
+    store = packs[destination]
+    stale = []
+    for i, j in index.pairs(plan['dests'][destination]):
+        if j < 0 or not packable(
+                index, i, options['pack_threshold'], plan['linked']):
+            continue
+        row = store.lookup(os.path.join(base, index.file_path(i)))
+        if row == (index.sizes[i], index.mtimes[i]):
+            stale.append(j)
+    return stale
+
+
+def mirror_packs(plan, destination, manifest=None):
+    """Drop pack index rows of files gone from the source, or that
+    grew out of the packs and have their tree copy in place."""
+    index = plan['index']
+    packed = plan['packed'][destination]
+    base = os.path.basename(plan['src'])
+
+    threshold = options['pack_threshold']
+
+    stale = list(packed.diff(index))
+    for i, j in index.pairs(packed):
+        if j < 0 or packable(index, i, threshold, plan['linked']):
+            continue
+        if os.path.lexists(os.path.join(destination, base, index.file_path(i))):
+            stale.append(j)
+    paths = [os.path.join(base, packed.file_path(j)) for j in stale]
+    packs[destination].remove(paths)
+    if manifest:
+        for j, path in zip(stale, paths):
+            manifest.record('removed', path, size=packed.sizes[j], packed=True)
+    return len(paths)
+
 # --------------------------------------------------
 # Worker
 # --------------------------------------------------
-def backup_worker(source_dirs, destination, mirror_mode):
-    global progress
+progress_lock = threading.Lock()
+
+# Upper bound for copy threads; the tuners decide how many are used
+MAX_WORKERS = 32
+
+
+def update_eta():
+    # Caller holds progress_lock
+    done = progress['copied_files'] + progress['failed_files']
+    total = progress['total_files']
+    if total:
+        progress['percent'] = int((done / total) * 100)
+        elapsed = time.time() - progress['start_time']
+        if progress.get('baseline_mb_per_sec') and progress.get('copy_start'):
+            # Bytes left at this pair's usual rate, then at this run's
+            progress['eta'] = eta_seconds(
+                progress['bytes_total'] - progress['bytes_copied'],
+                progress['bytes_copied'],
+                time.time() - progress['copy_start'],
+                progress['baseline_mb_per_sec']
+            )
+        elif done:
+            progress['eta'] = int(elapsed * (total - done) / done)
+
+
+def source_fields(src_file, digest=None):
+    """Catalog fields of a source file just backed up: its mtime_ns,
+    and its digest, taken at copy time or from the hash cache."""
+    st = os.stat(src_file)
+    fields = {'mtime_ns': st.st_mtime_ns}
+    if digest is None and hash_cache is not None:
+        digest = hash_cache.get(src_file, st)
+    if digest:
+        fields['hash'] = digest
+    return fields
+
+
+def wants_digest():
+    """Whether copies are hashed after they are made: only for the
+    hash cache. Hashing for the catalog alone would read every copied
+    file twice; its hash column stays empty then."""
+    return hash_cache is not None
+
+
+def source_stat(src_file):
+    """Stat of a source about to be copied, when its digest will be
+    taken afterwards (see copied_digest); else None."""
+    if not wants_digest():
+        return None
+    try:
+        return os.stat(src_file)
+    except OSError:
+        # The copy reports it
+        return None
+
+
+def record_digest(src_file, src_st, dest_files=()):
+    """Digest of a source just copied from its src_st data; stored in
+    the hash cache, with its copies, when there is one. None if
+    unknown."""
+    if src_st is None:
+        return None
+    try:
+        if hash_cache is not None:
+            return hash_cache.record_copy(src_file, src_st, dest_files)
+        return copied_digest(src_file, src_st)
+    except OSError as e:
+        logger.warning(f"Digest not recorded: {src_file} | {e}")
+        return None
+
+
+def metadata_only(src_file, dest_file):
+    """Update dest in place if only its metadata is out of date."""
+    if options['compare_mode'] == 'off' or not os.path.exists(dest_file):
+        return False
+    if not is_metadata_candidate(os.stat(src_file), os.stat(dest_file)):
+        return False
+    if not content_equal(
+        src_file, dest_file, options['compare_mode'], hash_cache
+    ):
+        return False
+
+    update_metadata(src_file, dest_file, hash_cache)
+    return True
+
+
+def record_failure(destination, rel_path, error, attempts=1, **fields):
+    """Count a file as failed for good and list it in the progress."""
+    code = getattr(error, 'errno', None)
+    manifests[destination].record(
+        'failed', rel_path, error=str(error), errno=code,
+        attempts=attempts, **fields
+    )
+    per_dest = progress['destinations'][destination]
+    with progress_lock:
+        progress['failed_files'] += 1
+        per_dest['failed_files'] += 1
+        if len(progress['failures']) < MAX_FAILURES_LISTED:
+            progress['failures'].append({
+                'destination': destination,
+                'path': rel_path,
+                'error': str(error),
+                'errno': code,
+                'attempts': attempts
+            })
+        update_eta()
+
+
+def record_link(destination, action, rel_path, **fields):
+    """Manifest entry and counters of a hard link or symlink."""
+    manifests[destination].record(action, rel_path, **fields)
+    per_dest = progress['destinations'][destination]
+    with progress_lock:
+        progress['copied_files'] += 1
+        progress['linked_files' if action == 'linked' else 'symlinks'] += 1
+        per_dest['copied_files'] += 1
+        update_eta()
+
+
+def copy_symlink(src_file, targets):
+    """Recreate the symlink src_file at every {destination: dest_file}."""
+    try:
+        st = os.lstat(src_file)
+        link_target = os.readlink(src_file)
+    except OSError as e:
+        st, link_target, error = None, None, e
+
+    for destination, dest_file in targets.items():
+        rel_path = os.path.relpath(dest_file, destination)
+        try:
+            if st is None:
+                raise error
+            if os.path.lexists(dest_file):
+                os.unlink(dest_file)
+            os.symlink(link_target, dest_file)
+            os.utime(
+                dest_file, ns=(st.st_atime_ns, st.st_mtime_ns),
+                follow_symlinks=False
+            )
+        except OSError as e:
+            record_failure(destination, rel_path, e)
+            logger.error(f"Symlink failed: {src_file} -> {dest_file} | {e}")
+            continue
+
+        record_link(destination, 'symlink', rel_path, target=link_target)
+        if LOG_FILE_NAMES:
+            logger.info(f"Symlink: {dest_file} -> {link_target}")
+
+
+def link_hardlinks(plan):
+    """Hard-link the queued files of a plan to their group's first file.
+
+    Runs after all copies: the first file's data is in place by then,
+    whether it was copied in this run or already up to date.
+    """
+    index = plan['index']
+    base = os.path.basename(plan['src'])
+
+    for i, targets in plan['links']:
+        control.checkpoint()
+        first_rel = os.path.join(base, index.file_path(index.hardlinks[i]))
+        for destination, dest_file in targets.items():
+            first = os.path.join(destination, first_rel)
+            rel_path = os.path.relpath(dest_file, destination)
+            try:
+                if not (os.path.exists(dest_file) and
+                        os.path.samefile(first, dest_file)):
+                    # Link next to it, then swap it in atomically
+                    tmp = dest_file + '.backup-link'
+                    if os.path.lexists(tmp):
+                        os.unlink(tmp)
+                    os.link(first, tmp)
+                    os.replace(tmp, dest_file)
+            except OSError as e:
+                record_failure(destination, rel_path, e)
+                logger.error(f"Link failed: {first} -> {dest_file} | {e}")
+                continue
+
+            record_link(
+                destination, 'linked', rel_path,
+                size=index.sizes[i], mtime_ns=index.mtimes[i],
+                target=first_rel
+            )
+
+
+def archive_sources(source_dirs, destinations, settings, low_priority=False):
+    """Archive mode: write all sources into one archive per run.
+
+    The same archive goes to <destination>/archives/ of every
+    destination; sources are read once. Nothing is compared with
+    earlier runs: every archive is complete on its own.
+    """
+    if low_priority:
+        set_low_priority()
+
+    plans = scan_sources(source_dirs, [])
+    total = sum(len(plan['index']) for plan in plans)
+    progress['total_files'] = total
+    progress['bytes_total'] = sum(
+        size for plan in plans
+        for i, size in enumerate(plan['index'].sizes)
+        if plan['index'].kinds[i] == FILE and i not in plan['index'].hardlinks
+    )
+    progress['files_scanned'] = total
+    progress['bytes_scanned'] = progress['bytes_total']
+    progress['copy_start'] = time.time()
+    for destination in destinations:
+        progress['destinations'][destination]['total_files'] = total
+
+    out_dirs = {
+        os.path.join(destination, ARCHIVE_DIR): destination
+        for destination in destinations
+    }
+    writer = ArchiveWriter(
+        out_dirs, progress['run_id'], settings['codec'],
+        settings.get('level'), settings['volume_size'],
+        settings.get('workers'), throttle, control
+    )
+    try:
+        for plan in plans:
+            archive_plan(plan, destinations, writer)
+        summary = writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    progress['bytes_transferred'] = summary['compressed']
+    for out_dir, error in writer.failed.items():
+        progress['destinations'][out_dirs[out_dir]]['error'] = str(error)
+    progress['status'] = 'done'
+    logger.info(
+        f"Archive complete: {progress['copied_files']}/{total} archived "
+        f"to {len(destinations) - len(writer.failed)} destination(s) | "
+        f"{summary['bytes']} bytes, {summary['compressed']} compressed "
+        f"({settings['codec']}), {len(summary['volumes'])} volume(s), "
+        f"{progress['failed_files']} failed",
+        extra={
+            'run_id': progress['run_id'],
+            'copied_files': progress['copied_files'],
+            'failed_files': progress['failed_files'],
+            'bytes_copied': progress['bytes_copied'],
+            'duration': round(time.time() - progress['start_time'], 3)
+        }
+    )
+
+
+def archive_plan(plan, destinations, writer):
+    """Append the directories and files of one plan to the archive."""
+    src = plan['src']
+    base = os.path.basename(src)
+    index = plan['index']
+    # Hard link group -> name the data was archived under
+    archived = {}
+
+    for d in range(index.dir_total()):
+        rel = index.dir_path(d)
+        root = os.path.join(src, rel)
+        arc_dir = os.path.join(base, rel) if rel else base
+        writer.add_dir(root, arc_dir)
+
+        for i in index.files_in(d):
+            control.checkpoint()
+            f = index.file_names[i]
+            src_file = os.path.join(root, f)
+            arcname = os.path.join(arc_dir, f)
+            group = index.hardlinks.get(i, i)
+            size = 0
+            try:
+                if index.kinds[i] == SYMLINK:
+                    writer.add_symlink(src_file, arcname)
+                elif group in archived:
+                    writer.add_link(src_file, arcname, archived[group])
+                else:
+                    size = writer.add_file(src_file, arcname)
+                    archived[group] = arcname
+            except OSError as e:
+                for destination in destinations:
+                    record_failure(destination, arcname, e)
+                logger.error(f"Archive failed: {src_file} | {e}")
+                continue
+
+            for destination in destinations:
+                manifests[destination].record(
+                    'archived', arcname, size=size, mtime_ns=index.mtimes[i]
+                )
+            with progress_lock:
+                progress['copied_files'] += 1
+                progress['bytes_copied'] += size
+                progress['bytes_transferred'] = writer.compressed
+                for destination in destinations:
+                    progress['destinations'][destination]['copied_files'] += 1
+                update_eta()
+
+            if LOG_FILE_NAMES:
+                logger.info(f"Archived: {src_file}")
+
+
+def link_remote(plan):
+    """Store the queued hard links of a plan as server-side copies."""
+    index = plan['index']
+    base = os.path.basename(plan['src'])
+
+    for i, targets in plan['remote_links']:
+        control.checkpoint()
+        first_rel = os.path.join(base, index.file_path(index.hardlinks[i]))
+        for destination, dest_file in targets.items():
+            rel_path = os.path.relpath(dest_file, destination)
+            try:
+                backends[destination].copy(first_rel, rel_path, index.mtimes[i])
+            except Exception as e:
+                record_failure(destination, rel_path, e)
+                logger.error(f"Remote copy failed: {first_rel} -> {dest_file} | {e}")
+                continue
+
+            record_link(
+                destination, 'linked', rel_path,
+                size=index.sizes[i], mtime_ns=index.mtimes[i],
+                target=first_rel
+            )
+
+
+def mirror_remote(plans, destination, manifest=None):
+    """Delete objects of a remote destination gone from the source."""
+    removed = 0
+    for plan in plans:
+        base = os.path.basename(plan['src'])
+        dest_index = plan['dests'][destination]
+        control.checkpoint()
+        extras = {
+            os.path.join(base, dest_index.file_path(i)): dest_index.sizes[i]
+            for i in dest_index.diff(plan['index'])
+        }
+        for rel_path in backends[destination].remove(extras):
+            removed += 1
+            if manifest:
+                manifest.record('removed', rel_path, size=extras[rel_path])
+    logger.info(f"Removed (mirror): {removed} objects from {destination}")
+    return removed
+
+
+def copy_one(src_file, targets, tuner, attempt=1):
+    """Copy one source file to {destination: dest_file} in one read.
+
+    Destinations failing with a transient error are handed to the
+    retry queue; the copy is then retried for those alone.
+    """
+    transferred = 0
+    failed = {}
+    try:
+        # Copies queued before a cancel end here
+        control.checkpoint()
+        for destination, dest_file in list(targets.items()):
+            try:
+                if not metadata_only(src_file, dest_file):
+                    continue
+            except Exception as e:
+                # Fall back to a full copy of this destination
+                logger.warning(f"Compare failed: {dest_file} | {e}")
+                continue
+
+            del targets[destination]
+            manifests[destination].record(
+                'metadata', os.path.relpath(dest_file, destination),
+                size=os.path.getsize(dest_file), **source_fields(src_file)
+            )
+            with progress_lock:
+                progress['copied_files'] += 1
+                progress['metadata_updated'] += 1
+                per_dest = progress['destinations'][destination]
+                per_dest['copied_files'] += 1
+                per_dest['metadata_updated'] += 1
+                update_eta()
+
+            if LOG_FILE_NAMES:
+                logger.info(f"Metadata updated: {dest_file}")
+
+        if not targets:
+            return
+
+        # Taken before the data is read: a digest recorded afterwards
+        # must describe the data that was copied
+        src_st = source_stat(src_file)
+        started = time.monotonic()
+        results = copy_file_multi(
+            src_file, list(targets.values()), throttle,
+            options['copy_tier'], tier_stats, options['io_mode'], metadata,
+            control
+        )
+        duration = round(time.monotonic() - started, 6)
+        fields = None
+
+        copied = [
+            dest_file for dest_file in targets.values()
+            if not isinstance(results[dest_file], Exception)
+        ]
+        digest = record_digest(src_file, src_st, copied) if copied else None
+
+        for destination, dest_file in targets.items():
+            result = results[dest_file]
+            per_dest = progress['destinations'][destination]
+            rel_path = os.path.relpath(dest_file, destination)
+
+            if isinstance(result, Cancelled):
+                # Stopped mid-file; dest_file is untouched
+                manifests[destination].record('cancelled', rel_path)
+                continue
+            if isinstance(result, Exception):
+                failed[destination] = (dest_file, result)
+                continue
+
+            size, written = result
+            transferred += written
+            if fields is None:
+                fields = source_fields(src_file, digest)
+            manifests[destination].record(
+                'copied', rel_path, size=size, transferred=written,
+                duration=duration, **fields
+            )
+            with progress_lock:
+                progress['copied_files'] += 1
+                progress['bytes_copied'] += size
+                progress['bytes_transferred'] += written
+                per_dest['copied_files'] += 1
+                update_eta()
+
+            if LOG_FILE_NAMES:
+                logger.info(f"Copied: {src_file} -> {dest_file}")
+
+        for destination, (dest_file, result) in failed.items():
+            retry_or_fail(
+                copy_one, src_file, destination, dest_file, tuner, attempt,
+                result, duration
+            )
+
+    finally:
+        tuner.release(transferred)
+
+
+def pack_one(src_file, targets, tuner, attempt=1):
+    """Append one small file to the pack of every {destination: dest_file}.
+
+    dest_file only names the file: the data goes to the destination's
+    PackStore under the same relative path.
+    """
+    transferred = 0
+    try:
+        control.checkpoint()
+        started = time.monotonic()
+        hook = gate(throttle, control)
+        fields = None
+        try:
+            st, data = read_small(src_file, hook)
+            error = None
+        except OSError as e:
+            error = e
+
+        for destination, dest_file in targets.items():
+            rel_path = os.path.relpath(dest_file, destination)
+            try:
+                if error:
+                    raise error
+                if hook:
+                    hook.write(len(data))
+                pack, offset = packs[destination].add(rel_path, st, data)
+            except OSError as e:
+                retry_or_fail(
+                    pack_one, src_file, destination, dest_file, tuner,
+                    attempt, e, round(time.monotonic() - started, 6)
+                )
+                continue
+
+            transferred += len(data)
+            if fields is None:
+                fields = {'mtime_ns': st.st_mtime_ns}
+                # Already in memory: hashing it reads nothing
+                if hash_cache is not None or catalog is not None:
+                    fields['hash'] = data_digest(data)
+            manifests[destination].record(
+                'packed', rel_path, size=len(data), pack=pack, offset=offset,
+                **fields
+            )
+            with progress_lock:
+                progress['copied_files'] += 1
+                progress['packed_files'] += 1
+                progress['bytes_copied'] += len(data)
+                progress['bytes_transferred'] += len(data)
+                progress['destinations'][destination]['copied_files'] += 1
+                update_eta()
+
+            if LOG_FILE_NAMES:
+                logger.info(f"Packed: {src_file} -> {pack}+{offset}")
+
+    finally:
+        tuner.release(transferred)
+
+
+def upload_one(src_file, targets, tuner, attempt=1):
+    """Upload one source file to every remote {destination: dest_file}."""
+    transferred = 0
+    fields = None
+    try:
+        control.checkpoint()
+        src_st = source_stat(src_file)
+        for destination, dest_file in targets.items():
+            rel_path = os.path.relpath(dest_file, destination)
+            started = time.monotonic()
+            try:
+                size, sent = backends[destination].upload(
+                    src_file, rel_path, throttle, control
+                )
+            except Cancelled:
+                manifests[destination].record('cancelled', rel_path)
+                continue
+            except Exception as e:
+                retry_or_fail(
+                    upload_one, src_file, destination, dest_file, tuner,
+                    attempt, e, round(time.monotonic() - started, 6)
+                )
+                continue
+
+            transferred += sent
+            if fields is None:
+                fields = source_fields(
+                    src_file, record_digest(src_file, src_st)
+                )
+            # Nothing sent: the object matched by ETag
+            manifests[destination].record(
+                'copied' if sent else 'verified', rel_path, size=size,
+                transferred=sent,
+                duration=round(time.monotonic() - started, 6),
+                **fields
+            )
+            with progress_lock:
+                progress['copied_files'] += 1
+                progress['bytes_copied'] += size
+                progress['bytes_transferred'] += sent
+                progress['destinations'][destination]['copied_files'] += 1
+                update_eta()
+
+            if LOG_FILE_NAMES:
+                logger.info(f"Uploaded: {src_file} -> {dest_file}")
+
+    finally:
+        tuner.release(transferred)
+
+
+def retry_or_fail(func, src_file, destination, dest_file, tuner, attempt,
+                  error, duration):
+    """Queue a failed copy of one destination again, or count it failed."""
+    item = (func, src_file, {destination: dest_file}, tuner)
+    if retries.schedule(item, attempt, error):
+        with progress_lock:
+            progress['retried_files'] += 1
+        logger.warning(
+            f"Copy failed, will retry (attempt {attempt}): "
+            f"{src_file} -> {dest_file} | {error}"
+        )
+        return
+
+    record_failure(
+        destination, os.path.relpath(dest_file, destination),
+        error, attempt, duration=duration
+    )
+    logger.error(f"Copy failed: {src_file} -> {dest_file} | {error}")
+
+
+def resubmit_due(executor):
+    """Hand copies whose retry backoff has passed back to the pool."""
+    for (func, src_file, targets, tuner), attempt in retries.pop_due():
+        tuner.acquire()
+        executor.submit(func, src_file, targets, tuner, attempt)
+
+
+def drain_retries(executor):
+    """Run retries until no copy is in flight and none is waiting."""
+    while True:
+        control.checkpoint()
+        resubmit_due(executor)
+        in_flight = sum(tuner.in_flight for tuner in tuners.values())
+        if not in_flight and not retries.pending():
+            return
+        retries.wait(0.2)
+
+
+def link_previous(previous, dest_file, rel_path):
+    """Hard-link rel_path of the previous snapshot to dest_file.
+
+    False if that cannot be done (file gone, link count limit,
+    filesystem without hard links): the file is then copied.
+    """
+    try:
+        os.link(
+            os.path.join(previous, rel_path), dest_file,
+            follow_symlinks=False
+        )
+        return True
+    except OSError as e:
+        logger.warning(f"Snapshot link failed, copying: {dest_file} | {e}")
+        return False
+
+
+# A copy waiting in an OrderBuffer is (file_id, flags): file_id is
+# its plan's first id plus its index in the plan, flags has PACKED
+# and then one bit per destination it goes to
+PACKED = 1
+
+
+def first_ids(plans):
+    """First file id of each plan, for held_copy()."""
+    firsts = [0]
+    for plan in plans[:-1]:
+        firsts.append(firsts[-1] + len(plan['index']))
+    return firsts
+
+
+def held_copy(plans, firsts, destinations, file_id, flags):
+    """(src_file, targets) of a copy held as (file_id, flags)."""
+    p = bisect.bisect_right(firsts, file_id) - 1
+    plan = plans[p]
+    rel_path = plan['index'].file_path(file_id - firsts[p])
+    base = os.path.basename(plan['src'])
+    targets = {
+        destination: os.path.join(destination, base, rel_path)
+        for n, destination in enumerate(destinations)
+        if flags >> (n + 1) & 1
+    }
+    return os.path.join(plan['src'], rel_path), targets
+
+
+def target_flags(destinations, targets):
+    """held_copy() flags of the destinations in targets."""
+    return sum(
+        1 << (n + 1) for n, destination in enumerate(destinations)
+        if destination in targets
+    )
+
+
+def dispatch_sources(plans, destinations, tuner, executor):
+    """Walk the plans of one device group and queue their copies.
+
+    Copies pass through an OrderBuffer, which reorders them by the
+    job's order policy before they reach the pool.
+    """
+    order = OrderBuffer(options['order'], options['priority_paths'])
+    firsts = first_ids(plans)
+
+    def submit(copies):
+        for file_id, flags in copies:
+            src_file, targets = held_copy(
+                plans, firsts, destinations, file_id, flags
+            )
+            func = pack_one if flags & PACKED else copy_one
+            tuner.acquire()
+            executor.submit(func, src_file, targets, tuner)
+
+    for p, plan in enumerate(plans):
+        src = plan['src']
+        base = os.path.basename(src)
+        index = plan['index']
+
+        for d in range(index.dir_total()):
+            rel = index.dir_path(d)
+            root = os.path.join(src, rel)
+            dest_dirs = {
+                dest: os.path.join(dest, base, rel) for dest in destinations
+            }
+            # Destinations this directory could not be created in
+            dir_errors = {}
+            for destination, dest_dir in dest_dirs.items():
+                # Parents come first, and the destination index tells
+                # which directories already exist: one mkdir at most
+                try:
+                    if d == ROOT:
+                        retry_call(os.makedirs, dest_dir, exist_ok=True)
+                    elif plan['dir_map'][destination][d] < 0:
+                        try:
+                            retry_call(os.mkdir, dest_dir)
+                        except FileExistsError:
+                            pass
+                    metadata.add_dir(root, dest_dir)
+                except OSError as e:
+                    dir_errors[destination] = e
+                    logger.error(f"Directory failed: {dest_dir} | {e}")
+
+            # Copies that failed earlier are due again
+            resubmit_due(executor)
+
+            for i in index.files_in(d):
+                control.checkpoint()
+                f = index.file_names[i]
+                src_file = os.path.join(root, f)
+
+                # Each destination keeps its own incremental decision
+                targets = {}
+                for destination, dest_dir in dest_dirs.items():
+                    dest_file = os.path.join(dest_dir, f)
+                    rel_path = os.path.relpath(dest_file, destination)
+                    pending = plan['pending'][destination][i]
+                    if not pending and destination in link_dest:
+                        # Unchanged: linked to the previous snapshot,
+                        # or copied if that fails
+                        pending = destination in dir_errors or \
+                            not link_previous(
+                                link_dest[destination], dest_file, rel_path
+                            )
+                    if not pending:
+                        manifests[destination].record(
+                            'skipped', rel_path,
+                            size=index.sizes[i], mtime_ns=index.mtimes[i]
+                        )
+                    elif destination in dir_errors:
+                        record_failure(
+                            destination, rel_path, dir_errors[destination]
+                        )
+                    else:
+                        targets[destination] = dest_file
+
+                if not targets:
+                    continue
+
+                if index.kinds[i] == SYMLINK:
+                    copy_symlink(src_file, targets)
+                    continue
+                if i in index.hardlinks:
+                    # Linked once the group's first file is copied
+                    plan['links'].append((i, targets))
+                    continue
+
+                flags = target_flags(destinations, targets)
+                if packs and packable(
+                        index, i, options['pack_threshold'], plan['linked']):
+                    flags |= PACKED
+                submit(order.push(
+                    firsts[p] + i, flags, os.path.join(base, rel, f),
+                    index.sizes[i], index.mtimes[i]
+                ))
+
+    submit(order.drain())
+
+
+def dispatch_remote(plans, destinations, tuner, executor):
+    """Walk the plans of one backend destination and queue the uploads.
+
+    Backends (object stores, encrypted directories) store files only:
+    symlinks are skipped and hard links become backend copies once
+    the group's first file is stored.
+    """
+    order = OrderBuffer(options['order'], options['priority_paths'])
+    firsts = first_ids(plans)
+
+    def submit(copies):
+        for file_id, flags in copies:
+            src_file, targets = held_copy(
+                plans, firsts, destinations, file_id, flags
+            )
+            tuner.acquire()
+            executor.submit(upload_one, src_file, targets, tuner)
+
+    for p, plan in enumerate(plans):
+        src = plan['src']
+        base = os.path.basename(src)
+        index = plan['index']
+
+        for d in range(index.dir_total()):
+            rel = index.dir_path(d)
+            resubmit_due(executor)
+
+            for i in index.files_in(d):
+                control.checkpoint()
+                f = index.file_names[i]
+                targets = {}
+                for destination in destinations:
+                    dest_file = os.path.join(destination, base, rel, f)
+                    rel_path = os.path.relpath(dest_file, destination)
+                    if not plan['pending'][destination][i]:
+                        manifests[destination].record(
+                            'skipped', rel_path,
+                            size=index.sizes[i], mtime_ns=index.mtimes[i]
+                        )
+                    elif index.kinds[i] == SYMLINK:
+                        manifests[destination].record(
+                            'skipped', rel_path, reason='symlink'
+                        )
+                    else:
+                        targets[destination] = dest_file
+
+                if not targets:
+                    continue
+                if i in index.hardlinks:
+                    plan['remote_links'].append((i, targets))
+                    continue
+
+                submit(order.push(
+                    firsts[p] + i, target_flags(destinations, targets),
+                    os.path.join(base, rel, f),
+                    index.sizes[i], index.mtimes[i]
+                ))
+
+    submit(order.drain())
+
+
+def group_by_device(plans, destinations):
+    """Map 'src_dev->dest_dev[+dest_dev]' labels to (plans, destinations).
+
+    Local destinations are written together, one group per source
+    device; every remote destination gets groups of its own.
+    """
+    local = [d for d in destinations if d not in backends]
+    for destination in local:
+        retry_call(os.makedirs, destination, exist_ok=True)
+    dest_devs = '+'.join(device_label(d) for d in local)
+
+    groups = {}
+    for plan in plans:
+        src_dev = device_label(plan['src'])
+        if local:
+            groups.setdefault(
+                f"{src_dev}->{dest_devs}", ([], local)
+            )[0].append(plan)
+        for destination in backends:
+            groups.setdefault(
+                f"{src_dev}->{backends[destination].label}",
+                ([], [destination])
+            )[0].append(plan)
+    return groups
+
+
+def backup_worker(source_dirs, destinations, mirror_mode, low_priority=False,
+                  compare_mode='off', copy_tier='auto', io_mode='normal',
+                  symlinks='preserve', out_of_tree='keep',
+                  symlink_loops='skip', order='tree', priority_paths=(),
+                  archive=None, layout='files', pack_threshold=PACK_THRESHOLD,
+                  remote_options=None, encryption=None, snapshot=None):
+    """Run one job; archive (codec, volume_size, ...) selects archive mode.
+
+    remote_options are passed to the backends of remote destinations
+    (endpoint_url, region, ...). encryption (passphrase or keyfile)
+    writes the local destinations through an EncryptedBackend.
+    snapshot (retention rules, possibly none) selects snapshot mode:
+    each destination gets a new snapshot, and old ones are pruned
+    once it is complete.
+    """
+    remote_options = remote_options or {}
+    global progress, tuners, hash_cache, manifests, tier_stats, metadata
+    global retries, control, packs, backends, link_dest, catalog
+
+    options['compare_mode'] = compare_mode
+    options['copy_tier'] = copy_tier
+    options['io_mode'] = io_mode
+    options['symlinks'] = symlinks
+    options['out_of_tree'] = out_of_tree
+    options['symlink_loops'] = symlink_loops
+    options['order'] = order
+    options['priority_paths'] = list(priority_paths)
+    options['layout'] = layout
+    options['pack_threshold'] = pack_threshold
+    tier_stats = TierStats()
+    metadata = MetadataQueue()
+    control = JobControl()
+    # Out-of-space copies can only succeed after a mirror cleanup
+    retries = RetryQueue(defer_cleanup=mirror_mode)
+    if compare_mode == 'hash':
+        hash_cache = HashCache(HASH_CACHE_DB)
+    try:
+        catalog = Catalog(CATALOG_DB)
+    except Exception as e:
+        # The backup itself does not need it
+        logger.warning(f"Catalog unavailable: {e}")
+
+    run_id = new_run_id()
+    phases = Phases()
+    snapshot_of = {}
+    if snapshot is not None:
+        # The new snapshots stand in for the destinations
+        for destination in destinations:
+            new = snapshot_path(destination, run_id)
+            snapshot_of[new] = destination
+            previous = latest_snapshot(destination)
+            if previous:
+                link_dest[new] = previous
+        destinations = list(snapshot_of)
 
     progress.update({
         'status': 'running',
+        'job': 'backup',
         'copied_files': 0,
         'failed_files': 0,
         'removed_files': 0,
         'percent': 0,
         'eta': None,
         'start_time': time.time(),
-        'error': None
+        'error': None,
+        'run_id': run_id,
+        'bytes_copied': 0,
+        'bytes_transferred': 0,
+        'metadata_updated': 0,
+        'linked_files': 0,
+        'symlinks': 0,
+        'packed_files': 0,
+        'retried_files': 0,
+        'pruned': {},
+        'failures': [],
+        'files_scanned': 0,
+        'bytes_scanned': 0,
+        'copy_start': None,
+        'baseline_mb_per_sec': None,
+        'history': None,
+        'destinations': {
+            d: {
+                'total_files': 0,
+                'copied_files': 0,
+                'failed_files': 0,
+                'removed_files': 0,
+                'metadata_updated': 0
+            }
+            for d in destinations
+        }
     })
 
+    mode = (
+        'archive' if archive else 'mirror' if mirror_mode else
+        'snapshot' if snapshot is not None else 'incremental'
+    )
+    # Snapshots count as runs of their destination
+    pair = pair_key(source_dirs, [snapshot_of.get(d, d) for d in destinations])
+    try:
+        progress['baseline_mb_per_sec'] = history_baseline(pair)
+    except Exception as e:
+        logger.warning(f"Run history unavailable: {e}")
     logger.info(
-        f"Backup started | Mode: {'MIRROR' if mirror_mode else 'INCREMENTAL'}"
+        f"Backup started | Mode: {mode.upper()}"
+        f" | Destinations: {destinations}"
+        f" | Limits: {throttle.limits()} | Low priority: {low_priority}"
+        f" | Compare: {compare_mode} | Copy tier: {copy_tier}"
+        f" | I/O mode: {io_mode} | Symlinks: {symlinks}"
+        f" (out of tree: {out_of_tree}, loops: {symlink_loops})"
+        f" | Order: {order} | Layout: {layout}",
+        extra={'run_id': progress['run_id']}
     )
 
     try:
-        total_before = count_all_files(source_dirs)
-        total_after = count_incremental_files(source_dirs, destination)
+        backends = {
+            d: open_backend(d, **remote_options)
+            for d in destinations if is_remote(d)
+        }
+        if encryption:
+            for d in destinations:
+                if d not in backends:
+                    backends[d] = EncryptedBackend(d, **encryption)
+        # Remote manifests are written locally, then stored remotely
+        manifests = {
+            d: RunManifest(
+                backends[d].state_dir if d in backends else d,
+                progress['run_id'],
+                # Snapshots are catalogued under their destination
+                catalog=catalog and catalog.run(
+                    snapshot_of.get(d, d), progress['run_id']
+                ),
+                source_dirs=source_dirs, mirror_mode=mirror_mode,
+                mode=mode, archive=archive
+            )
+            for d in destinations
+        }
+
+        if archive:
+            with phases('archive'):
+                archive_sources(
+                    source_dirs, destinations, archive, low_priority
+                )
+            return
+
+        if layout == 'packed':
+            packs = {
+                d: PackStore(d, progress['run_id'])
+                for d in destinations if d not in backends
+            }
+
+        with phases('scan'):
+            plans = scan_sources(source_dirs, destinations)
+
+        total_before = sum(len(plan['index']) for plan in plans)
+        progress['files_scanned'] = total_before
+        progress['bytes_scanned'] = sum(
+            sum(plan['index'].sizes) for plan in plans
+        )
+        total_after = 0
+        total_bytes = 0
+        for destination in destinations:
+            count = 0
+            for plan in plans:
+                pending = plan['pending'][destination]
+                index = plan['index']
+                count += pending.count(1)
+                if destination in backends:
+                    # Stored nowhere: dispatch_remote skips them
+                    count -= sum(
+                        1 for i, flag in enumerate(pending)
+                        if flag and index.kinds[i] == SYMLINK
+                    )
+                # Links and symlinks carry no data of their own
+                total_bytes += sum(
+                    index.sizes[i] for i, flag in enumerate(pending)
+                    if flag and index.kinds[i] != SYMLINK and
+                    i not in index.hardlinks
+                )
+            progress['destinations'][destination]['total_files'] = count
+            total_after += count
         progress['total_files'] = total_after
+        progress['bytes_total'] = total_bytes
+        progress['copy_start'] = time.time()
 
-        copied = 0
+        groups = group_by_device(plans, destinations)
+        tuners = {label: ConcurrencyTuner(label) for label in groups}
 
-        for src in source_dirs:
-            if not os.path.isdir(src):
-                continue
+        with ThreadPoolExecutor(
+            max_workers=MAX_WORKERS,
+            initializer=set_low_priority if low_priority else None
+        ) as executor, ThreadPoolExecutor(
+            max_workers=max(1, len(groups))
+        ) as dispatchers:
+            with phases('copy'):
+                # One dispatcher per device group, so a slow disk does
+                # not hold back sources that live on another one
+                jobs = [
+                    dispatchers.submit(
+                        dispatch_remote if dests[0] in backends
+                        else dispatch_sources,
+                        group, dests, tuners[label], executor
+                    )
+                    for label, (group, dests) in groups.items()
+                ]
+                for job in jobs:
+                    job.result()
+                drain_retries(executor)
 
-            dest_root = os.path.join(destination, os.path.basename(src))
-            os.makedirs(dest_root, exist_ok=True)
+            with phases('links'):
+                for plan in plans:
+                    link_hardlinks(plan)
+                    if backends:
+                        link_remote(plan)
 
-            for root, _, files in os.walk(src):
-                rel = os.path.relpath(root, src)
-                dest_dir = os.path.join(dest_root, rel)
-                os.makedirs(dest_dir, exist_ok=True)
+            with phases('metadata'):
+                metadata.flush()
 
-                for f in files:
-                    src_file = os.path.join(root, f)
-                    dest_file = os.path.join(dest_dir, f)
+            if mirror_mode:
+                with phases('mirror'):
+                    for destination in destinations:
+                        cleanup = (
+                            mirror_remote if destination in backends
+                            else mirror_cleanup
+                        )
+                        removed = cleanup(
+                            plans, destination, manifests[destination]
+                        )
+                        progress['destinations'][destination][
+                            'removed_files'] = removed
+                        progress['removed_files'] += removed
 
-                    if not should_copy(src_file, dest_file):
-                        continue
+                    # Copies that ran out of space get one more go now
+                    if retries.release_deferred():
+                        drain_retries(executor)
 
-                    try:
-                        shutil.copy2(src_file, dest_file)
-                        copied += 1
-                        progress['copied_files'] = copied
+        # Directory times last: removals and new files above would
+        # otherwise change them again
+        with phases('metadata'):
+            metadata.finish()
 
-                        if LOG_FILE_NAMES:
-                            logger.info(f"Copied: {src_file}")
+        # Old snapshots go only once the new ones are complete
+        if snapshot and not progress['failed_files']:
+            with phases('prune'):
+                for destination in snapshot_of.values():
+                    # This run's manifest is closed further down
+                    progress['pruned'][destination] = prune(
+                        destination, snapshot, done=[progress['run_id']]
+                    )
 
-                    except Exception as e:
-                        progress['failed_files'] += 1
-                        logger.error(f"Copy failed: {src_file} | {e}")
+        progress['status'] = 'done'
+        logger.info(
+            f"Backup complete: {progress['copied_files']}/{total_after} copied "
+            f"to {len(destinations)} destination(s) "
+            f"({total_before} total scanned) | "
+            f"{progress['bytes_copied']} bytes, "
+            f"{progress['bytes_transferred']} transferred, "
+            f"{progress['metadata_updated']} metadata-only, "
+            f"{progress['linked_files']} hard-linked, "
+            f"{progress['symlinks']} symlinks, "
+            f"{progress['packed_files']} packed, "
+            f"{progress['failed_files']} failed "
+            f"({progress['retried_files']} retries), "
+            f"{sum(len(p['snapshots']) for p in progress['pruned'].values())}"
+            f" snapshots pruned "
+            f"({sum(p['bytes_reclaimed'] for p in progress['pruned'].values())}"
+            f" bytes reclaimed) | "
+            f"{metadata.applied} metadata applied "
+            f"({metadata.failed} failed) | "
+            f"Tiers: {tier_stats.snapshot()} | Concurrency: "
+            + ', '.join(
+                f"{label}={tuner.level}" for label, tuner in tuners.items()
+            ),
+            extra={
+                'run_id': progress['run_id'],
+                'copied_files': progress['copied_files'],
+                'failed_files': progress['failed_files'],
+                'bytes_copied': progress['bytes_copied'],
+                'duration': round(time.time() - progress['start_time'], 3)
+            }
+        )
 
-                    if total_after:
-                        progress['percent'] = int((copied / total_after) * 100)
-                        elapsed = time.time() - progress['start_time']
-                        if copied:
-                            progress['eta'] = int(
-                                elapsed * (total_after - copied) / copied
-                            )
+    except Cancelled:
+        progress['status'] = 'cancelled'
+        logger.warning(
+            f"Backup cancelled: {progress['copied_files']}/"
+            f"{progress['total_files']} copied",
+            extra={'run_id': progress['run_id']}
+        )
 
-        if mirror_mode:
-            progress['removed_files'] = mirror_cleanup(
-                source_dirs, destination
+    except Exception as e:
+        progress['status'] = 'error'
+        progress['error'] = str(e)
+        logger.exception("Backup failed")
+
+    finally:
+        # Files copied so far keep their times and modes, also after a
+        # cancel or an error: without them the next run would take them
+        # for newer than the source. A no-op once the job has finished
+        try:
+            metadata.finish()
+        except Exception:
+            logger.exception("Metadata not applied")
+
+        # Packed data is synced before the index points to it; what
+        # was packed before a cancel or an error is kept
+        for destination, store in packs.items():
+            try:
+                store.close()
+            except Exception:
+                logger.exception(f"Pack index not saved: {destination}")
+        packs = {}
+
+        for destination, manifest in manifests.items():
+            manifest.close(
+                status=progress['status'],
+                **progress['destinations'][destination]
+            )
+            if destination in backends:
+                try:
+                    backends[destination].put_file(
+                        manifest.path,
+                        os.path.relpath(manifest.path,
+                                        backends[destination].state_dir)
+                    )
+                except Exception:
+                    logger.exception(f"Manifest not stored: {destination}")
+        manifests = {}
+
+        # Before the backends go: their labels name the devices
+        save_history('backup', pair, phases, snapshot_of)
+
+        for backend in backends.values():
+            backend.close()
+        backends = {}
+        link_dest = {}
+
+        if hash_cache is not None:
+            hash_cache.close()
+            hash_cache = None
+
+        # The manifests above have written their last entries
+        if catalog is not None:
+            catalog.close()
+            catalog = None
+
+def save_history(kind, pair, phases, snapshot_of=None):
+    """Store the finished job in the run history; flags regressions."""
+    snapshot_of = snapshot_of or {}
+    devices = {}
+    for destination in progress['destinations']:
+        name = snapshot_of.get(destination, destination)
+        try:
+            devices[name] = (
+                backends[destination].label if destination in backends
+                else device_label(destination)
+            )
+        except OSError:
+            devices[name] = None
+    try:
+        progress['history'] = record_run({
+            'run_id': progress['run_id'],
+            'kind': kind,
+            'pair': pair,
+            'started': progress['start_time'],
+            'finished': time.time(),
+            'status': progress['status'],
+            'devices': devices,
+            'phases': phases.seconds,
+            'files_scanned': progress.get('files_scanned'),
+            'bytes_scanned': progress.get('bytes_scanned'),
+            'files_copied': progress['copied_files'],
+            'bytes_copied': progress['bytes_copied'],
+            'failed_files': progress['failed_files'],
+            'copy_seconds': phases.seconds.get(
+                'copy', phases.seconds.get('archive')
             )
+        })
+    except Exception:
+        logger.exception("Run history not saved")
+
+
+def restore_worker(backup, target=None, prefixes=(), globs=(), run_id=None,
+                   workers=RESTORE_WORKERS, copy_tier='auto',
+                   io_mode='normal', overwrite=False):
+    """Run one restore job; progress counts restored files as copied.
+
+    Files in place that are newer than the backup's copy are kept
+    unless overwrite is set.
+    """
+    global control, tier_stats
+
+    tier_stats = TierStats()
+    control = JobControl()
+    progress.update({
+        'status': 'running',
+        'job': 'restore',
+        'total_files': 0,
+        'copied_files': 0,
+        'failed_files': 0,
+        'skipped_files': 0,
+        'removed_files': 0,
+        'metadata_updated': 0,
+        'linked_files': 0,
+        'symlinks': 0,
+        'bytes_copied': 0,
+        'percent': 0,
+        'eta': None,
+        'start_time': time.time(),
+        'error': None,
+        'run_id': new_run_id(),
+        'failures': [],
+        'destinations': {},
+        'files_scanned': None,
+        'bytes_scanned': None,
+        'copy_start': None,
+        'baseline_mb_per_sec': None,
+        'history': None,
+        'restore': None
+    })
+    phases = Phases()
+    logger.info(
+        f"Restore started | From: {backup} | To: {target or 'original location'}"
+        f" | Prefixes: {list(prefixes)} | Globs: {list(globs)}",
+        extra={'run_id': progress['run_id']}
+    )
+
+    def report(action, rel_path, size=0, error=None, linked=None, **fields):
+        with progress_lock:
+            if action == 'failed':
+                progress['failed_files'] += 1
+                if len(progress['failures']) < MAX_FAILURES_LISTED:
+                    progress['failures'].append({
+                        'destination': target, 'path': rel_path,
+                        'error': error
+                    })
+            elif action != 'cancelled':
+                progress['copied_files'] += 1
+                progress['bytes_copied'] += size
+                if action == 'skipped':
+                    progress['skipped_files'] += 1
+                elif linked:
+                    progress['linked_files'] += 1
+            progress['total_files'] = restorer.summary['total_files']
+            update_eta()
 
+    restorer = Restorer(
+        backup, target, prefixes, globs, run_id, workers, throttle,
+        copy_tier, io_mode, tier_stats, control, report, overwrite
+    )
+    try:
+        with phases('copy'):
+            summary = restorer.run()
+        progress['restore'] = summary
+        progress['total_files'] = summary['total_files']
         progress['status'] = 'done'
         logger.info(
-            f"Backup complete: {copied}/{total_after} copied "
-            f"({total_before} total scanned)"
+            f"Restore complete: {summary['restored_files']}/"
+            f"{summary['total_files']} restored "
+            f"({summary['skipped_files']} skipped, "
+            f"{summary['newer_files']} of them newer in place, "
+            f"{summary['failed_files']} failed), "
+            f"{summary['bytes_restored']} bytes | first file after "
+            f"{summary['first_file_seconds']} s, {summary['seconds']} s total"
+            f" | Tiers: {tier_stats.snapshot()}",
+            extra={
+                'run_id': progress['run_id'],
+                'copied_files': summary['restored_files'],
+                'failed_files': summary['failed_files'],
+                'bytes_copied': summary['bytes_restored'],
+                'duration': summary['seconds']
+            }
+        )
+
+    except Cancelled:
+        progress['status'] = 'cancelled'
+        progress['restore'] = restorer.summary
+        logger.warning(
+            f"Restore cancelled: {progress['copied_files']}/"
+            f"{progress['total_files']} restored",
+            extra={'run_id': progress['run_id']}
         )
 
     except Exception as e:
         progress['status'] = 'error'
         progress['error'] = str(e)
-        logger.exception("Backup failed")
+        logger.exception("Restore failed")
+
+    finally:
+        save_history(
+            'restore', pair_key([backup], [target or 'original location']),
+            phases
+        )
+
+def cluster_worker(source_dirs, destination, agents, copy_tier='auto',
+                   io_mode='normal', symlinks='preserve'):
+    """Run one incremental backup sharded over agents (backup_cluster).
+
+    Files found unchanged count as copied, as in a restore.
+    """
+    global control, catalog
+
+    control = JobControl()
+    try:
+        catalog = Catalog(CATALOG_DB)
+    except Exception as e:
+        logger.warning(f"Catalog unavailable: {e}")
+    run_id = new_run_id()
+    progress.update({
+        'status': 'running',
+        'job': 'backup',
+        'total_files': 0,
+        'copied_files': 0,
+        'failed_files': 0,
+        'skipped_files': 0,
+        'removed_files': 0,
+        'metadata_updated': 0,
+        'linked_files': 0,
+        'symlinks': 0,
+        'bytes_copied': 0,
+        'bytes_total': 0,
+        'percent': 0,
+        'eta': None,
+        'start_time': time.time(),
+        'error': None,
+        'run_id': run_id,
+        'failures': [],
+        'destinations': {destination: {}},
+        'files_scanned': None,
+        'bytes_scanned': None,
+        'copy_start': None,
+        'baseline_mb_per_sec': None,
+        'history': None,
+        'cluster': None
+    })
+    logger.info(
+        f"Cluster backup started | Destination: {destination}"
+        f" | Agents: {agents} | Copy tier: {copy_tier} | I/O mode: {io_mode}",
+        extra={'run_id': run_id}
+    )
+
+    def report(summary):
+        with progress_lock:
+            progress['total_files'] = summary['total_files']
+            progress['files_scanned'] = summary['total_files']
+            progress['bytes_scanned'] = summary['bytes_total']
+            progress['copied_files'] = (
+                summary['copied_files'] + summary['skipped_files']
+            )
+            for key in ('skipped_files', 'failed_files', 'linked_files',
+                        'bytes_copied'):
+                progress[key] = summary[key]
+            progress['cluster'] = {
+                key: summary[key] for key in (
+                    'shards_total', 'shards_done', 'shards_failed',
+                    'reassigned', 'agents'
+                )
+            }
+            update_eta()
+
+    coordinator = Coordinator(
+        agents, source_dirs, destination, run_id,
+        options={
+            'copy_tier': copy_tier, 'io_mode': io_mode, 'symlinks': symlinks
+        },
+        control=control, report=report,
+        catalog=catalog and catalog.run(destination, run_id)
+    )
+    try:
+        summary = coordinator.run()
+        report(summary)
+        progress['status'] = 'done'
+        if summary['shards_failed']:
+            progress['status'] = 'error'
+            progress['error'] = f"{summary['shards_failed']} shards failed"
+        logger.info(
+            f"Cluster backup complete: {summary['copied_files']} copied, "
+            f"{summary['skipped_files']} unchanged, "
+            f"{summary['failed_files']} failed | "
+            f"{summary['shards_done']}/{summary['shards_total']} shards, "
+            f"{summary['reassigned']} reassigned",
+            extra={
+                'run_id': run_id,
+                'copied_files': summary['copied_files'],
+                'failed_files': summary['failed_files'],
+                'bytes_copied': summary['bytes_copied'],
+                'duration': round(time.time() - progress['start_time'], 2)
+            }
+        )
+
+    except Cancelled:
+        progress['status'] = 'cancelled'
+        logger.warning(
+            f"Cluster backup cancelled: {progress['copied_files']}/"
+            f"{progress['total_files']} done",
+            extra={'run_id': run_id}
+        )
+
+    except Exception as e:
+        progress['status'] = 'error'
+        progress['error'] = str(e)
+        logger.exception("Cluster backup failed")
+
+    finally:
+        save_history(
+            'backup', pair_key(source_dirs, [destination]),
+            coordinator.phases
+        )
+        if catalog is not None:
+            catalog.close()
+            catalog = None
 
 # --------------------------------------------------
 # Routes
@@ -212,15 +1791,187 @@ def index():
 def start_backup():
     data = request.json
 
-    if progress['status'] == 'running':
+    if progress['status'] in ACTIVE_STATES:
         return jsonify({'status': 'error', 'message': 'Already running'}), 409
 
+    # One job may write to several destinations, reading sources once
+    destinations = list(data.get('destinations') or [])
+    if data.get('destination'):
+        destinations.insert(0, data['destination'])
+    destinations = list(dict.fromkeys(d for d in destinations if d))
+
+    if not data.get('source_dirs') or not destinations:
+        return jsonify({'status': 'error', 'message': 'Missing input'}), 400
+
+    try:
+        throttle.reset()
+        throttle.set_limits(data.get('limits') or {})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    compare_mode = data.get('compare_mode', 'off')
+    if compare_mode not in COMPARE_MODES:
+        return jsonify({'status': 'error', 'message': 'Bad compare_mode'}), 400
+
+    copy_tier = data.get('copy_tier', 'auto')
+    if copy_tier not in COPY_TIERS:
+        return jsonify({'status': 'error', 'message': 'Bad copy_tier'}), 400
+
+    io_mode = data.get('io_mode', 'normal')
+    if io_mode not in IO_MODES:
+        return jsonify({'status': 'error', 'message': 'Bad io_mode'}), 400
+
+    symlinks = data.get('symlinks', 'preserve')
+    out_of_tree = data.get('out_of_tree', 'keep')
+    symlink_loops = data.get('symlink_loops', 'skip')
+    if (symlinks not in SYMLINK_MODES or
+            out_of_tree not in OUT_OF_TREE_MODES or
+            symlink_loops not in LOOP_MODES):
+        return jsonify({'status': 'error', 'message': 'Bad symlink options'}), 400
+
+    order = data.get('order', 'tree')
+    if order not in ORDER_POLICIES:
+        return jsonify({'status': 'error', 'message': 'Bad order'}), 400
+
+    layout = data.get('layout', 'files')
+    if layout not in LAYOUTS:
+        return jsonify({'status': 'error', 'message': 'Bad layout'}), 400
+    try:
+        pack_threshold = int(data.get('pack_threshold', PACK_THRESHOLD))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Bad pack_threshold'}), 400
+
+    remote_options = data.get('remote') or {}
+    if any(is_remote(d) for d in destinations):
+        try:
+            for destination in destinations:
+                if is_remote(destination):
+                    open_backend(destination, **remote_options).close()
+        except Exception as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    encryption = data.get('encryption') or None
+    if encryption:
+        if any(is_remote(d) for d in destinations):
+            return jsonify({
+                'status': 'error',
+                'message': 'Encryption needs local destinations'
+            }), 400
+        if layout == 'packed':
+            return jsonify({
+                'status': 'error',
+                'message': 'Encrypted destinations use the files layout'
+            }), 400
+        # Also catches a wrong passphrase before the job starts
+        try:
+            for destination in destinations:
+                EncryptedBackend(destination, **encryption)
+        except Exception as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    mode = data.get('mode') or (
+        'mirror' if data.get('mirror_mode') else 'incremental'
+    )
+    if mode not in BACKUP_MODES:
+        return jsonify({'status': 'error', 'message': 'Bad mode'}), 400
+
+    archive = None
+    if mode == 'archive' and (
+            encryption or any(is_remote(d) for d in destinations)):
+        return jsonify({
+            'status': 'error',
+            'message': 'Archive mode needs plain local destinations'
+        }), 400
+    if mode == 'archive':
+        settings = data.get('archive') or {}
+        archive = {
+            'codec': settings.get('codec', CODECS[-1]),
+            'level': settings.get('level'),
+            'volume_size': settings.get('volume_size', VOLUME_SIZE),
+            'workers': settings.get('workers')
+        }
+        if archive['codec'] not in CODECS:
+            return jsonify({
+                'status': 'error',
+                'message': f"Bad codec (available: {', '.join(CODECS)})"
+            }), 400
+        try:
+            archive['volume_size'] = max(0, int(archive['volume_size']))
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'Bad volume_size'}), 400
+        try:
+            check_volume_size(archive['volume_size'])
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    snapshot = None
+    if mode == 'snapshot':
+        if encryption or layout == 'packed' or \
+                any(is_remote(d) for d in destinations):
+            return jsonify({
+                'status': 'error',
+                'message': 'Snapshots need plain local destinations'
+            }), 400
+        retention = data.get('retention') or {}
+        try:
+            snapshot = {
+                rule: max(0, int(retention.get(rule) or 0))
+                for rule in RETENTION_RULES
+            }
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'Bad retention'}), 400
+
+    agents = [a for a in data.get('agents') or [] if a]
+    if agents:
+        if mode != 'incremental' or len(destinations) > 1 or encryption or \
+                layout == 'packed' or is_remote(destinations[0]):
+            return jsonify({
+                'status': 'error',
+                'message': 'Agents run incremental backups to one plain'
+                           ' local destination'
+            }), 400
+        # The coordinator sends it with every request to the agents
+        if not agent_token():
+            return jsonify({
+                'status': 'error',
+                'message': f"Agents need a shared token: set {TOKEN_ENV}"
+            }), 400
+        thread = threading.Thread(
+            target=cluster_worker,
+            args=(
+                data.get('source_dirs', []),
+                destinations[0],
+                agents,
+                copy_tier,
+                io_mode,
+                symlinks
+            ),
+            daemon=True
+        )
+        thread.start()
+        return jsonify({'status': 'started'})
+
     thread = threading.Thread(
         target=backup_worker,
         args=(
             data.get('source_dirs', []),
-            data.get('destination'),
-            data.get('mirror_mode', False)
+            destinations,
+            mode == 'mirror',
+            data.get('low_priority', False),
+            compare_mode,
+            copy_tier,
+            io_mode,
+            symlinks,
+            out_of_tree,
+            symlink_loops,
+            order,
+            data.get('priority_paths') or [],
+            archive,
+            layout,
+            pack_threshold,
+            remote_options,
+            encryption,
+            snapshot
         ),
         daemon=True
     )
@@ -229,9 +1980,225 @@ def start_backup():
     return jsonify({'status': 'started'})
 
 
+@app.route('/start-restore', methods=['POST'])
+def start_restore():
+    data = request.json
+
+    if progress['status'] in ACTIVE_STATES:
+        return jsonify({'status': 'error', 'message': 'Already running'}), 409
+
+    destination = data.get('destination')
+    if not destination:
+        return jsonify({'status': 'error', 'message': 'Missing input'}), 400
+    run_id = data.get('run_id') or None
+    backup = resolve_backup(destination, run_id)
+    try:
+        check_plain(backup)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not backup_manifests(backup, run_id):
+        return jsonify({
+            'status': 'error', 'message': f"No backup manifests in {backup}"
+        }), 400
+
+    target = data.get('target') or None
+    try:
+        workers = max(1, int(data.get('workers', RESTORE_WORKERS)))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Bad workers'}), 400
+
+    copy_tier = data.get('copy_tier', 'auto')
+    io_mode = data.get('io_mode', 'normal')
+    if copy_tier not in COPY_TIERS or io_mode not in IO_MODES:
+        return jsonify({'status': 'error', 'message': 'Bad copy options'}), 400
+
+    thread = threading.Thread(
+        target=restore_worker,
+        args=(
+            backup,
+            target,
+            data.get('prefixes') or [],
+            data.get('globs') or [],
+            run_id,
+            workers,
+            copy_tier,
+            io_mode,
+            bool(data.get('overwrite'))
+        ),
+        daemon=True
+    )
+    thread.start()
+
+    return jsonify({'status': 'started', 'backup': backup})
+
+
 @app.route('/progress')
 def get_progress():
-    return jsonify(progress)
+    with progress_lock:
+        snapshot = dict(progress)
+    # Report the chosen level and recent history per device pair
+    snapshot['concurrency'] = {
+        label: tuner.snapshot()
+        for label, tuner in tuners.items()
+    }
+    snapshot['copy_tiers'] = tier_stats.snapshot()
+    return jsonify(snapshot)
+
+
+@app.route('/pause', methods=['POST'])
+def pause_backup():
+    # Everything holds still within one chunk; resume picks up there
+    if progress['status'] != 'running':
+        return jsonify({'status': 'error', 'message': 'Not running'}), 409
+    control.pause()
+    progress['status'] = 'paused'
+    logger.info("Backup paused", extra={'run_id': progress['run_id']})
+    return jsonify({'status': 'paused'})
+
+
+@app.route('/resume', methods=['POST'])
+def resume_backup():
+    if progress['status'] != 'paused':
+        return jsonify({'status': 'error', 'message': 'Not paused'}), 409
+    progress['status'] = 'running'
+    control.resume()
+    logger.info("Backup resumed", extra={'run_id': progress['run_id']})
+    return jsonify({'status': 'running'})
+
+
+@app.route('/cancel', methods=['POST'])
+def cancel_backup():
+    if progress['status'] not in ('running', 'paused'):
+        return jsonify({'status': 'error', 'message': 'Not running'}), 409
+    progress['status'] = 'cancelling'
+    control.cancel()
+    return jsonify({'status': 'cancelling'})
+
+
+@app.route('/throttle', methods=['GET', 'POST'])
+def update_throttle():
+    # Limits can be changed live while a job is running
+    if request.method == 'POST':
+        try:
+            throttle.set_limits(request.json or {})
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        logger.info(f"Throttle updated: {throttle.limits()}")
+
+    return jsonify(throttle.limits())
+
+
+@app.route('/history')
+def get_history():
+    # Newest first; pair narrows it to one source/destination pair
+    try:
+        limit = max(1, int(request.args.get('limit', HISTORY_LIMIT)))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Bad limit'}), 400
+    return jsonify({
+        'runs': run_history(request.args.get('pair') or None, limit)
+    })
+
+
+@app.route('/catalog/search')
+def search_catalog():
+    # Answered from the local catalog; the backup media stay idle
+    args = request.args
+    started = time.monotonic()
+    try:
+        results = catalog_search(
+            args.get('q', ''),
+            destination=args.get('destination') or None,
+            run_id=args.get('run_id') or None,
+            modified_from=args.get('from') or None,
+            modified_to=args.get('to') or None,
+            limit=args.get('limit', SEARCH_LIMIT)
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({
+        'results': results,
+        'ms': round((time.monotonic() - started) * 1000, 1)
+    })
+
+
+DOWNLOAD_TYPES = {'tar': 'application/x-tar', 'zip': 'application/zip'}
+
+
+@app.route('/download')
+def download_backup():
+    # Streamed while it is built: no temp archive, about one chunk in memory
+    args = request.args
+    fmt = args.get('format', 'tar')
+    if fmt not in DOWNLOAD_FORMATS:
+        return jsonify({'status': 'error', 'message': 'Bad format'}), 400
+    if not args.get('destination'):
+        return jsonify({'status': 'error', 'message': 'Missing input'}), 400
+    try:
+        download = Download(
+            args['destination'], args.get('path', ''),
+            args.get('run_id') or None
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    etag = f'"{download.etag(fmt)}"'
+    headers = {
+        'Content-Disposition':
+            f"attachment; filename*=UTF-8''{quote(download.name)}.{fmt}",
+        'ETag': etag,
+        # Only the tar stream can be rebuilt from an offset
+        'Accept-Ranges': 'bytes' if fmt == 'tar' else 'none'
+    }
+    start = end = None
+    range_header = request.headers.get('Range')
+    if fmt == 'tar' and range_header and \
+            request.headers.get('If-Range', etag) == etag:
+        size = download.tar_size()
+        try:
+            span = parse_range(range_header, size)
+        except ValueError:
+            return Response(status=416, headers={
+                'Content-Range': f"bytes */{size}"
+            })
+        if span:
+            start, end = span
+            headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+            headers['Content-Length'] = str(end - start + 1)
+
+    logger.info(
+        f"Download started | {download.backup} | Path: "
+        f"{download.prefix or '/'} | Format: {fmt}"
+        + (f" | Bytes: {start}-{end}" if start is not None else '')
+    )
+    chunks = download.tar(start, end) if start is not None \
+        else download.stream(fmt)
+    return Response(
+        logged_download(chunks, download), 206 if start is not None else 200,
+        headers=headers, mimetype=DOWNLOAD_TYPES[fmt]
+    )
+
+
+def logged_download(chunks, download):
+    started = time.monotonic()
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    except GeneratorExit:
+        logger.warning(
+            f"Download interrupted after {sent} bytes | {download.backup}"
+        )
+        raise
+    except Exception:
+        logger.exception(f"Download failed after {sent} bytes")
+        raise
+    seconds = time.monotonic() - started
+    logger.info(
+        f"Download complete: {sent} bytes in {seconds:.1f} s | "
+        f"{download.backup} | Path: {download.prefix or '/'}"
+    )
 
 # --------------------------------------------------
 # Main
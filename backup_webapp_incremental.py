@@ -5,6 +5,8 @@ import threading
 import time
 import logging
 
+from backup_logging import setup_logging
+
 # --------------------------------------------------
 # Configuration
 # --------------------------------------------------
@@ -15,11 +17,7 @@ LOG_FILE_NAMES = False
 # --------------------------------------------------
 # Logging configuration
 # --------------------------------------------------
-logging.basicConfig(
-    filename='webapp.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+setup_logging('webapp.log')
 logger = logging.getLogger('app')
 
 # --------------------------------------------------
@@ -5,6 +5,8 @@ import threading
 import time
 import logging
 
+from backup_logging import setup_logging
+
 # --------------------------------------------------
 # This web application provides a web interface to back up files
 # from multiple source directories to a destination directory. It
@@ -28,11 +30,7 @@ MIRROR_MODE = False
 # --------------------------------------------------
 # Logging configuration
 # --------------------------------------------------
-logging.basicConfig(
-    filename='webapp.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+setup_logging('webapp.log')
 logger = logging.getLogger('app')
 
 # --------------------------------------------------
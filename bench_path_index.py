@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+from backup_pathindex import PathIndex
+
+# --------------------------------------------------
+# Memory benchmark: set of relative path strings (what
+# build_file_index used to keep) vs PathIndex, on a synthetic
+# tree shaped like a photo library.
+#
+#   python bench_path_index.py --files 2000000
+# --------------------------------------------------
+
+FILES_PER_DIR = 200
+DIRS_PER_LEVEL = 20
+
+
+def synthetic_tree(total_files):
+    """Yield (dir_parts, [(name, size, mtime_ns), ...]) per leaf dir."""
+    produced = 0
+    leaf = 0
+    while produced < total_files:
+        parts = (
+            f"{2000 + leaf // (DIRS_PER_LEVEL * DIRS_PER_LEVEL)}",
+            f"album_{leaf // DIRS_PER_LEVEL % DIRS_PER_LEVEL:03d}",
+            f"roll_{leaf % DIRS_PER_LEVEL:03d}"
+        )
+        count = min(FILES_PER_DIR, total_files - produced)
+        files = [
+            (f"IMG_{produced + n:08d}.jpg", 3_500_000 + n, 1_700_000_000_000_000_000 + n)
+            for n in range(count)
+        ]
+        yield parts, files
+        produced += count
+        leaf += 1
+
+
+def build_set(total_files):
+    paths = set()
+    for parts, files in synthetic_tree(total_files):
+        rel_dir = os.path.join(*parts)
+        for name, _, _ in files:
+            paths.add(os.path.join(rel_dir, name))
+    return paths
+
+
+def build_index(total_files):
+    index = PathIndex()
+    dirs = {}
+    for parts, files in synthetic_tree(total_files):
+        d = 0
+        for depth in range(len(parts)):
+            key = parts[:depth + 1]
+            if key not in dirs:
+                dirs[key] = index.add_directory(d, parts[depth])
+            d = dirs[key]
+        index.add_files(d, files)
+    return index
+
+
+def measure(label, builder, total_files):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = builder(total_files)
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{label:<12} {len(result):>10} files | "
+        f"retained {current / 1024 / 1024:8.1f} MB "
+        f"({current / len(result):6.1f} B/file) | "
+        f"peak {peak / 1024 / 1024:8.1f} MB | {elapsed:6.2f}s"
+    )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare memory use of path sets and PathIndex'
+    )
+    parser.add_argument('--files', type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    measure('set[str]', build_set, args.files)
+    index = measure('PathIndex', build_index, args.files)
+
+    # Diff against itself must find nothing and touch every file
+    started = time.perf_counter()
+    extras = sum(1 for _ in index.diff(index))
+    print(f"diff(self)   {extras} extras in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup_logging import setup_logging  # noqa: E402
+
+# The apps set up logging to a file in the working directory when
+# they are imported; only the first setup_logging() call counts, so
+# the tests log to a temporary directory instead of the tree
+LOG_DIR = tempfile.TemporaryDirectory(prefix='backup-tests-')
+setup_logging(os.path.join(LOG_DIR.name, 'tests.log'))
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from backup_archive import (
+    ArchiveReader, ArchiveWriter, check_volume_size, index_path
+)
+
+BLOCK = 64 * 1024
+
+
+def write_archive(tmp_path, files, **options):
+    src = tmp_path / 'src'
+    src.mkdir()
+    out = tmp_path / 'out'
+    writer = ArchiveWriter(
+        [str(out)], 'run', block_size=BLOCK, workers=2, **options
+    )
+    writer.add_dir(str(src), 'src')
+    for name, data in files.items():
+        (src / name).write_bytes(data)
+        writer.add_file(str(src / name), f"src/{name}")
+    os.symlink('a.bin', src / 'link')
+    writer.add_symlink(str(src / 'link'), 'src/link')
+    return writer.close(), out
+
+
+def test_volumes_round_trip(tmp_path):
+    files = {
+        'a.bin': os.urandom(3 * BLOCK + 17),
+        'b.txt': b'text ' * 20000,
+        'empty': b'',
+    }
+    summary, out = write_archive(
+        tmp_path, files, volume_size=2 * BLOCK + 1024
+    )
+    assert len(summary['volumes']) > 1
+    for name in summary['volumes']:
+        assert os.path.getsize(out / name) <= 2 * BLOCK + 1024
+
+    reader = ArchiveReader(index_path(str(out), 'run'))
+    target = tmp_path / 'restored'
+    target.mkdir()
+    for name, data in files.items():
+        reader.extract(f"src/{name}", str(target / name))
+        assert (target / name).read_bytes() == data
+    reader.extract('src/link', str(target / 'link'))
+    assert os.readlink(target / 'link') == 'a.bin'
+
+
+def test_volume_size_below_two_blocks_is_rejected(tmp_path):
+    check_volume_size(0, BLOCK)
+    check_volume_size(2 * BLOCK, BLOCK)
+    with pytest.raises(ValueError):
+        check_volume_size(BLOCK, BLOCK)
+    with pytest.raises(ValueError):
+        ArchiveWriter(
+            [str(tmp_path / 'out')], 'run', volume_size=1000,
+            block_size=BLOCK
+        )
+    assert not (tmp_path / 'out').exists()
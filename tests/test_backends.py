@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+import boto3
+
+import backup_backends
+import backup_webapp_AIO as webapp
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(name, 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='backups')
+        yield client
+
+
+def test_remote_backup_progress_reaches_the_total(tmp_path, monkeypatch,
+                                                  bucket):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'a.txt').write_text('data')
+    # Backends store no symlinks: they must not count as files to do
+    (source / 'link').symlink_to('a.txt')
+    state = tmp_path / 'state'
+    monkeypatch.setattr(backup_backends, 'REMOTE_STATE_DIR', str(state))
+    monkeypatch.chdir(tmp_path)
+
+    webapp.backup_worker(
+        [str(source)], ['s3://backups/pc'], False,
+        remote_options={
+            'region': 'us-east-1', 'cache_db': str(tmp_path / 'cache.db')
+        }
+    )
+
+    assert webapp.progress['status'] == 'done'
+    assert webapp.progress['total_files'] == 1
+    assert webapp.progress['copied_files'] == 1
+    keys = [
+        obj['Key'] for obj in
+        bucket.list_objects_v2(Bucket='backups')['Contents']
+    ]
+    assert 'pc/source/a.txt' in keys
+    assert any(key.startswith('pc/.backup/manifests/') for key in keys)
+    assert os.listdir(state / 'backups' / 'pc' / '.backup' / 'manifests')
+
+
+def test_remote_state_does_not_depend_on_the_working_directory():
+    assert os.path.isabs(backup_backends.REMOTE_CACHE_DB)
+    assert os.path.isabs(backup_backends.REMOTE_STATE_DIR)
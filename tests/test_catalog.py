@@ -0,0 +1,45 @@
+from backup_catalog import Catalog, fts_query, search
+
+
+def test_fts_query_makes_the_last_token_of_each_word_a_prefix():
+    assert fts_query('budget.xl') == '"budget xl"*'
+    assert fts_query('march  budget_2024') == '"march"* "budget 2024"*'
+    assert fts_query('-- ..') == ''
+
+
+def catalog_run(db_path, destination, run_id, entries, status='done'):
+    catalog = Catalog(db_path)
+    try:
+        run = catalog.run(destination, run_id)
+        for entry in entries:
+            run.add(entry)
+        run.close(status)
+    finally:
+        catalog.close()
+
+
+def test_search_finds_every_version_by_prefix(tmp_path):
+    db_path = str(tmp_path / 'catalog.db')
+    catalog_run(db_path, '/mnt/usb', '20240301-000000-000', [
+        {'action': 'copied', 'path': 'docs/budget.xlsx', 'size': 1,
+         'mtime_ns': 1, 'hash': 'aa'},
+        {'action': 'copied', 'path': 'docs/notes.txt', 'size': 2},
+        # The first run of a destination catalogues what is there
+        {'action': 'skipped', 'path': 'docs/old.txt', 'size': 3},
+    ])
+    catalog_run(db_path, '/mnt/usb', '20240401-000000-000', [
+        {'action': 'copied', 'path': 'docs/budget.xlsx', 'size': 4,
+         'mtime_ns': 2, 'hash': 'bb'},
+        # Later on, unchanged files were catalogued by an earlier run
+        {'action': 'skipped', 'path': 'docs/old.txt', 'size': 3},
+    ])
+
+    results = search('budg xls', db_path=db_path)
+    assert [(r['run_id'], r['hash']) for r in results] == [
+        ('20240401-000000-000', 'bb'), ('20240301-000000-000', 'aa')
+    ]
+    assert search('budget', run_id='20240301-000000-000',
+                  db_path=db_path)[0]['size'] == 1
+    assert [r['run_id'] for r in search('old', db_path=db_path)] == [
+        '20240301-000000-000'
+    ]
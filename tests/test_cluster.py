@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+
+import pytest
+
+import backup_cluster
+from backup_cluster import (
+    Agent, Coordinator, _call, agent_server, make_shards
+)
+from backup_logging import manifest_dir, read_manifest
+from backup_pathindex import PathIndex
+
+TOKEN = 'secret'
+
+
+def make_source(root, dirs=8, files=3):
+    for d in range(dirs):
+        sub = root / f"dir{d}"
+        sub.mkdir(parents=True)
+        for f in range(files):
+            (sub / f"file{f}.txt").write_text(f"{d}-{f}" * (d + 1))
+    (root / 'top.txt').write_text('top')
+
+
+def item_files(index, item):
+    if not item['recursive']:
+        (d,) = [
+            d for d in range(index.dir_total())
+            if index.dir_path(d) == item['path']
+        ]
+        return {index.file_path(i) for i in index.files_in(d)}
+    prefix = item['path'] + os.sep if item['path'] else ''
+    return {
+        index.file_path(i) for i in range(len(index))
+        if index.file_path(i).startswith(prefix)
+    }
+
+
+def test_make_shards_covers_every_file_once(tmp_path):
+    make_source(tmp_path)
+    index = PathIndex.scan(str(tmp_path))
+    shards = make_shards({str(tmp_path): index}, 3)
+
+    assert 1 < len(shards) <= 3
+    seen = []
+    for shard in shards:
+        for item in shard['items']:
+            seen += item_files(index, item)
+    assert sorted(seen) == sorted(
+        index.file_path(i) for i in range(len(index))
+    )
+    assert sum(shard['files'] for shard in shards) == len(index)
+    assert sum(shard['bytes'] for shard in shards) == index.total_bytes()
+
+
+def test_make_shards_of_one_directory(tmp_path):
+    (tmp_path / 'only.txt').write_text('x')
+    index = PathIndex.scan(str(tmp_path))
+    (shard,) = make_shards({str(tmp_path): index}, 4)
+    assert shard['items'] == [
+        {'source': str(tmp_path), 'path': '', 'recursive': True}
+    ]
+
+
+class StalledAgent(Agent):
+    """Takes a shard, then makes no progress."""
+
+    def _run(self, shard):
+        self.control.pause()
+        super()._run(shard)
+
+
+def start_agent(agent):
+    server = agent_server(agent, '127.0.0.1', 0, TOKEN)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_agent_refuses_requests_without_the_token(tmp_path):
+    server, url = start_agent(Agent())
+    try:
+        assert _call(url, '/status')[0] == 401
+        assert _call(url, '/shards', {}, 'wrong')[0] == 401
+        assert _call(url, '/status', token=TOKEN)[0] == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_agent_needs_a_token(monkeypatch):
+    monkeypatch.delenv(backup_cluster.TOKEN_ENV, raising=False)
+    with pytest.raises(ValueError):
+        agent_server(Agent(), '127.0.0.1', 0)
+
+
+def test_shard_of_a_killed_agent_is_reassigned(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_cluster, 'POLL_SECONDS', 0.05)
+    source = tmp_path / 'source'
+    make_source(source)
+    destination = tmp_path / 'dest'
+    stalled = StalledAgent()
+    servers = dict([start_agent(stalled), start_agent(Agent())])
+
+    def kill():
+        # Once the stalled agent holds a shard, it goes away with it
+        while stalled.snapshot()['state'] != 'running':
+            time.sleep(0.01)
+        for server, url in servers.items():
+            if server.RequestHandlerClass.agent is stalled:
+                server.shutdown()
+                server.server_close()
+        stalled.cancel()
+    killer = threading.Thread(target=kill, daemon=True)
+    killer.start()
+
+    coordinator = Coordinator(
+        list(servers.values()), [str(source)], str(destination),
+        shards_per_agent=2, token=TOKEN
+    )
+    try:
+        summary = coordinator.run()
+    finally:
+        killer.join(10)
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    assert summary['reassigned'] >= 1
+    assert summary['shards_failed'] == 0
+    assert summary['shards_done'] == summary['shards_total']
+    for d in range(8):
+        for f in range(3):
+            path = destination / 'source' / f"dir{d}" / f"file{f}.txt"
+            assert path.read_text() == f"{d}-{f}" * (d + 1)
+    (name,) = os.listdir(manifest_dir(str(destination)))
+    entries = list(read_manifest(
+        os.path.join(manifest_dir(str(destination)), name)
+    ))
+    assert entries[-1]['status'] == 'done'
+    assert not os.path.exists(destination / '.backup' / 'shards')
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+from backup_compare import HashCache, content_equal, file_digest
+
+
+def test_record_copy_fills_the_cache_for_source_and_copy(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(10000))
+    st = os.stat(src)
+    dest = tmp_path / 'dest.bin'
+    shutil.copyfile(src, dest)
+
+    cache = HashCache(str(tmp_path / 'hashes.db'))
+    try:
+        digest = cache.record_copy(str(src), st, [str(dest)])
+        assert digest == file_digest(str(src))
+        assert cache.get(str(src), st) == digest
+        # The copy's entry is valid once its metadata matches the source
+        os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert cache.get(str(dest), os.stat(dest)) == digest
+        assert content_equal(str(src), str(dest), 'hash', cache)
+    finally:
+        cache.close()
+
+
+def test_record_copy_skips_a_source_changed_during_the_copy(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(b'old data')
+    st = os.stat(src)
+    src.write_bytes(b'new data, longer')
+
+    cache = HashCache(str(tmp_path / 'hashes.db'))
+    try:
+        assert cache.record_copy(str(src), st, [str(tmp_path / 'x')]) is None
+        assert cache.get(str(src), os.stat(src)) is None
+    finally:
+        cache.close()
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+import pytest
+
+from backup_control import Cancelled, JobControl
+from backup_copy import copy_file, partial_path
+
+
+def test_pause_holds_checkpoints_until_resume():
+    control = JobControl()
+    passed = threading.Event()
+
+    def work():
+        control.checkpoint()
+        passed.set()
+
+    control.pause()
+    thread = threading.Thread(target=work)
+    thread.start()
+    assert not passed.wait(0.1)
+    control.resume()
+    assert passed.wait(5)
+    thread.join()
+
+
+def test_cancel_wakes_a_paused_job():
+    control = JobControl()
+    errors = []
+
+    def work():
+        try:
+            control.checkpoint()
+        except Cancelled as e:
+            errors.append(e)
+
+    control.pause()
+    thread = threading.Thread(target=work)
+    thread.start()
+    time.sleep(0.05)
+    control.cancel()
+    thread.join(5)
+    assert len(errors) == 1
+    # A cancelled job stays cancelled
+    assert control.resume() == 'cancelled'
+
+
+def test_cancelled_copy_leaves_no_file(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(4 * 1024 * 1024))
+    dest = str(tmp_path / 'dest.bin')
+    control = JobControl()
+    control.cancel()
+    with pytest.raises(Cancelled):
+        copy_file(str(src), dest, tier='chunked', control=control)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(partial_path(dest))
+
+
+def test_cancel_in_the_simple_web_app_reaches_its_job(tmp_path, monkeypatch):
+    pytest.importorskip('flask')
+    import backup_webapp
+
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+    counting, go = threading.Event(), threading.Event()
+
+    def count_files(dirs):
+        counting.set()
+        go.wait(5)
+        return 1
+    monkeypatch.setattr(backup_webapp, 'count_files', count_files)
+
+    client = backup_webapp.app.test_client()
+    response = client.post('/start-backup', json={
+        'source_dirs': [str(source)], 'destination': str(tmp_path / 'dest')
+    })
+    assert response.status_code == 200
+    assert counting.wait(5)
+    assert client.post('/cancel').status_code == 200
+    go.set()
+
+    deadline = time.monotonic() + 5
+    while backup_webapp.progress['status'] == 'cancelling' and \
+            time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert backup_webapp.progress['status'] == 'cancelled'
+    assert not (tmp_path / 'dest' / 'source' / 'a.txt').exists()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import threading
+
+import backup_copy
+from backup_copy import copy_file_multi, partial_path
+
+
+def run_with_timeout(func, *args, timeout=10, **kwargs):
+    """func's result; fails the test instead of hanging."""
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.setdefault('value', func(*args, **kwargs)),
+        daemon=True
+    )
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"{func.__name__} did not return"
+    return result['value']
+
+
+def make_source(tmp_path, size=3 * backup_copy.CHUNK_SIZE + 123):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(size))
+    return src
+
+
+def test_fanout_writes_every_destination(tmp_path):
+    src = make_source(tmp_path)
+    dests = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    results = run_with_timeout(copy_file_multi, str(src), dests)
+    for dest in dests:
+        assert results[dest][0] == src.stat().st_size
+        assert open(dest, 'rb').read() == src.read_bytes()
+        assert not os.path.exists(partial_path(dest))
+
+
+def test_fanout_truncate_failure_does_not_hang(tmp_path, monkeypatch):
+    src = make_source(tmp_path)
+    dests = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    real_open = open
+
+    class FailingTruncate:
+        def __init__(self, f):
+            self.f = f
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        def truncate(self, size):
+            raise OSError(5, 'Input/output error')
+
+    def fake_open(path, mode='r', *args, **kwargs):
+        f = real_open(path, mode, *args, **kwargs)
+        return FailingTruncate(f) if 'w' in mode else f
+
+    monkeypatch.setattr(backup_copy, 'open', fake_open, raising=False)
+    results = run_with_timeout(copy_file_multi, str(src), dests)
+    for dest in dests:
+        assert isinstance(results[dest], OSError)
+        assert not os.path.exists(dest)
+        assert not os.path.exists(partial_path(dest))
+
+
+def failing_finish(self):
+    raise OSError(5, 'Input/output error')
+
+
+def test_fanout_writeback_failure_does_not_hang(tmp_path, monkeypatch):
+    src = make_source(tmp_path)
+    dests = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    monkeypatch.setattr(backup_copy.Writeback, 'finish', failing_finish)
+    results = run_with_timeout(
+        copy_file_multi, str(src), dests, io_mode='nocache'
+    )
+    for dest in dests:
+        assert isinstance(results[dest], OSError)
+        assert not os.path.exists(partial_path(dest))
+
+
+def test_single_copy_writeback_failure_leaves_no_partial(tmp_path,
+                                                         monkeypatch):
+    src = make_source(tmp_path)
+    dest = str(tmp_path / 'a')
+    monkeypatch.setattr(backup_copy.Writeback, 'finish', failing_finish)
+    results = run_with_timeout(
+        copy_file_multi, str(src), [dest], io_mode='nocache'
+    )
+    assert isinstance(results[dest], OSError)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(partial_path(dest))
+
+
+def test_fifo_source_is_refused_without_blocking(tmp_path):
+    fifo = str(tmp_path / 'pipe')
+    os.mkfifo(fifo)
+    dests = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    for targets in (dests[:1], dests):
+        results = run_with_timeout(copy_file_multi, fifo, targets)
+        for dest in targets:
+            assert isinstance(results[dest], shutil.SpecialFileError)
+            assert not os.path.exists(partial_path(dest))
+
+
+def test_missing_source_fails_every_destination(tmp_path):
+    missing = str(tmp_path / 'gone.txt')
+    dests = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    for targets in (dests[:1], dests):
+        results = copy_file_multi(missing, targets)
+        for dest in targets:
+            assert isinstance(results[dest], FileNotFoundError)
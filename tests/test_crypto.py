@@ -0,0 +1,109 @@
+import os
+import struct
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from backup_crypto import (
+    CRYPT_STATE_DIR, HEADER_SIZE, LAST_CHUNK, LONG_NAME_SUFFIX, MAGIC,
+    MAGIC_V1, CryptoKeys, EncryptedBackend, decrypt_paths
+)
+from backup_pathindex import PathIndex
+from backup_restore import Restorer
+
+PASSPHRASE = 'correct horse'
+
+
+def test_long_names_are_hashed_and_read_back(tmp_path):
+    dest = str(tmp_path / 'dest')
+    backend = EncryptedBackend(dest, passphrase=PASSPHRASE)
+    src = tmp_path / 'src.txt'
+    src.write_text('data')
+    long_name = 'x' * 200 + '.txt'
+
+    backend.upload(str(src), os.path.join('docs', long_name))
+
+    enc_dir = os.path.join(dest, backend.keys.encrypt_path('docs'))
+    (stored,) = os.listdir(enc_dir)
+    assert stored.endswith(LONG_NAME_SUFFIX)
+    assert len(stored) <= 255
+    # A new set of keys finds the name through the long-name manifest
+    keys = CryptoKeys(dest, passphrase=PASSPHRASE)
+    index = PathIndex.scan(dest)
+    assert [p for _, p in decrypt_paths(keys, index)] == [
+        os.path.join('docs', long_name)
+    ]
+    # The incremental check sees the plain name and size
+    docs = backend.index('docs')
+    assert [(docs.file_path(i), docs.sizes[i]) for i in range(len(docs))] \
+        == [(long_name, 4)]
+
+
+def test_manifests_are_staged_on_the_destination(tmp_path):
+    dest = str(tmp_path / 'dest')
+    backend = EncryptedBackend(dest, passphrase=PASSPHRASE)
+    assert backend.state_dir == os.path.join(dest, CRYPT_STATE_DIR)
+
+    staged = os.path.join(backend.state_dir, '.backup', 'manifests', 'r.gz')
+    os.makedirs(os.path.dirname(staged))
+    with open(staged, 'w') as f:
+        f.write('plain')
+    backend.put_file(staged, os.path.relpath(staged, backend.state_dir))
+
+    assert not os.path.exists(staged)
+    keys = CryptoKeys(dest, passphrase=PASSPHRASE)
+    index = PathIndex.scan(dest)
+    (stored,) = [
+        i for i, p in decrypt_paths(keys, index)
+        if p == os.path.join('.backup', 'manifests', 'r.gz')
+    ]
+    out = tmp_path / 'r.gz'
+    keys.decrypt_file(os.path.join(dest, index.file_path(stored)), str(out))
+    assert out.read_text() == 'plain'
+
+
+def test_restore_refuses_an_encrypted_destination(tmp_path):
+    dest = str(tmp_path / 'dest')
+    EncryptedBackend(dest, passphrase=PASSPHRASE)
+    with pytest.raises(ValueError, match='backup_crypto.py restore'):
+        Restorer(dest, str(tmp_path / 'out'))
+
+
+def test_each_file_has_its_own_key(tmp_path):
+    keys = CryptoKeys(str(tmp_path / 'dest'), passphrase=PASSPHRASE)
+    keys.chunk_size = 1000
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(2500))
+    one, two = str(tmp_path / 'one'), str(tmp_path / 'two')
+
+    for dest in (one, two):
+        assert keys.encrypt_file(str(src), dest)[0] == 2500
+        assert keys.plain_size(os.path.getsize(dest)) == 2500
+    sealed = [open(path, 'rb').read() for path in (one, two)]
+    assert all(data.startswith(MAGIC) for data in sealed)
+    salts = [data[len(MAGIC):HEADER_SIZE] for data in sealed]
+    assert salts[0] != salts[1]
+
+    out = str(tmp_path / 'out')
+    assert keys.decrypt_file(one, out) == 2500
+    assert open(out, 'rb').read() == src.read_bytes()
+
+    # Cut off after the first chunk: the last-chunk flag is missing
+    with open(one, 'r+b') as f:
+        f.truncate(HEADER_SIZE + 1000 + 16)
+    with pytest.raises(ValueError):
+        keys.decrypt_file(one, out)
+
+
+def test_files_of_the_first_format_still_decrypt(tmp_path):
+    keys = CryptoKeys(str(tmp_path / 'dest'), passphrase=PASSPHRASE)
+    prefix = os.urandom(8)
+    header = MAGIC_V1 + prefix
+    nonce = prefix + struct.pack('>I', 0 | LAST_CHUNK)
+    old = tmp_path / 'old'
+    old.write_bytes(header + keys.aead.encrypt(nonce, b'old data', header))
+
+    out = str(tmp_path / 'out')
+    assert keys.decrypt_file(str(old), out) == 8
+    assert open(out, 'rb').read() == b'old data'
@@ -0,0 +1,48 @@
+import io
+import tarfile
+
+import pytest
+
+from backup_download import Download, parse_range
+from test_restore import make_backup, write_run
+
+
+def test_parse_range():
+    assert parse_range('bytes=0-99', 1000) == (0, 99)
+    assert parse_range('bytes=500-', 1000) == (500, 999)
+    assert parse_range('bytes=-100', 1000) == (900, 999)
+    assert parse_range('bytes=900-5000', 1000) == (900, 999)
+    assert parse_range('bytes=0-1,5-6', 1000) is None
+    assert parse_range('bytes=a-b', 1000) is None
+    assert parse_range('items=0-1', 1000) is None
+    with pytest.raises(ValueError):
+        parse_range('bytes=1000-', 1000)
+    with pytest.raises(ValueError):
+        parse_range('bytes=9-5', 1000)
+
+
+def test_tar_ranges_match_the_whole_stream(tmp_path):
+    names = ['a.txt', 'sub/b.txt', 'sub/empty.txt']
+    dst = make_backup(tmp_path, names)
+    # Sizes that cross block boundaries, and an empty file
+    (tmp_path / 'dst' / 'data' / 'a.txt').write_bytes(b'x' * 1500)
+    (tmp_path / 'dst' / 'data' / 'sub' / 'empty.txt').write_bytes(b'')
+    write_run(dst, '20240101-000000-000',
+              [('copied', 'data/' + name) for name in names])
+
+    download = Download(dst, 'data')
+    whole = b''.join(download.tar())
+    assert len(whole) == download.tar_size()
+    with tarfile.open(fileobj=io.BytesIO(whole)) as archive:
+        assert sorted(archive.getnames()) == [
+            'data/a.txt', 'data/sub/b.txt', 'data/sub/empty.txt'
+        ]
+        assert archive.extractfile('data/a.txt').read() == b'x' * 1500
+
+    size = len(whole)
+    for start, end in [(0, 0), (0, 511), (100, 2000), (511, 513),
+                       (1024, size - 1), (size - 1, size - 1)]:
+        part = b''.join(download.tar(start, end))
+        assert part == whole[start:end + 1], (start, end)
+    # Resuming with an open end yields the rest
+    assert b''.join(download.tar(777)) == whole[777:]
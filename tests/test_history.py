@@ -0,0 +1,69 @@
+import time
+
+from backup_history import (
+    MIN_REGRESSION_BYTES, Phases, baseline, eta_seconds, history,
+    pair_key, record_run
+)
+
+PAIR = pair_key(['/src'], ['/mnt/usb'])
+GB = 10 ** 9
+
+
+def run(db, n, mb_per_sec, status='done', bytes_copied=GB, pair=PAIR):
+    return record_run({
+        'run_id': f"r{n:02d}", 'kind': 'backup', 'pair': pair,
+        'started': 1000.0 + n, 'finished': 1001.0 + n, 'status': status,
+        'bytes_copied': bytes_copied,
+        'copy_seconds': bytes_copied / (mb_per_sec * 1e6),
+        'phases': {'copy': 1.0}, 'devices': {'src': '8:1'}
+    }, db_path=db)
+
+
+def test_slow_run_is_flagged_against_the_median(tmp_path):
+    db = str(tmp_path / 'history.db')
+    assert not run(db, 0, 100)['regression']
+    assert not run(db, 1, 120)['regression']
+    # Two complete runs are no baseline yet
+    assert run(db, 2, 20)['baseline_mb_per_sec'] is None
+    for n, rate in enumerate([110, 90, 100], start=3):
+        run(db, n, rate)
+    assert baseline(PAIR, db) == 100
+
+    slow = run(db, 10, 40)
+    assert slow['baseline_mb_per_sec'] == 100
+    assert slow['regression']
+    assert not run(db, 11, 60)['regression']
+
+
+def test_failed_small_and_other_runs_do_not_count(tmp_path):
+    db = str(tmp_path / 'history.db')
+    for n in range(3):
+        run(db, n, 100)
+    # Not done, too small to judge, or another pair
+    assert not run(db, 3, 10, status='error')['regression']
+    small = run(db, 4, 1, bytes_copied=MIN_REGRESSION_BYTES - 1)
+    assert not small['regression']
+    assert run(db, 5, 1, pair='other')['baseline_mb_per_sec'] is None
+    assert baseline(PAIR, db) == 100
+
+    runs = history(PAIR, db_path=db)
+    assert [r['run_id'] for r in runs] == ['r04', 'r03', 'r02', 'r01', 'r00']
+    assert runs[0]['phases'] == {'copy': 1.0}
+    assert len(history(db_path=db)) == 6
+    assert history(db_path=str(tmp_path / 'none.db')) == []
+
+
+def test_eta_leans_on_the_baseline_early():
+    # Nothing copied yet: the baseline alone
+    assert eta_seconds(100 * 10 ** 6, 0, 0, 10) == 10
+    assert eta_seconds(100 * 10 ** 6, 0, 0) is None
+    # Past the warm-up: the run's own rate alone
+    assert eta_seconds(100 * 10 ** 6, 60 * 10 ** 6, 60, 10) == 100
+
+
+def test_phases_add_up():
+    phases = Phases()
+    for _ in range(2):
+        with phases('scan'):
+            time.sleep(0.01)
+    assert phases.seconds['scan'] >= 0.02
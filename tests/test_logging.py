@@ -0,0 +1,81 @@
+import gzip
+import json
+import logging
+import sys
+import time
+
+import backup_logging
+from backup_logging import (
+    JsonFormatter, QuietPathsFilter, RunManifest, manifest_status,
+    read_manifest, setup_logging
+)
+
+
+def test_manifest_has_run_entries_and_summary(tmp_path):
+    manifest = RunManifest(str(tmp_path), 'r1', mode='incremental')
+    manifest.record('copied', 'a.txt', size=3)
+    manifest.record('copied', 'b.txt', size=4)
+    manifest.record('failed', 'c.txt', error='denied')
+    manifest.close(status='done')
+
+    entries = list(read_manifest(manifest.path))
+    assert entries[0]['type'] == 'run'
+    assert entries[0]['mode'] == 'incremental'
+    assert [e['path'] for e in entries[1:-1]] == ['a.txt', 'b.txt', 'c.txt']
+    assert entries[-1]['totals'] == {
+        'copied': {'files': 2, 'bytes': 7}, 'failed': {'files': 1, 'bytes': 0}
+    }
+    assert manifest_status(manifest.path) == 'done'
+
+
+def test_manifest_without_summary_has_no_status(tmp_path):
+    path = tmp_path / 'cut.jsonl.gz'
+    with gzip.open(path, 'wt') as f:
+        f.write(json.dumps({'type': 'run'}) + '\n')
+        f.write(json.dumps({'action': 'copied', 'path': 'a'}) + '\n')
+    assert manifest_status(str(path)) is None
+    assert manifest_status(str(tmp_path / 'missing.jsonl.gz')) is None
+
+
+def test_json_lines_carry_extra_fields_and_exceptions():
+    try:
+        raise OSError('disk gone')
+    except OSError:
+        record = logging.getLogger('app').makeRecord(
+            'app', logging.ERROR, __file__, 1, 'Copy failed: %s', ('a',),
+            sys.exc_info(), extra={'run_id': 'r1'}
+        )
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'Copy failed: a'
+    assert entry['run_id'] == 'r1'
+    assert 'disk gone' in entry['exception']
+
+
+def test_progress_polling_is_not_logged():
+    quiet = QuietPathsFilter()
+
+    def access(path):
+        return logging.makeLogRecord({
+            'name': 'werkzeug', 'msg': f'127.0.0.1 "GET {path} HTTP/1.1" 200'
+        })
+    assert not quiet.filter(access('/progress'))
+    assert not quiet.filter(access('/progress?x=1'))
+    assert quiet.filter(access('/start-backup'))
+
+
+def test_log_calls_reach_the_file_through_the_listener():
+    # conftest.py installed the pipeline; later calls return it
+    listener = setup_logging('ignored.log')
+    assert listener is backup_logging._listener
+    path = listener.handlers[0].baseFilename
+
+    logging.getLogger('app').info('listener probe', extra={'job': 7})
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        found = [e for e in lines if e['message'] == 'listener probe']
+        if found:
+            break
+        time.sleep(0.01)
+    assert found and found[0]['job'] == 7
@@ -0,0 +1,65 @@
+import os
+
+from backup_metadata import MetadataQueue
+
+T1 = 1_600_000_000 * 10 ** 9
+T2 = 1_500_000_000 * 10 ** 9
+
+
+def make_tree(root):
+    (root / 'sub').mkdir(parents=True)
+    for rel_path in ('a.txt', 'sub/b.txt'):
+        (root / rel_path).write_text(rel_path)
+        os.utime(root / rel_path, ns=(T1, T1))
+    os.chmod(root / 'sub' / 'b.txt', 0o600)
+    os.utime(root / 'sub', ns=(T2, T2))
+    os.utime(root, ns=(T2, T2))
+
+
+def test_files_wait_for_their_batch(tmp_path):
+    src, dest = tmp_path / 'src', tmp_path / 'dest'
+    make_tree(src)
+    (dest / 'sub').mkdir(parents=True)
+    queue = MetadataQueue(batch_size=2)
+
+    (dest / 'a.txt').write_text('a')
+    queue.add_file(str(src / 'a.txt'), str(dest / 'a.txt'),
+                   os.stat(src / 'a.txt'))
+    assert os.stat(dest / 'a.txt').st_mtime_ns != T1
+    assert queue.applied == 0
+
+    # The second entry fills the batch
+    (dest / 'sub' / 'b.txt').write_text('b')
+    queue.add_file(str(src / 'sub' / 'b.txt'), str(dest / 'sub' / 'b.txt'),
+                   os.stat(src / 'sub' / 'b.txt'))
+    assert queue.applied == 2
+    assert os.stat(dest / 'a.txt').st_mtime_ns == T1
+    assert os.stat(dest / 'sub' / 'b.txt').st_mode & 0o777 == 0o600
+
+
+def test_directory_times_survive_the_files_written_into_them(tmp_path):
+    src, dest = tmp_path / 'src', tmp_path / 'dest'
+    make_tree(src)
+    queue = MetadataQueue()
+    for rel_dir in ('', 'sub'):
+        (dest / rel_dir).mkdir(exist_ok=True)
+        queue.add_dir(str(src / rel_dir), str(dest / rel_dir))
+    for rel_path in ('a.txt', 'sub/b.txt'):
+        (dest / rel_path).write_text(rel_path)
+        queue.add_file(str(src / rel_path), str(dest / rel_path),
+                       os.stat(src / rel_path))
+
+    queue.finish()
+    assert (queue.applied, queue.failed) == (4, 0)
+    for rel_path in ('', 'sub'):
+        assert os.stat(dest / rel_path).st_mtime_ns == T2
+    assert os.stat(dest / 'sub' / 'b.txt').st_mtime_ns == T1
+
+
+def test_a_missing_file_is_counted_not_raised(tmp_path):
+    src = tmp_path / 'a.txt'
+    src.write_text('a')
+    queue = MetadataQueue()
+    queue.add_file(str(src), str(tmp_path / 'gone' / 'a.txt'), os.stat(src))
+    queue.finish()
+    assert (queue.applied, queue.failed) == (0, 1)
@@ -0,0 +1,62 @@
+import pytest
+
+from backup_order import OrderBuffer, path_rank
+
+
+def push_all(buffer, files):
+    """Names of files, in the order buffer hands them out."""
+    out = []
+    for file_id, (name, size, mtime) in enumerate(files):
+        out += buffer.push(file_id, 0, str(name), size, mtime)
+    return [files[file_id][0] for file_id, _ in out + list(buffer.drain())]
+
+
+FILES = [('a', 30, 1), ('b', 10, 3), ('c', 20, 2), ('d', 10, 4)]
+
+
+def test_tree_keeps_walk_order_without_holding_anything():
+    buffer = OrderBuffer('tree')
+    assert buffer.push(7, 6, 'a', 1, 1) == [(7, 6)]
+    assert list(buffer.drain()) == []
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('newest', ['d', 'b', 'c', 'a']),
+    # Equal sizes keep walk order
+    ('smallest', ['b', 'd', 'c', 'a']),
+    ('largest', ['a', 'c', 'b', 'd']),
+])
+def test_order_is_exact(policy, expected):
+    assert push_all(OrderBuffer(policy), FILES) == expected
+
+
+def test_order_is_exact_past_any_window():
+    files = [(n, (n * 7919) % 100003, 0) for n in range(50000)]
+    sizes = [size for _, size, _ in files]
+    out = push_all(OrderBuffer('smallest'), files)
+    assert [sizes[n] for n in out] == sorted(sizes)
+
+
+def test_flags_come_back_with_their_copy():
+    buffer = OrderBuffer('largest')
+    buffer.push(1, 0b10, 'a', 5, 0)
+    buffer.push(2, 0b101, 'b', 9, 0)
+    assert list(buffer.drain()) == [(2, 0b101), (1, 0b10)]
+
+
+def test_priority_paths_then_newest():
+    buffer = OrderBuffer('priority', ['src/docs', '*.xlsx'])
+    files = [
+        ('src/a.txt', 1, 5), ('src/b.xlsx', 1, 1), ('src/docs/c', 1, 2),
+        ('src/docs/d', 1, 3)
+    ]
+    assert push_all(buffer, files) == [
+        'src/docs/d', 'src/docs/c', 'src/b.xlsx', 'src/a.txt'
+    ]
+    assert path_rank('src/docs', ['src/docs/']) == 0
+    assert path_rank('src/other', ['src/docs']) == 1
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OrderBuffer('random')
@@ -0,0 +1,67 @@
+import os
+
+from backup_pack import PackStore, packed_entries, restore
+
+
+def pack_files(destination, source, files, run_id='r1', pack_size=1 << 30):
+    store = PackStore(destination, run_id, pack_size=pack_size)
+    for rel_path, data in files.items():
+        path = source / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        store.add(rel_path, os.stat(path), data)
+    store.close()
+    return store
+
+
+FILES = {
+    'src/mail/inbox/1': b'one',
+    'src/mail/inbox/2': b'two' * 100,
+    'src/mailbox': b'not mail',
+    'src/notes.txt': b'notes',
+}
+
+
+def test_pack_append_and_restore(tmp_path):
+    destination = str(tmp_path / 'dest')
+    source = tmp_path / 'source'
+    # Tiny packs: every file after the first starts a new one
+    store = pack_files(destination, source, FILES, pack_size=1)
+    assert store.packs == len(FILES)
+    assert store.added == len(FILES)
+
+    index = PackStore(destination, 'r2').path_index('src')
+    assert len(index) == len(FILES)
+
+    target = tmp_path / 'out'
+    assert restore(destination, str(target)) == (0, len(FILES))
+    for rel_path, data in FILES.items():
+        assert (target / rel_path).read_bytes() == data
+        assert (target / rel_path).stat().st_mtime_ns == \
+            (source / rel_path).stat().st_mtime_ns
+
+
+def test_prefix_matches_whole_path_components(tmp_path):
+    destination = str(tmp_path / 'dest')
+    pack_files(destination, tmp_path / 'source', FILES)
+
+    assert sorted(row[0] for row in packed_entries(destination, 'src/mail')) \
+        == ['src/mail/inbox/1', 'src/mail/inbox/2']
+    assert [row[0] for row in packed_entries(destination, 'src/mailbox')] \
+        == ['src/mailbox']
+
+    target = tmp_path / 'out'
+    assert restore(destination, str(target), 'src/mail') == (0, 2)
+    assert not (target / 'src' / 'mailbox').exists()
+
+
+def test_newer_tree_copy_wins(tmp_path):
+    destination = tmp_path / 'dest'
+    pack_files(str(destination), tmp_path / 'source', {'src/a.txt': b'old'})
+    # The file grew past the threshold and went to the tree since
+    (destination / 'src').mkdir()
+    (destination / 'src' / 'a.txt').write_bytes(b'new and large')
+
+    target = tmp_path / 'out'
+    assert restore(str(destination), str(target)) == (1, 0)
+    assert (target / 'src' / 'a.txt').read_bytes() == b'new and large'
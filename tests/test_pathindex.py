@@ -0,0 +1,37 @@
+import os
+
+from backup_pathindex import FILE, SYMLINK, PathIndex
+
+
+def make_tree(root):
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'top.txt').write_text('top')
+    (root / 'a' / 'one.txt').write_text('1')
+    (root / 'a' / 'b' / 'two.txt').write_text('22')
+    os.symlink('top.txt', root / 'link')
+
+
+def paths(index):
+    return sorted(index.file_path(i) for i in range(len(index)))
+
+
+def test_scan_lists_files_and_symlinks(tmp_path):
+    make_tree(tmp_path)
+    index = PathIndex.scan(str(tmp_path))
+    assert paths(index) == [
+        os.path.join('a', 'b', 'two.txt'), os.path.join('a', 'one.txt'),
+        'link', 'top.txt'
+    ]
+    i = index.lookup(os.path.join('a', 'b', 'two.txt'))
+    assert index.sizes[i] == 2 and index.kinds[i] == FILE
+    assert index.kinds[index.lookup('link')] == SYMLINK
+    assert index.lookup('missing.txt') == -1
+    assert index.total_bytes() == 3 + 1 + 2 + os.lstat(tmp_path / 'link').st_size
+
+
+def test_scan_skips_special_files(tmp_path):
+    make_tree(tmp_path)
+    os.mkfifo(tmp_path / 'a' / 'pipe')
+    index = PathIndex.scan(str(tmp_path))
+    assert index.lookup(os.path.join('a', 'pipe')) == -1
+    assert index.lookup(os.path.join('a', 'one.txt')) >= 0
@@ -0,0 +1,97 @@
+import os
+
+from backup_logging import RunManifest
+from backup_restore import Restorer, backup_entries
+
+
+def write_run(destination, run_id, entries, mode='incremental',
+              status='done'):
+    manifest = RunManifest(
+        destination, run_id, source_dirs=['/src/data'], mode=mode
+    )
+    for action, path in entries:
+        manifest.record(action, path, size=1)
+    manifest.close(status=status)
+
+
+def make_backup(tmp_path, names):
+    dst = tmp_path / 'dst'
+    for name in names:
+        path = dst / 'data' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    return str(dst)
+
+
+def test_files_deleted_from_the_source_stay_restorable(tmp_path):
+    dst = make_backup(tmp_path, ['keep.txt', 'deleted.txt'])
+    write_run(dst, '20240101-000000-000', [
+        ('copied', 'data/keep.txt'), ('copied', 'data/deleted.txt')
+    ])
+    # deleted.txt is gone from the source: the next run does not list it
+    write_run(dst, '20240102-000000-000', [('skipped', 'data/keep.txt')])
+
+    assert sorted(backup_entries(dst)) == ['data/deleted.txt', 'data/keep.txt']
+
+    target = tmp_path / 'out'
+    summary = Restorer(dst, str(target)).run()
+    assert summary['restored_files'] == 2
+    assert (target / 'data' / 'deleted.txt').read_text() == 'deleted.txt'
+
+
+def test_removed_paths_are_dropped(tmp_path):
+    dst = make_backup(tmp_path, ['keep.txt'])
+    write_run(dst, '20240101-000000-000', [
+        ('copied', 'data/keep.txt'), ('copied', 'data/gone.txt')
+    ])
+    write_run(dst, '20240102-000000-000', [
+        ('skipped', 'data/keep.txt'), ('removed', 'data/gone.txt')
+    ], mode='mirror')
+    # Nothing older than a complete mirror run is read
+    write_run(dst, '20240100-000000-000', [('copied', 'data/ancient.txt')])
+
+    assert list(backup_entries(dst)) == ['data/keep.txt']
+
+
+def test_kept_and_removed_by_one_run_is_kept(tmp_path):
+    dst = make_backup(tmp_path, ['moved.txt'])
+    # e.g. a packed file whose tree copy replaced the pack row
+    write_run(dst, '20240101-000000-000', [
+        ('copied', 'data/moved.txt'), ('removed', 'data/moved.txt')
+    ], mode='mirror')
+    assert list(backup_entries(dst)) == ['data/moved.txt']
+
+
+def test_restore_keeps_newer_files_unless_overwrite(tmp_path):
+    dst = make_backup(tmp_path, ['a.txt', 'b.txt'])
+    write_run(dst, '20240101-000000-000', [
+        ('copied', 'data/a.txt'), ('copied', 'data/b.txt')
+    ])
+    target = tmp_path / 'out'
+    (target / 'data').mkdir(parents=True)
+    live = target / 'data' / 'a.txt'
+    live.write_text('edited since the backup')
+    backup_mtime = os.stat(os.path.join(dst, 'data', 'a.txt')).st_mtime_ns
+    os.utime(live, ns=(backup_mtime + 10 ** 9, backup_mtime + 10 ** 9))
+
+    reasons = {}
+    summary = Restorer(
+        dst, str(target),
+        report=lambda action, rel_path, **f: reasons.update(
+            {rel_path: f.get('reason')})
+    ).run()
+    assert live.read_text() == 'edited since the backup'
+    assert reasons['data/a.txt'] == 'newer'
+    assert summary['newer_files'] == 1 and summary['restored_files'] == 1
+
+    Restorer(dst, str(target), overwrite=True).run()
+    assert live.read_text() == 'a.txt'
+
+
+def test_rerun_skips_unchanged_files(tmp_path):
+    dst = make_backup(tmp_path, ['a.txt'])
+    write_run(dst, '20240101-000000-000', [('copied', 'data/a.txt')])
+    target = str(tmp_path / 'out')
+    Restorer(dst, target).run()
+    summary = Restorer(dst, target).run()
+    assert summary['skipped_files'] == 1 and summary['newer_files'] == 0
@@ -0,0 +1,95 @@
+import errno
+
+import pytest
+
+import backup_retry
+from backup_retry import RetryQueue, backoff, classify, retry_call
+
+
+def eagain():
+    return OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(backup_retry, 'time', clock)
+    return clock
+
+
+def test_errors_are_classified():
+    assert classify(eagain()) == 'retry'
+    assert classify(OSError(errno.ENOSPC, 'full')) == 'cleanup'
+    assert classify(OSError(errno.EACCES, 'denied')) == 'permanent'
+    assert classify(ValueError('bad')) == 'permanent'
+    assert [backoff(n) for n in (1, 2, 3)] == [1.0, 2.0, 4.0]
+    assert backoff(20) == backup_retry.MAX_DELAY
+
+
+def test_retry_call_retries_eagain_then_succeeds(clock):
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise eagain()
+        return 'ok'
+
+    assert retry_call(flaky) == 'ok'
+    assert clock.slept == [1.0, 2.0]
+
+
+def test_retry_call_gives_up(clock):
+    def always():
+        raise eagain()
+
+    def denied():
+        raise PermissionError(errno.EACCES, 'Permission denied')
+
+    with pytest.raises(OSError):
+        retry_call(always, attempts=2)
+    with pytest.raises(PermissionError):
+        retry_call(denied)
+    assert clock.slept == [1.0]
+
+
+def test_queue_hands_items_back_after_their_backoff(clock):
+    retries = RetryQueue(max_attempts=3)
+    assert retries.schedule('a', 1, eagain())
+    assert retries.pop_due() == []
+    clock.now += 1.0
+    assert retries.pop_due() == [('a', 2)]
+    assert retries.schedule('a', 2, eagain())
+    clock.now += 2.0
+    assert retries.pop_due() == [('a', 3)]
+    # Out of attempts, or not transient: failed at once
+    assert not retries.schedule('a', 3, eagain())
+    assert not retries.schedule('b', 1, OSError(errno.EACCES, 'denied'))
+    assert retries.pending() == 0
+
+
+def test_out_of_space_waits_for_the_cleanup(clock):
+    full = OSError(errno.ENOSPC, 'No space left on device')
+    assert not RetryQueue().schedule('a', 1, full)
+
+    retries = RetryQueue(defer_cleanup=True)
+    assert retries.schedule('a', 1, full)
+    clock.now += 1000
+    assert retries.pop_due() == []
+    assert retries.release_deferred() == 1
+    assert retries.pop_due() == [('a', 2)]
+    # After the cleanup, running out of space again is final
+    assert not retries.schedule('b', 1, full)
@@ -0,0 +1,95 @@
+import os
+import threading
+
+from backup_control import JobControl
+from backup_pathindex import PathIndex
+from backup_scan import ParallelScanner, WorkStealingPool
+
+
+def make_tree(root, width=4, depth=3):
+    """width subdirectories per level, depth levels, files in each."""
+    root.mkdir(exist_ok=True)
+    for n in range(width):
+        (root / f"f{n}.txt").write_text('x' * n)
+    if depth:
+        for n in range(width):
+            make_tree(root / f"d{n}", width, depth - 1)
+    os.link(root / 'f1.txt', root / 'hard.txt')
+    os.symlink('f0.txt', root / 'link')
+
+
+def layout(index):
+    """Directories, files and hard-link pairs by path: ids depend on
+    the order directories were listed in."""
+    path = index.file_path
+    return (
+        sorted(index.dir_path(d) for d in range(index.dir_total())),
+        sorted(
+            (path(i), index.sizes[i], index.mtimes[i], index.kinds[i])
+            for i in range(len(index))
+        ),
+        {frozenset((path(i), path(j))) for i, j in index.hardlinks.items()}
+    )
+
+
+def test_parallel_scan_matches_the_sequential_one(tmp_path):
+    make_tree(tmp_path / 'src')
+    with ParallelScanner(workers=4) as scanner:
+        parallel = scanner.scan(str(tmp_path / 'src'))
+    sequential = PathIndex.scan(str(tmp_path / 'src'))
+    assert layout(parallel) == layout(sequential)
+    assert parallel.dir_total() == 1 + 4 + 16 + 64
+    assert layout(parallel)[2], "hard links were found"
+
+
+def test_trees_share_one_pool(tmp_path):
+    roots = [tmp_path / f"src{n}" for n in range(3)]
+    for root in roots:
+        make_tree(root, width=3, depth=2)
+    results = {}
+    with ParallelScanner(workers=4) as scanner:
+        threads = [
+            threading.Thread(
+                target=lambda r=root: results.update(
+                    {r: scanner.scan(str(r))}
+                )
+            )
+            for root in roots
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+    for root in roots:
+        assert layout(results[root]) == layout(PathIndex.scan(str(root)))
+
+
+def test_cancelled_scan_returns_what_it_listed(tmp_path):
+    make_tree(tmp_path / 'src', width=3, depth=2)
+    control = JobControl()
+    control.cancel()
+    with ParallelScanner(workers=2, control=control) as scanner:
+        index = scanner.scan(str(tmp_path / 'src'))
+    assert len(index) == 0
+
+
+def test_pool_runs_every_task_once():
+    done = []
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def handler(n):
+        if n < 100:
+            # Tasks queued from a worker go to its own deque
+            pool.submit(n + 100)
+        with lock:
+            done.append(n)
+            if len(done) == 200:
+                finished.set()
+
+    pool = WorkStealingPool(handler, workers=4)
+    for n in range(100):
+        pool.submit(n)
+    assert finished.wait(10)
+    pool.close()
+    assert sorted(done) == list(range(200))
@@ -0,0 +1,121 @@
+import os
+import threading
+
+from backup_logging import RunManifest
+from backup_snapshot import (
+    delete_snapshot, list_snapshots, prune, select_prune, snapshot_path,
+    snapshot_status
+)
+
+DAY1 = ['20240101-080000-000', '20240101-200000-000']
+DAY2 = ['20240102-080000-000']
+DAY3 = ['20240103-080000-000', '20240103-200000-000']
+RUNS = DAY1 + DAY2 + DAY3
+
+
+def test_no_rules_keep_everything():
+    assert select_prune(RUNS) == []
+
+
+def test_keep_last():
+    assert select_prune(RUNS, keep_last=2) == DAY1 + DAY2
+
+
+def test_keep_daily_keeps_the_newest_of_each_day():
+    assert select_prune(RUNS, keep_daily=2) == DAY1 + DAY3[:1]
+    assert select_prune(RUNS, keep_last=1, keep_daily=3) == \
+        DAY1[:1] + DAY3[:1]
+
+
+def test_the_newest_snapshot_is_always_kept():
+    assert select_prune(RUNS, keep_monthly=0, keep_weekly=1) == RUNS[:-1]
+
+
+def test_only_complete_snapshots_count():
+    # The two newest were cancelled: keep_last=2 keeps two complete ones
+    complete = DAY1 + DAY2
+    assert select_prune(RUNS, keep_last=2, complete=complete) == DAY1[:1]
+    # Incomplete ones older than a complete snapshot go
+    complete = [RUNS[0], RUNS[2], RUNS[4]]
+    assert select_prune(RUNS, keep_last=3, complete=complete) == \
+        [RUNS[1], RUNS[3]]
+    # Nothing complete yet: nothing to fall back on, nothing goes
+    assert select_prune(RUNS, keep_last=1, complete=[]) == []
+
+
+def make_snapshot(destination, run_id, status):
+    root = snapshot_path(destination, run_id)
+    os.makedirs(os.path.join(root, 'src'))
+    with open(os.path.join(root, 'src', 'a.txt'), 'w') as f:
+        f.write(run_id)
+    manifest = RunManifest(root, run_id, mode='snapshot')
+    manifest.record('copied', os.path.join('src', 'a.txt'), size=1)
+    if status:
+        manifest.close(status=status)
+    else:
+        # A run that died: no summary line
+        manifest.records.put(None)
+        manifest.thread.join()
+
+
+def test_prune_reads_the_status_of_each_snapshot(tmp_path):
+    destination = str(tmp_path)
+    statuses = ['done', 'done', 'cancelled', None, 'done', 'error']
+    runs = [f"2024010{n + 1}-080000-000" for n in range(len(statuses))]
+    for run_id, status in zip(runs, statuses):
+        make_snapshot(destination, run_id, status)
+
+    assert [snapshot_status(destination, r) for r in runs] == statuses
+    summary = prune(destination, {'keep_last': 2})
+    # The last two complete ones stay, and the failed run after them
+    assert summary['snapshots'] == [runs[0], runs[2], runs[3]]
+    assert list_snapshots(destination) == [runs[1], runs[4], runs[5]]
+    assert summary['files'] == 3
+
+
+def test_prune_counts_the_run_that_prunes(tmp_path):
+    destination = str(tmp_path)
+    runs = [f"2024010{n + 1}-080000-000" for n in range(3)]
+    make_snapshot(destination, runs[0], 'done')
+    make_snapshot(destination, runs[1], 'done')
+    # Still open: its manifest is closed after the prune
+    make_snapshot(destination, runs[2], None)
+
+    summary = prune(destination, {'keep_last': 2}, done=[runs[2]])
+    assert summary['snapshots'] == runs[:1]
+
+
+def test_links_unlinked_at_once_count_as_freed(tmp_path, monkeypatch):
+    snapshot = str(tmp_path / 'r1')
+    for rel_dir in ('a', 'b'):
+        os.makedirs(os.path.join(snapshot, rel_dir))
+    data = os.path.join(snapshot, 'a', 'data')
+    with open(data, 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+    os.link(data, os.path.join(snapshot, 'b', 'data'))
+    # Also in another snapshot: not freed
+    kept = os.path.join(snapshot, 'a', 'kept')
+    with open(kept, 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+    os.link(kept, os.path.join(snapshot, 'b', 'kept'))
+    os.link(kept, str(tmp_path / 'elsewhere'))
+    manifest = RunManifest(snapshot, 'r1', mode='snapshot')
+    for rel_path in ('a/data', 'b/data', 'a/kept', 'b/kept'):
+        manifest.record('copied', rel_path, size=1)
+    manifest.close(status='done')
+    size = os.stat(data).st_blocks * 512
+
+    # Both directories stat their names before either unlinks one
+    both_stated = threading.Barrier(2)
+    unlink = os.unlink
+
+    def unlink_together(name, dir_fd=None):
+        if name == 'data':
+            both_stated.wait(timeout=5)
+        unlink(name, dir_fd=dir_fd)
+    monkeypatch.setattr(os, 'unlink', unlink_together)
+
+    files, freed = delete_snapshot(snapshot, workers=2)
+    assert files == 4
+    assert freed == size
+    assert os.path.exists(tmp_path / 'elsewhere')
@@ -0,0 +1,57 @@
+import os
+import time
+
+import pytest
+
+from backup_copy import choose_tier, copy_file
+from backup_throttle import IOThrottle, TokenBucket
+
+MB = 1024 * 1024
+
+
+def test_bucket_holds_its_rate():
+    bucket = TokenBucket(MB)
+    started = time.monotonic()
+    for _ in range(8):
+        bucket.consume(64 * 1024)
+    # 512 KB at 1 MB/s, from an empty bucket
+    assert 0.4 <= time.monotonic() - started <= 0.8
+
+
+def test_unlimited_bucket_does_not_wait():
+    bucket = TokenBucket(0)
+    started = time.monotonic()
+    bucket.consume(100 * MB)
+    assert time.monotonic() - started < 0.05
+
+
+@pytest.mark.parametrize('tier', ['kernel', 'sendfile'])
+def test_throttle_applies_to_explicit_kernel_tiers(tmp_path, tier):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(2 * MB))
+    st = src.stat()
+    dest = str(tmp_path / 'dest.bin')
+    assert choose_tier(st, dest, True, tier) == 'chunked'
+    assert choose_tier(st, dest, False, tier) == tier
+
+    throttle = IOThrottle({'read_bytes_per_sec': 4 * MB})
+    started = time.monotonic()
+    copy_file(str(src), dest, throttle, tier)
+    assert time.monotonic() - started >= 0.35
+    assert open(dest, 'rb').read() == src.read_bytes()
+
+
+@pytest.mark.parametrize('limits', [
+    [], {'read_bytes_per_sec': []}, {'read_bytes_per_sec': {}},
+    {'read_bytes_per_sec': 'fast'}, {'read_bytes_per_sec': -1},
+    {'read_bytes_per_sec': float('nan')}, {'bogus': 1},
+])
+def test_bad_limits_are_rejected_whole(limits):
+    throttle = IOThrottle({'write_bytes_per_sec': 5})
+    with pytest.raises(ValueError):
+        throttle.set_limits(
+            dict(limits, write_files_per_sec=3)
+            if isinstance(limits, dict) else limits
+        )
+    assert throttle.limits()['write_bytes_per_sec'] == 5
+    assert throttle.limits()['write_files_per_sec'] == 0
@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+import backup_tuner
+from backup_tuner import BACKOFF, ConcurrencyTuner
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(backup_tuner, 'time', clock)
+    return clock
+
+
+def window(tuner, clock, files, nbytes):
+    """One measurement window of files copies of nbytes each."""
+    for n in range(files):
+        tuner.acquire()
+        if n == files - 1:
+            clock.now += tuner.window
+        tuner.release(nbytes)
+    return tuner.history[-1]['action']
+
+
+def test_climbs_while_throughput_improves(clock):
+    tuner = ConcurrencyTuner('a->b', start_level=2)
+    assert window(tuner, clock, 10, 1 << 20) == 'increase'
+    assert window(tuner, clock, 20, 1 << 20) == 'increase'
+    assert tuner.level == 4
+
+
+def test_backs_off_multiplicatively_on_a_drop(clock):
+    tuner = ConcurrencyTuner('a->b', start_level=8)
+    window(tuner, clock, 40, 1 << 20)
+    assert tuner.level == 9
+    assert window(tuner, clock, 10, 1 << 20) == 'decrease'
+    assert tuner.level == int(9 * BACKOFF)
+
+
+def test_gives_back_a_stream_that_bought_nothing(clock):
+    tuner = ConcurrencyTuner('a->b', start_level=2)
+    window(tuner, clock, 10, 1 << 20)
+    assert tuner.level == 3
+    assert window(tuner, clock, 10, 1 << 20) == 'revert'
+    assert tuner.level == 2
+    # Flat from then on: held, then probed again
+    actions = [window(tuner, clock, 10, 1 << 20) for _ in range(4)]
+    assert actions == ['hold', 'hold', 'increase', 'revert']
+
+
+def test_levels_stay_in_bounds(clock):
+    tuner = ConcurrencyTuner('a->b', min_level=1, max_level=3, start_level=3)
+    window(tuner, clock, 10, 1 << 20)
+    assert tuner.level == 3
+    # Each window slower than the one before
+    for k in range(1, 5):
+        assert window(tuner, clock, 3, (1 << 20) >> k) == 'decrease'
+    assert tuner.level == 1
+
+
+def test_gate_holds_copies_past_the_level(clock):
+    tuner = ConcurrencyTuner('a->b', start_level=1)
+    tuner.acquire()
+    started = threading.Event()
+
+    def second():
+        tuner.acquire()
+        started.set()
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not started.wait(0.1)
+    tuner.release()
+    assert started.wait(5)
+    tuner.release()
+    thread.join()
+    assert tuner.snapshot()['in_flight'] == 0
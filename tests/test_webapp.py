@@ -0,0 +1,188 @@
+import errno
+import os
+
+import pytest
+
+pytest.importorskip('flask')
+
+import backup_retry
+import backup_webapp_AIO as webapp
+from backup_catalog import search as catalog_search
+from backup_compare import HashCache, file_digest
+from backup_logging import manifest_status
+
+
+def test_backup_error_still_applies_metadata(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    (source / 'docs').mkdir(parents=True)
+    src_file = source / 'docs' / 'a.txt'
+    src_file.write_text('data')
+    os.utime(src_file, ns=(10 ** 18, 10 ** 18))
+    destination = tmp_path / 'dest'
+    destination.mkdir()
+    # The job databases are opened in the working directory
+    monkeypatch.chdir(tmp_path)
+
+    def fail(plan):
+        raise RuntimeError('links failed')
+    monkeypatch.setattr(webapp, 'link_hardlinks', fail)
+
+    webapp.backup_worker([str(source)], [str(destination)], False)
+
+    assert webapp.progress['status'] == 'error'
+    dest_file = destination / 'source' / 'docs' / 'a.txt'
+    assert dest_file.read_text() == 'data'
+    assert dest_file.stat().st_mtime_ns == 10 ** 18
+
+
+def test_copied_files_have_their_digest_cached(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'a.txt').write_text('data')
+    destination = tmp_path / 'dest'
+    destination.mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    webapp.backup_worker(
+        [str(source)], [str(destination)], False, compare_mode='hash'
+    )
+
+    assert webapp.progress['copied_files'] == 1
+    cache = HashCache(webapp.HASH_CACHE_DB)
+    try:
+        digest = file_digest(str(source / 'a.txt'))
+        for path in (source / 'a.txt', destination / 'source' / 'a.txt'):
+            assert cache.get(str(path), os.stat(path)) == digest
+    finally:
+        cache.close()
+
+
+def test_catalog_gets_the_digest_of_hash_compared_copies(
+        tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'budget.xlsx').write_bytes(b'x' * 100000)
+    destination = tmp_path / 'dest'
+    destination.mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    webapp.backup_worker(
+        [str(source)], [str(destination)], False, compare_mode='hash'
+    )
+
+    results = catalog_search('budget', db_path=webapp.CATALOG_DB)
+    assert [r['hash'] for r in results] == [
+        file_digest(str(source / 'budget.xlsx'))
+    ]
+
+
+def test_catalog_alone_does_not_read_copies_again(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'budget.xlsx').write_bytes(b'x' * 100000)
+    destination = tmp_path / 'dest'
+    destination.mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    def read_again(*args):
+        raise AssertionError('copy read twice')
+    monkeypatch.setattr(webapp, 'copied_digest', read_again)
+
+    webapp.backup_worker([str(source)], [str(destination)], False)
+
+    assert webapp.progress['copied_files'] == 1
+    results = catalog_search('budget', db_path=webapp.CATALOG_DB)
+    assert [r['hash'] for r in results] == [None]
+
+
+def test_ordered_copies_reach_their_own_destinations(tmp_path, monkeypatch):
+    sources = [tmp_path / 'one', tmp_path / 'two']
+    for n, source in enumerate(sources):
+        (source / 'sub').mkdir(parents=True)
+        (source / 'big.bin').write_bytes(b'b' * (1000 + n))
+        (source / 'sub' / 'small.txt').write_text(f"small {n}")
+    destinations = [tmp_path / 'a', tmp_path / 'b']
+    for destination in destinations:
+        destination.mkdir()
+    # Already up to date in a only
+    (destinations[0] / 'two' / 'sub').mkdir(parents=True)
+    kept = destinations[0] / 'two' / 'sub' / 'small.txt'
+    kept.write_text('small 1')
+    st = (sources[1] / 'sub' / 'small.txt').stat()
+    os.utime(kept, ns=(st.st_atime_ns, st.st_mtime_ns))
+    monkeypatch.chdir(tmp_path)
+
+    webapp.backup_worker(
+        [str(s) for s in sources], [str(d) for d in destinations], False,
+        order='smallest'
+    )
+
+    assert webapp.progress['status'] == 'done'
+    assert webapp.progress['copied_files'] == 7
+    for source in sources:
+        for destination in destinations:
+            for rel in ('big.bin', 'sub/small.txt'):
+                copy = destination / source.name / rel
+                assert copy.read_bytes() == (source / rel).read_bytes()
+
+
+def test_bad_throttle_limits_are_a_client_error():
+    client = webapp.app.test_client()
+    for body in ([1], {'read_bytes_per_sec': [1]}, {'read_bytes_per_sec': {}}):
+        response = client.post('/throttle', json=body)
+        assert response.status_code == 400
+
+
+def test_cancel_mid_run_leaves_a_cancelled_manifest(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for n in range(20):
+        (source / f"f{n:02d}.txt").write_text(str(n))
+    destination = tmp_path / 'dest'
+    destination.mkdir()
+    monkeypatch.chdir(tmp_path)
+    copy = webapp.copy_file_multi
+    calls = []
+
+    def cancel_after_first(src_file, *args):
+        calls.append(src_file)
+        if len(calls) == 2:
+            webapp.control.cancel()
+        return copy(src_file, *args)
+    monkeypatch.setattr(webapp, 'copy_file_multi', cancel_after_first)
+
+    webapp.backup_worker([str(source)], [str(destination)], False)
+
+    assert webapp.progress['status'] == 'cancelled'
+    assert webapp.progress['copied_files'] < 20
+    (path,) = (destination / '.backup' / 'manifests').iterdir()
+    assert manifest_status(str(path)) == 'cancelled'
+    assert not [p for p in (destination / 'source').iterdir()
+                if p.name.endswith('.backup-part')]
+
+
+def test_transient_copy_error_is_retried(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'busy.txt').write_text('data')
+    destination = tmp_path / 'dest'
+    destination.mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backup_retry, 'BASE_DELAY', 0.01)
+    copy = webapp.copy_file_multi
+    calls = []
+
+    def busy_once(src_file, dest_files, *args):
+        calls.append(src_file)
+        if len(calls) == 1:
+            return {d: OSError(errno.EAGAIN, 'busy') for d in dest_files}
+        return copy(src_file, dest_files, *args)
+    monkeypatch.setattr(webapp, 'copy_file_multi', busy_once)
+
+    webapp.backup_worker([str(source)], [str(destination)], False)
+
+    assert len(calls) == 2
+    assert webapp.progress['status'] == 'done'
+    assert webapp.progress['retried_files'] == 1
+    assert webapp.progress['failed_files'] == 0
+    assert (destination / 'source' / 'busy.txt').read_text() == 'data'